@@ -5,7 +5,19 @@ import webbrowser
 import pyautogui
 import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util.retry import Retry
 import json
+import sqlite3
+import zlib
+import mmap
+import bz2
+import gzip
+import asyncio
+import ssl
+import socket
+import weakref
 import time
 import os
 import difflib
@@ -16,7 +28,11 @@ import importlib.util
 import traceback
 import unicodedata
 import math
-from typing import Dict, List, Any, Optional
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED, CancelledError, TimeoutError as FutureTimeoutError
+from typing import Dict, List, Any, Optional, Iterable, Iterator, Tuple
+from html.parser import HTMLParser
 try:
     import pystray
     from PIL import Image, ImageDraw
@@ -27,12 +43,21 @@ except Exception:
     ImageDraw = None
     PYSTRAY_AVAILABLE = False
 
+# NumPy serve à voz e ao ranking dos trechos; sem ele o ranking roda em Python puro
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except Exception:
+    np = None
+    NUMPY_AVAILABLE = False
+
 # =========================
 # IMPORTAÇÕES PARA RECONHECIMENTO DE VOZ
 # =========================
 try:
+    if not NUMPY_AVAILABLE:
+        raise ImportError("numpy")
     import sounddevice as sd
-    import numpy as np
     from scipy.io.wavfile import write
     import whisper
     import tempfile
@@ -43,7 +68,6 @@ try:
         import winsound
 except Exception:
     sd = None
-    np = None
     write = None
     whisper = None
     tempfile = None
@@ -69,6 +93,20 @@ FONT_TITLE = ("Consolas", 16, "bold")
 
 ADDON_DIRECT_KEYWORDS = {}
 
+# Arquivo opcional de configuração (modelos por papel, orçamentos de histórico etc.)
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "jarvis_config.json")
+
+def load_config(path: str = CONFIG_PATH) -> Dict[str, Any]:
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except Exception as e:
+        print(f"[JARVIS] Erro ao ler {os.path.basename(path)}: {e}")
+        return {}
+
 # =========================
 # SEGURANÇA
 # =========================
@@ -101,6 +139,70 @@ Responda somente se tiver certeza da resposta, caso contrário, admita que não
 Se não tiver certeza, você pode sempre pesquisar ela, mas se o resultado for inconclusivo ou contraditório, admita que não tem certeza ao invés de tentar adivinhar ou inventar uma resposta.
 """
 
+# =========================
+# PLANEJADOR
+# =========================
+PLANNER_FORMAT = (
+    "{\n"
+    '  "action": "chat|research|open|search|youtube|ytvideo|type|clear|math",\n'
+    '  "target": "",\n'
+    '  "query": "",\n'
+    '  "text": "",\n'
+    '  "context_query": ""\n'
+    "}"
+)
+
+PLANNER_ACTIONS = ("chat", "research", "open", "search", "youtube", "ytvideo", "type", "clear", "math")
+PLANNER_FIELDS = ("target", "query", "text", "context_query")
+
+# Schema enviado no campo "format" do Ollama: a saída do planner é restrita a esse JSON
+PLANNER_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "action": {"type": "string", "enum": list(PLANNER_ACTIONS)},
+        **{field: {"type": "string"} for field in PLANNER_FIELDS},
+    },
+    "required": ["action", *PLANNER_FIELDS],
+}
+
+# O JSON do plano raramente passa de ~60 tokens; o limite só precisa acomodar "text" de /digitar
+PLANNER_NUM_PREDICT = 256
+
+PLANNER_RULES = (
+    "- Se o usuário pedir para pesquisar informação, explicar um tema, ou responder algo que exija conhecimento externo, use action=\"research\" e preencha query com o termo principal.\n"
+    "- Se pedir para abrir algo, use action=\"open\" e target com o nome do app/arquivo.\n"
+    "- Se pedir pesquisa no Google, use action=\"search\" e query.\n"
+    "- Se pedir YouTube, use action=\"youtube\" ou \"ytvideo\".\n"
+    "- Se pedir para digitar, use action=\"type\" e text.\n"
+    "- Se pedir para limpar, use action=\"clear\".\n"
+    "- Se for uma pergunta matemática, use action=\"math\" e coloque a expressão em query.\n"
+    "- Caso contrário, use action=\"chat\".\n"
+)
+
+PLANNER_PROMPT = (
+    "Você é o planejador de ações do JARVIS. "
+    "Responda SOMENTE com JSON válido, sem markdown e sem texto extra.\n\n"
+    "Formato obrigatório:\n"
+    + PLANNER_FORMAT + "\n\n"
+    "Regras:\n"
+    + PLANNER_RULES
+)
+
+# Modo fundido: uma única inferência devolve o plano (cabeçalho JSON) e a resposta
+FUSED_PLANNER_PROMPT = (
+    JARVIS_PERSONALITY
+    + "\nModo de resposta única:\n"
+    "Comece SEMPRE com um CABEÇALHO: uma única linha contendo somente o JSON do plano, sem markdown, no formato:\n"
+    '{"action": "chat|research|open|search|youtube|ytvideo|type|clear|math", "target": "", "query": "", "text": "", "context_query": ""}\n\n'
+    "Regras para escolher a ação:\n"
+    + PLANNER_RULES
+    + "\nSe action for \"chat\", escreva a resposta ao usuário logo após a linha do cabeçalho.\n"
+    "Para qualquer outra ação, não escreva nada depois do cabeçalho.\n"
+)
+
+# Se o cabeçalho não aparecer nesses primeiros caracteres, o texto é tratado como resposta de chat
+FUSED_HEADER_MAX_CHARS = 600
+
 # =========================
 # SISTEMA DE ADDONS
 # =========================
@@ -115,13 +217,6 @@ class AddonManager:
         self.addon_direct_keywords = []
         self.direct_keyword_handlers = {}
         
-        try:
-            from PYbrowser import TerminalSearchBrowser
-            self.browser = TerminalSearchBrowser(max_results=5)
-        except Exception as e:
-            print(f"[JARVIS] PYbrowser indisponível: {e}")
-            self.browser = None
-        
         # Hooks disponíveis para os addons
         self.hooks = {
             'pre_init': [],      # Executado antes da inicialização do Jarvis
@@ -137,6 +232,15 @@ class AddonManager:
         # Comandos registrados pelos addons
         self.custom_commands: Dict[str, Dict] = {}
         
+    @property
+    def browser(self):
+        """PYbrowser compartilhado (criado no primeiro acesso); None se indisponível."""
+        return get_browser_service().get()
+
+    def research(self, query: str) -> str:
+        """Texto do artigo sobre o termo, pelo mesmo caminho (e cache) da pesquisa do Jarvis."""
+        return self.jarvis.research_with_context(query)
+
     def scan_addons(self) -> List[str]:
         """Escaneia a pasta atual por arquivos addon_*.py"""
         addon_files = []
@@ -483,6 +587,8 @@ class VoiceSystem:
         
         # Restaura janela se estiver minimizada e reativa IA se necessário
         self.jarvis.restore_and_activate_ai()
+        # Enquanto o usuário fala, o modelo já vai sendo carregado
+        self.jarvis.warm_up_ai("gravação de voz")
         
         self._play_start_sound()
         
@@ -683,6 +789,85 @@ def extract_json(text: str):
     except Exception:
         return None
 
+def estimate_tokens(text: str) -> int:
+    """Estimativa barata de tokens (~4 caracteres por token, suficiente para orçamento)."""
+    if not text:
+        return 0
+    return len(text) // 4 + 1
+
+def estimate_message_tokens(messages) -> int:
+    # ~4 tokens de overhead por mensagem (papel + delimitadores do template)
+    return sum(estimate_tokens(m.get("content", "")) + 4 for m in messages)
+
+def validate_plan(data) -> Optional[dict]:
+    """
+    Valida um plano contra PLANNER_SCHEMA. Retorna o plano normalizado
+    (somente os campos do schema, todos como string) ou None se for inválido.
+    """
+    if not isinstance(data, dict):
+        return None
+    action = data.get("action")
+    if not isinstance(action, str) or action.lower().strip() not in PLANNER_ACTIONS:
+        return None
+    plan = {"action": action.lower().strip()}
+    for field in PLANNER_FIELDS:
+        value = data.get(field, "")
+        if value is None:
+            value = ""
+        elif not isinstance(value, str):
+            if isinstance(value, (dict, list)):
+                return None
+            value = str(value)
+        plan[field] = value
+    return plan
+
+def split_json_header(text: str):
+    """
+    Separa um objeto JSON no início do texto do restante.
+    Retorna (dict, resto) quando o objeto está completo, None se ainda está incompleto
+    e False quando o texto claramente não começa com JSON.
+    """
+    stripped = text.lstrip()
+    if stripped.startswith("```"):
+        # tolera cercas de markdown em volta do cabeçalho
+        newline = stripped.find("\n")
+        if newline == -1:
+            return None
+        stripped = stripped[newline + 1:].lstrip()
+    if not stripped:
+        return None
+    if not stripped.startswith("{"):
+        return False
+
+    depth = 0
+    in_string = False
+    escaped = False
+    for i, ch in enumerate(stripped):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                try:
+                    data = json.loads(stripped[:i + 1])
+                except Exception:
+                    return False
+                rest = stripped[i + 1:]
+                if rest.lstrip().startswith("```"):
+                    rest = rest.lstrip()[3:]
+                return (data, rest.lstrip("\n")) if isinstance(data, dict) else False
+    return None
+
 def clean_query(text: str, remove_words):
     if not text:
         return ""
@@ -713,33 +898,780 @@ def _normalize_for_match(value: str) -> str:
     return value
 
 
-class BrowserKnowledgeProvider:
-    """Integra o PYbrowser para buscar contexto textual na Wikipédia."""
+def _normalize_for_search(value: str) -> str:
+    """Como _normalize_for_match, mas mantém a separação entre as palavras
+    ("bom dia" não casa com "bomdia")."""
+    value = value.lower()
+    value = unicodedata.normalize("NFKD", value)
+    value = "".join(ch for ch in value if not unicodedata.combining(ch))
+    return re.sub(r"[^a-z0-9]+", " ", value).strip()
+
+
+# Palavras muito comuns que não ajudam a escolher trechos
+SEARCH_STOPWORDS = {
+    "a", "o", "as", "os", "um", "uma", "uns", "umas", "de", "do", "da", "dos", "das", "em", "no", "na",
+    "nos", "nas", "por", "para", "pra", "com", "sem", "sobre", "e", "ou", "que", "qual", "quais", "quem",
+    "como", "quando", "onde", "porque", "se", "ao", "aos", "foi", "era", "ser", "sao",
+    "me", "fale", "diga", "explique", "conte", "voce", "the", "of", "and", "in", "is", "mais", "muito",
+}
+
+
+def _search_tokens(text: str) -> List[str]:
+    """Palavras normalizadas (minúsculas, sem acentos), sem stopwords."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return [w for w in re.findall(r"[a-z0-9]+", text) if len(w) > 1 and w not in SEARCH_STOPWORDS]
+
+
+def split_into_chunks(text: str, target_chars: int = 700) -> List[str]:
+    """Divide o artigo em trechos de ~target_chars, respeitando parágrafos
+    (e frases, quando um parágrafo sozinho passa do tamanho)."""
+    chunks: List[str] = []
+    current = ""
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        pieces = [paragraph]
+        if len(paragraph) > target_chars * 2:
+            pieces = re.split(r"(?<=[.!?])\s+", paragraph)
+        for piece in pieces:
+            if current and len(current) + len(piece) + 2 > target_chars:
+                chunks.append(current)
+                current = ""
+            current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def bm25_scores(query_tokens: List[str], chunk_tokens: List[List[str]], k1: float = 1.5, b: float = 0.75) -> List[float]:
+    """Pontuação BM25 de cada trecho para a consulta (vetorizada com NumPy quando disponível)."""
+    n = len(chunk_tokens)
+    terms = list(dict.fromkeys(query_tokens))
+    if not n or not terms:
+        return [0.0] * n
+    lengths = [len(tokens) for tokens in chunk_tokens]
+    avg_len = (sum(lengths) / n) or 1.0
+    counts = []
+    for tokens in chunk_tokens:
+        freq: Dict[str, int] = {}
+        for token in tokens:
+            freq[token] = freq.get(token, 0) + 1
+        counts.append([freq.get(term, 0) for term in terms])
+
+    if NUMPY_AVAILABLE:
+        tf = np.array(counts, dtype=np.float64)  # trechos x termos
+        df = (tf > 0).sum(axis=0)
+        idf = np.log(1.0 + (n - df + 0.5) / (df + 0.5))
+        norm = k1 * (1.0 - b + b * np.array(lengths, dtype=np.float64) / avg_len)
+        scores = (tf * (k1 + 1.0) / (tf + norm[:, None])) @ idf
+        return scores.tolist()
+
+    df = [sum(1 for row in counts if row[j]) for j in range(len(terms))]
+    idf = [math.log(1.0 + (n - d + 0.5) / (d + 0.5)) for d in df]
+    scores = []
+    for row, length in zip(counts, lengths):
+        norm = k1 * (1.0 - b + b * length / avg_len)
+        scores.append(sum(idf[j] * f * (k1 + 1.0) / (f + norm) for j, f in enumerate(row) if f))
+    return scores
+
+
+def select_relevant_chunks(text: str, question: str, max_chars: int) -> str:
+    """
+    Monta o contexto com os trechos mais relevantes para a pergunta (BM25), dentro de
+    max_chars. O primeiro trecho (introdução do artigo) entra sempre; os demais saem
+    na ordem original do artigo.
+    """
+    if len(text) <= max_chars:
+        return text
+    chunks = split_into_chunks(text)
+    if not chunks:
+        return ""
+    scores = bm25_scores(_search_tokens(question), [_search_tokens(c) for c in chunks])
+
+    selected = {0}
+    used = len(chunks[0])
+    for index in sorted(range(1, len(chunks)), key=lambda i: scores[i], reverse=True):
+        if scores[index] <= 0:
+            break
+        if used + len(chunks[index]) + 7 > max_chars:
+            continue
+        selected.add(index)
+        used += len(chunks[index]) + 7
+
+    parts = []
+    previous = -1
+    for index in sorted(selected):
+        if parts and index != previous + 1:
+            parts.append("[...]")
+        parts.append(chunks[index])
+        previous = index
+    context = "\n\n".join(parts)
+    if len(context) > max_chars:
+        context = context[:max_chars].rsplit(" ", 1)[0].strip()
+    return context
+
+
+RESEARCH_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "research_index")
+
+
+def hashing_embedding(text: str, dim: int = 1024) -> List[float]:
+    """Embedding local sem modelo: feature hashing de palavras e bigramas (crc32,
+    estável entre execuções), com peso log(1+tf) e norma L2."""
+    tokens = _search_tokens(text)
+    features: Dict[int, float] = {}
+    for feature in tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]:
+        h = zlib.crc32(feature.encode("utf-8"))
+        slot = h % dim
+        features[slot] = features.get(slot, 0.0) + (1.0 if (h >> 31) & 1 else -1.0)
+    vector = [0.0] * dim
+    for slot, value in features.items():
+        vector[slot] = math.copysign(math.log1p(abs(value)), value)
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+class VectorIndex:
+    """
+    Índice vetorial local dos trechos de artigos já pesquisados. Os vetores ficam num
+    .npy memory-mapped (cresce dobrando a capacidade) e os metadados num .jsonl
+    append-only. Cada URL é indexada uma única vez. embedder(lista de textos) ->
+    lista de vetores; embedder_name identifica o espaço vetorial (trocar de embedder
+    recria o índice).
+    """
+
+    def __init__(self, base_path: str = RESEARCH_INDEX_PATH, embedder=None, embedder_name: str = "hash-1024"):
+        self.vectors_path = base_path + ".npy"
+        self.meta_path = base_path + ".jsonl"
+        self.embedder = embedder or (lambda texts: [hashing_embedding(t) for t in texts])
+        self.embedder_name = embedder_name
+        self._lock = threading.RLock()
+        self._vectors = None
+        self.rows: List[Dict[str, Any]] = []
+        self.by_url: Dict[str, List[int]] = {}
+        self.dim = 0
+        self.stats = {"queries": 0, "sufficient": 0, "insufficient": 0, "documents_added": 0}
+        self._load()
+
+    def _load(self):
+        if not (os.path.exists(self.meta_path) and os.path.exists(self.vectors_path)):
+            return
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                header = json.loads(f.readline() or "{}")
+                rows = [json.loads(line) for line in f if line.strip()]
+            if header.get("embedder") != self.embedder_name:
+                print(f"[JARVIS][ÍNDICE] Embedder mudou ({header.get('embedder')} -> {self.embedder_name}); recriando índice")
+                return self._reset()
+            vectors = np.load(self.vectors_path, mmap_mode="r+")
+            rows = rows[:vectors.shape[0]]
+            self.dim = int(header.get("dim") or vectors.shape[1])
+            self._vectors = vectors
+            self.rows = rows
+            for index, row in enumerate(rows):
+                self.by_url.setdefault(row["url"], []).append(index)
+            print(f"[JARVIS][ÍNDICE] {len(self.by_url)} páginas, {len(rows)} trechos carregados")
+        except Exception as e:
+            print(f"[JARVIS][ÍNDICE] Índice ilegível, recriando: {e}")
+            self._reset()
+
+    def _reset(self):
+        self._vectors = None
+        self.rows = []
+        self.by_url = {}
+        self.dim = 0
+        for path in (self.vectors_path, self.meta_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _ensure_capacity(self, needed: int, dim: int):
+        if self._vectors is not None and self._vectors.shape[0] >= needed:
+            return
+        capacity = max(1024, needed, 2 * (self._vectors.shape[0] if self._vectors is not None else 0))
+        tmp_path = self.vectors_path + ".tmp"
+        grown = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(capacity, dim))
+        count = len(self.rows)
+        if self._vectors is not None and count:
+            grown[:count] = self._vectors[:count]
+        grown.flush()
+        # O arquivo antigo precisa estar fechado antes da troca (Windows)
+        self._vectors = None
+        del grown
+        os.replace(tmp_path, self.vectors_path)
+        self._vectors = np.load(self.vectors_path, mmap_mode="r+")
+
+    def has_url(self, url: str) -> bool:
+        with self._lock:
+            return url in self.by_url
+
+    def add_document(self, url: str, title: str, text: str) -> int:
+        """Indexa os trechos de um artigo (uma vez por URL). Retorna quantos trechos entraram."""
+        if not url or not text or self.has_url(url):
+            return 0
+        chunks = split_into_chunks(text)
+        if not chunks:
+            return 0
+        vectors = np.asarray(self.embedder(chunks), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.maximum(norms, 1e-9)
+        with self._lock:
+            if url in self.by_url:
+                return 0
+            if not self.rows:
+                self.dim = vectors.shape[1]
+                with open(self.meta_path, "w", encoding="utf-8") as f:
+                    f.write(json.dumps({"embedder": self.embedder_name, "dim": self.dim}) + "\n")
+            elif vectors.shape[1] != self.dim:
+                print(f"[JARVIS][ÍNDICE] Dimensão inesperada ({vectors.shape[1]} != {self.dim}); ignorando {url}")
+                return 0
+            start = len(self.rows)
+            self._ensure_capacity(start + len(chunks), self.dim)
+            self._vectors[start:start + len(chunks)] = vectors
+            self._vectors.flush()
+            new_rows = [{"url": url, "title": title, "pos": pos, "text": chunk} for pos, chunk in enumerate(chunks)]
+            with open(self.meta_path, "a", encoding="utf-8") as f:
+                for row in new_rows:
+                    f.write(json.dumps(row, ensure_ascii=False) + "\n")
+            self.rows.extend(new_rows)
+            self.by_url[url] = list(range(start, start + len(chunks)))
+            self.stats["documents_added"] += 1
+        print(f"[JARVIS][ÍNDICE] {len(chunks)} trechos indexados de: {url}")
+        return len(chunks)
+
+    def search(self, text: str, top_k: int = 8) -> List[tuple]:
+        """Trechos mais próximos do texto, como [(similaridade, linha)], melhores primeiro."""
+        with self._lock:
+            count = len(self.rows)
+            if not count or self._vectors is None:
+                return []
+        query = np.asarray(self.embedder([text])[0], dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-9)
+        with self._lock:
+            if query.shape[0] != self.dim:
+                return []
+            scores = self._vectors[:count] @ query
+            k = min(top_k, count)
+            best = np.argpartition(-scores, k - 1)[:k]
+            best = best[np.argsort(-scores[best])]
+            return [(float(scores[i]), self.rows[i]) for i in best]
+
+    def document_chunks(self, url: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [self.rows[i] for i in self.by_url.get(url, [])]
+
+    def record_query(self, sufficient: bool):
+        """Conta uma consulta e se o índice bastou para respondê-la."""
+        with self._lock:
+            self.stats["queries"] += 1
+            self.stats["sufficient" if sufficient else "insufficient"] += 1
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["documents"] = len(self.by_url)
+            stats["chunks"] = len(self.rows)
+            stats["bytes"] = len(self.rows) * self.dim * 4
+        return stats
+
+
+RESEARCH_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "research_cache.db")
+
+
+class ResearchCache:
+    """
+    Cache persistente das pesquisas (SQLite): texto do artigo comprimido com zlib, URL,
+    título e horário da busca. Limitado pelo total de bytes comprimidos (LRU pelo último
+    acesso), com TTL para resultados e um TTL menor para buscas que não acharam nada.
+    Entradas vencidas guardam ETag/Last-Modified para revalidação condicional.
+    """
+
+    def __init__(self, path: str = RESEARCH_CACHE_PATH, max_bytes: int = 64 * 1024 * 1024,
+                 ttl: float = 7 * 24 * 3600, negative_ttl: float = 15 * 60):
+        self.path = path
+        self.max_bytes = max(1024, max_bytes)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        if path != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS research (
+                key TEXT PRIMARY KEY,
+                query TEXT NOT NULL,
+                search_term TEXT NOT NULL,
+                url TEXT NOT NULL,
+                title TEXT NOT NULL,
+                text BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                negative INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_research_accessed ON research(accessed_at)")
+        self._conn.commit()
+        self.stats = {"hits": 0, "misses": 0, "negative_hits": 0, "stale": 0,
+                      "revalidated": 0, "evictions": 0, "bytes_read": 0, "bytes_written": 0}
+
+    def get(self, key: str):
+        """Retorna (dados, estado), com estado em "fresh", "stale" ou "miss".
+        Entradas "stale" trazem etag/last_modified para revalidação."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT query, search_term, url, title, text, size, fetched_at, etag, last_modified, negative "
+                "FROM research WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None, "miss"
+            query, search_term, url, title, blob, size, fetched_at, etag, last_modified, negative = row
+            age = time.time() - fetched_at
+            if negative:
+                if age > self.negative_ttl:
+                    self.stats["misses"] += 1
+                    return None, "miss"
+                self.stats["negative_hits"] += 1
+            elif age > self.ttl:
+                self.stats["stale"] += 1
+            else:
+                self.stats["hits"] += 1
+            self._conn.execute("UPDATE research SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.stats["bytes_read"] += size
+
+        data = {
+            "query": query,
+            "search_term": search_term,
+            "url": url,
+            "title": title,
+            "text": zlib.decompress(blob).decode("utf-8") if blob else "",
+            "etag": etag or "",
+            "last_modified": last_modified or "",
+        }
+        return data, ("stale" if not negative and age > self.ttl else "fresh")
+
+    def contains(self, key: str) -> bool:
+        """Se há entrada utilizável para key, sem contar nas estatísticas nem renovar o LRU."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT fetched_at, negative FROM research WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return False
+        fetched_at, negative = row
+        return not (negative and time.time() - fetched_at > self.negative_ttl)
+
+    def put(self, key: str, data: Dict[str, Any], etag: str = "", last_modified: str = ""):
+        text = data.get("text", "") or ""
+        blob = zlib.compress(text.encode("utf-8"), 6) if text else b""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO research "
+                "(key, query, search_term, url, title, text, size, fetched_at, accessed_at, etag, last_modified, negative) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, data.get("query", ""), data.get("search_term", ""), data.get("url", ""),
+                 data.get("title", ""), blob, len(blob), now, now, etag or None, last_modified or None,
+                 0 if text else 1),
+            )
+            self.stats["bytes_written"] += len(blob)
+            self._evict()
+            self._conn.commit()
+
+    def touch(self, key: str):
+        """Revalidação bem-sucedida (304): a entrada volta a ser considerada nova."""
+        with self._lock:
+            self._conn.execute("UPDATE research SET fetched_at = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.stats["revalidated"] += 1
+
+    def set_validators(self, key: str, etag: str, last_modified: str):
+        with self._lock:
+            self._conn.execute("UPDATE research SET etag = ?, last_modified = ? WHERE key = ?",
+                               (etag or None, last_modified or None, key))
+            self._conn.commit()
+
+    def _evict(self):
+        # Chamado com _lock
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM research").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._conn.execute("SELECT key, size FROM research ORDER BY accessed_at").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM research WHERE key = ?", (key,))
+            total -= size
+            self.stats["evictions"] += 1
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            entries, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM research"
+            ).fetchone()
+            stats = dict(self.stats)
+        lookups = stats["hits"] + stats["negative_hits"] + stats["stale"] + stats["misses"]
+        stats["entries"] = entries
+        stats["bytes"] = total
+        stats["max_bytes"] = self.max_bytes
+        stats["hit_rate"] = (stats["hits"] + stats["negative_hits"] + stats["revalidated"]) / lookups if lookups else 0.0
+        return stats
+
+
+def _clean_result_url(url: str) -> str:
+    """Resolve o redirecionamento do DuckDuckGo (parâmetro uddg) para a URL real."""
+    if "uddg=" not in url:
+        return url
+    qs = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+    return qs.get("uddg", [url])[0] or url
+
+
+# =========================
+# FONTES DE CONHECIMENTO
+# =========================
+WIKI_OFFLINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "wiki_offline")
+
+
+class KnowledgeSource(ABC):
+    """
+    Fonte que resolve um termo direto para um artigo, sem passar pela busca.
+    lookup() retorna {"title", "url", "text"} ou None quando não conhece o termo.
+    """
+
+    name = "fonte"
+
+    @abstractmethod
+    def lookup(self, query: str) -> Optional[Dict[str, str]]:
+        ...
+
+
+class _ParagraphParser(HTMLParser):
+    """Parser incremental: junta o texto de cada <p> e título de seção (h2/h3),
+    ignorando tabelas, figuras, estilos e as notas de referência."""
+
+    SKIP_TAGS = {"style", "script", "table", "figure", "sup", "math"}
 
     def __init__(self):
-        self.available = bool(PYBROWSER_AVAILABLE and TerminalSearchBrowser is not None)
-        self.browser = None
-        self.cache: Dict[str, Dict[str, str]] = {}
+        super().__init__(convert_charrefs=True)
+        self.blocks: List[Tuple[str, str]] = []
+        self._kind = None
+        self._buf: List[str] = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self._skip += 1
+        elif tag == "p":
+            self._kind, self._buf = "p", []
+        elif tag in ("h2", "h3"):
+            self._kind, self._buf = "h", []
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self._skip = max(0, self._skip - 1)
+        elif self._kind and tag in ("p", "h2", "h3"):
+            text = " ".join(re.sub(r"\[\d+\]", "", "".join(self._buf)).split())
+            if text:
+                self.blocks.append((self._kind, text))
+            self._kind = None
+
+    def handle_data(self, data):
+        if self._kind and not self._skip:
+            self._buf.append(data)
+
+
+def iter_html_paragraphs(chunks: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    """
+    Converte os pedaços de HTML, à medida que chegam, em blocos limpos:
+    ("h", título da seção) ou ("p", parágrafo). Quem consome pode parar a
+    qualquer momento; fechar o gerador encerra o download.
+    """
+    parser = _ParagraphParser()
+    for chunk in chunks:
+        if not chunk:
+            continue
+        parser.feed(chunk)
+        if parser.blocks:
+            blocks, parser.blocks = parser.blocks, []
+            yield from blocks
+    parser.close()
+    yield from parser.blocks
+
+
+class WikipediaRestSource(KnowledgeSource):
+    """Wikipédia pela API: opensearch para achar o título e extracts para o texto puro."""
+
+    name = "wikipedia"
+
+    def __init__(self, lang: str = "pt", timeout: float = 6.0):
+        self.lang = lang
+        self.timeout = timeout
+        self.api_url = f"https://{lang}.wikipedia.org/w/api.php"
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = "JARVIS/1.0 (assistente local)"
+
+    def _titles(self, query: str) -> List[str]:
+        """Títulos candidatos; o que bate com o termo normalizado vem primeiro."""
+        r = self.session.get(self.api_url, params={
+            "action": "opensearch", "search": query, "limit": 5, "namespace": 0, "format": "json",
+        }, timeout=self.timeout)
+        r.raise_for_status()
+        titles = r.json()[1]
+        wanted = _normalize_for_match(query)
+        return sorted(titles, key=lambda title: _normalize_for_match(title) != wanted)
+
+    def resolve_title(self, query: str) -> Optional[str]:
+        titles = self._titles(query)
+        return titles[0] if titles else None
+
+    def page_url(self, title: str) -> str:
+        return f"https://{self.lang}.wikipedia.org/wiki/" + urllib.parse.quote(title.replace(" ", "_"))
+
+    def stream_paragraphs(self, title: str) -> Iterator[Tuple[str, str]]:
+        """Blocos do artigo em HTML (API REST) conforme o download avança."""
+        url = f"https://{self.lang}.wikipedia.org/api/rest_v1/page/html/" + urllib.parse.quote(title.replace(" ", "_"), safe="")
+        with self.session.get(url, stream=True, timeout=self.timeout) as r:
+            r.raise_for_status()
+            r.encoding = "utf-8"
+            yield from iter_html_paragraphs(r.iter_content(chunk_size=8192, decode_unicode=True))
+
+    def lookup(self, query: str) -> Optional[Dict[str, str]]:
+        for title in self._titles(query)[:2]:
+            r = self.session.get(self.api_url, params={
+                "action": "query", "prop": "extracts|info|pageprops", "explaintext": 1,
+                "inprop": "url", "ppprop": "disambiguation", "redirects": 1,
+                "titles": title, "format": "json", "formatversion": 2,
+            }, timeout=self.timeout)
+            r.raise_for_status()
+            pages = r.json().get("query", {}).get("pages", [])
+            if not pages or pages[0].get("missing"):
+                continue
+            page = pages[0]
+            # Página de desambiguação não serve como contexto; tenta o próximo título
+            if "disambiguation" in page.get("pageprops", {}):
+                continue
+            text = page.get("extract", "")
+            if not text:
+                continue
+            url = page.get("fullurl") or self.page_url(page["title"])
+            return {"title": page["title"], "url": url, "text": text}
+        return None
+
+
+class OfflineWikiSource(KnowledgeSource):
+    """
+    Extrato local da Wikipédia gerado por build_offline_wiki_index: os textos ficam
+    concatenados em {base}.dat e o índice ordenado pelo título normalizado em
+    {base}.idx (uma linha "chave\toffset\ttamanho\ttítulo\turl"). Os dois arquivos
+    são mapeados em memória e a busca é binária, sem carregar o índice inteiro.
+    """
+
+    name = "offline"
+
+    def __init__(self, base_path: str = WIKI_OFFLINE_PATH):
+        self.data_path = base_path + ".dat"
+        self.idx_path = base_path + ".idx"
+        with open(self.data_path, "rb") as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(self.idx_path, "rb") as f:
+            self._idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def exists(base_path: str = WIKI_OFFLINE_PATH) -> bool:
+        return all(os.path.isfile(base_path + ext) and os.path.getsize(base_path + ext) > 0 for ext in (".dat", ".idx"))
+
+    def _line_at(self, pos: int):
+        """Linha completa que começa no primeiro início de linha a partir de pos."""
+        if pos > 0:
+            pos = self._idx.find(b"\n", pos - 1) + 1
+            if pos <= 0:
+                return None, len(self._idx)
+        end = self._idx.find(b"\n", pos)
+        if end < 0:
+            end = len(self._idx)
+        return self._idx[pos:end], end + 1
+
+    def _find(self, key: bytes) -> Optional[List[str]]:
+        lo, hi = 0, len(self._idx)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            line, _ = self._line_at(mid)
+            if line is None or line.split(b"\t", 1)[0] >= key:
+                hi = mid
+            else:
+                lo = mid + 1
+        line, _ = self._line_at(lo)
+        if line and line.split(b"\t", 1)[0] == key:
+            return line.decode("utf-8").split("\t")
+        return None
 
-        if self.available:
+    def lookup(self, query: str) -> Optional[Dict[str, str]]:
+        key = _normalize_for_match(query)
+        if not key:
+            return None
+        row = self._find(key.encode("ascii"))
+        if row is None:
+            return None
+        _key, offset, length, title, url = row
+        text = self._data[int(offset):int(offset) + int(length)].decode("utf-8", errors="replace")
+        return {"title": title, "url": url, "text": text}
+
+
+def _open_dump(path: str):
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rt", encoding="utf-8")
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+def build_offline_wiki_index(source: str, base_path: str = WIKI_OFFLINE_PATH) -> int:
+    """
+    Gera o extrato local a partir da saída JSON do WikiExtractor (um artigo por linha
+    com "title", "url" e "text"; aceita arquivo .bz2/.gz ou uma pasta com vários).
+    Títulos repetidos após a normalização ficam com o primeiro. Retorna o total de artigos.
+    """
+    if os.path.isdir(source):
+        files = sorted(
+            os.path.join(root, name)
+            for root, _dirs, names in os.walk(source)
+            for name in names
+        )
+    else:
+        files = [source]
+
+    entries = {}
+    offset = 0
+    with open(base_path + ".dat.tmp", "wb") as out:
+        for path in files:
+            print(f"[JARVIS][WIKI] Lendo {path}")
+            with _open_dump(path) as f:
+                for line in f:
+                    try:
+                        article = json.loads(line)
+                    except ValueError:
+                        continue
+                    title = " ".join(str(article.get("title", "")).split())
+                    key = _normalize_for_match(title)
+                    text = (article.get("text") or "").strip()
+                    if not key or not text or key in entries:
+                        continue
+                    raw = text[:BrowserKnowledgeProvider.MAX_ARTICLE_CHARS].encode("utf-8")
+                    out.write(raw)
+                    url = article.get("url") or "https://pt.wikipedia.org/wiki/" + urllib.parse.quote(title.replace(" ", "_"))
+                    entries[key] = (offset, len(raw), title, url)
+                    offset += len(raw)
+                    if len(entries) % 50000 == 0:
+                        print(f"[JARVIS][WIKI] {len(entries)} artigos...")
+
+    with open(base_path + ".idx.tmp", "w", encoding="utf-8", newline="\n") as idx:
+        for key in sorted(entries):
+            start, length, title, url = entries[key]
+            idx.write(f"{key}\t{start}\t{length}\t{title}\t{url}\n")
+    os.replace(base_path + ".dat.tmp", base_path + ".dat")
+    os.replace(base_path + ".idx.tmp", base_path + ".idx")
+    print(f"[JARVIS][WIKI] Extrato local pronto: {len(entries)} artigos ({offset / 1048576:.0f} MB)")
+    return len(entries)
+
+
+def build_knowledge_sources(spec: str) -> List[KnowledgeSource]:
+    """Fontes diretas na ordem de JARVIS_KNOWLEDGE_SOURCES ("offline", "wikipedia")."""
+    sources: List[KnowledgeSource] = []
+    for name in (part.strip().lower() for part in spec.split(",")):
+        try:
+            if name == "offline":
+                if OfflineWikiSource.exists():
+                    sources.append(OfflineWikiSource())
+            elif name == "wikipedia":
+                sources.append(WikipediaRestSource(timeout=float(os.getenv("JARVIS_WIKIPEDIA_TIMEOUT", "6"))))
+            elif name:
+                print(f"[PYbrowser] Fonte de conhecimento desconhecida: {name}")
+        except Exception as e:
+            print(f"[PYbrowser] Fonte '{name}' indisponível: {e}")
+    return sources
+
+
+class BrowserService:
+    """
+    Instância única do PYbrowser, compartilhada pelo provedor de conhecimento,
+    pelos addons e pelo research_with_context. Só é criada no primeiro uso,
+    para a inicialização não pagar por ela.
+    """
+
+    def __init__(self, max_results: int = 5):
+        self.max_results = max_results
+        self._browser = None
+        self._failed = not (PYBROWSER_AVAILABLE and TerminalSearchBrowser is not None)
+        self._lock = threading.Lock()
+        # A instância compartilhada atende uma chamada por vez
+        self._call_lock = threading.Lock()
+        # Extrações em paralelo usam uma instância por thread, com prazo por página
+        self._local = threading.local()
+        self.fetch_timeout = max(1.0, float(os.getenv("JARVIS_RESEARCH_FETCH_TIMEOUT", "10")))
+
+    @property
+    def available(self) -> bool:
+        return not self._failed
+
+    def get(self):
+        """O TerminalSearchBrowser, criado na primeira chamada; None se indisponível."""
+        if self._browser is not None or self._failed:
+            return self._browser
+        with self._lock:
+            if self._browser is None and not self._failed:
+                try:
+                    self._browser = TerminalSearchBrowser(max_results=self.max_results)
+                    print("[PYbrowser] Instância criada com sucesso.")
+                except Exception as e:
+                    print(f"[PYbrowser] Falha ao inicializar: {e}")
+                    self._failed = True
+        return self._browser
+
+    def worker_browser(self):
+        """Instância própria da thread atual, para extrações paralelas; None se indisponível."""
+        if self.get() is None:
+            return None
+        browser = getattr(self._local, "browser", None)
+        if browser is None:
             try:
-                self.browser = TerminalSearchBrowser(max_results=5)
-                print("[PYbrowser] Instância criada com sucesso.")
+                browser = TerminalSearchBrowser(max_results=self.max_results)
             except Exception as e:
-                print(f"[PYbrowser] Falha ao inicializar: {e}")
-                self.available = False
-                self.browser = None
+                print(f"[PYbrowser] Falha ao criar instância da thread: {e}")
+                return None
+            self._local.browser = browser
+        return browser
 
-    def _search(self, query: str) -> List:
+    def _export_with_timeout(self, browser, url: str) -> str:
+        """export_text numa thread auxiliar: uma página travada libera quem chamou
+        depois de fetch_timeout (FutureTimeoutError), em vez de prender a thread."""
+        future: Future = Future()
+
+        def run():
+            try:
+                future.set_result(browser.export_text(url))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, daemon=True, name="jarvis-export").start()
+        return future.result(timeout=self.fetch_timeout)
+
+    def search(self, query: str) -> List:
         """Realiza a busca usando o PYbrowser, com idioma pt-BR."""
-        if not self.browser:
+        browser = self.get()
+        if not browser:
             print("[PYbrowser] Browser não disponível para busca.")
             return []
 
         try:
             print(f"[PYbrowser] Buscando: {query}")
             # O PYbrowser aceita idioma como parâmetro; usamos pt-BR
-            results = self.browser.search(query, language="pt-BR")
+            with self._call_lock:
+                results = browser.search(query, language="pt-BR")
             if results:
                 print(f"[PYbrowser] Resultados obtidos: {len(results)}")
                 for i, r in enumerate(results):
@@ -753,60 +1685,260 @@ class BrowserKnowledgeProvider:
             traceback.print_exc()
             return []
 
-    def _extract_text(self, url: str) -> str:
-        if not self.browser:
+    def extract_text(self, url: str, worker: bool = False) -> str:
+        """Texto principal da página. Com worker=True usa a instância da thread atual
+        e desiste depois de fetch_timeout (para o pool de extração paralela)."""
+        browser = self.worker_browser() if worker else self.get()
+        if not browser:
             return ""
 
+        def export(target: str) -> str:
+            if worker:
+                return self._export_with_timeout(browser, target)
+            with self._call_lock:
+                return browser.export_text(target)
+
         try:
             print(f"[PYbrowser] Extraindo texto de: {url}")
-            text = self.browser.export_text(url)
+            text = export(url)
 
             # se o texto vier vazio, tenta inferir a URL limpa da Wikipédia a partir do termo
             if not text and "uddg=" in url:
-                import urllib.parse
-                parsed = urllib.parse.urlparse(url)
-                qs = urllib.parse.parse_qs(parsed.query)
-                uddg = qs.get("uddg", [""])[0]
-                if uddg and "wikipedia.org" in uddg:
-                    clean_url = uddg  # URL real já está no parâmetro uddg
+                clean_url = _clean_result_url(url)  # URL real já está no parâmetro uddg
+                if clean_url != url and "wikipedia.org" in clean_url:
                     print(f"[PYbrowser] Tentando URL limpa: {clean_url}")
-                    text = self.browser.export_text(clean_url)
+                    text = export(clean_url)
 
             if not text:
                 print("[PYbrowser] export_text retornou string vazia.")
             else:
                 print(f"[PYbrowser] Texto extraído: {len(text)} caracteres")
             return text
+        except FutureTimeoutError:
+            print(f"[PYbrowser] Tempo esgotado ({self.fetch_timeout:.0f} s) ao extrair: {url}")
+            # A instância continua presa à requisição antiga; a próxima extração cria outra
+            self._local.browser = None
+            return ""
         except Exception as e:
             print(f"[PYbrowser] Erro ao extrair texto: {e}")
             import traceback
             traceback.print_exc()
             return ""
 
-    def find_wikipedia_context(self, query: str, max_chars: int = 8000) -> Dict[str, str]:
+
+_browser_service: Optional[BrowserService] = None
+_browser_service_lock = threading.Lock()
+
+
+def get_browser_service() -> BrowserService:
+    """Serviço de navegador compartilhado pelo processo."""
+    global _browser_service
+    with _browser_service_lock:
+        if _browser_service is None:
+            _browser_service = BrowserService(max_results=5)
+        return _browser_service
+
+
+class BrowserKnowledgeProvider:
+    """Integra o PYbrowser para buscar contexto textual na Wikipédia."""
+
+    MAX_ARTICLE_CHARS = 200_000
+    # Texto mínimo para uma página da Wikipédia encerrar a espera pelos demais candidatos
+    GOOD_RESULT_CHARS = 500
+    # Intervalo entre as verificações de cancelamento de quem espera outra pesquisa
+    FLIGHT_POLL_S = 0.25
+
+    def __init__(self, embedder=None, embedder_name: str = "hash-1024"):
+        # Navegador compartilhado e criado só quando a busca na web for necessária
+        self.browser_service = get_browser_service()
+        # Orçamento do contexto enviado ao modelo (tokens estimados -> caracteres)
+        self.context_chars = int(os.getenv("JARVIS_RESEARCH_CONTEXT_TOKENS", "1200")) * 4
+
+        # Candidatos extraídos em paralelo e prazo total para escolher um deles
+        self.research_fanout = max(1, int(os.getenv("JARVIS_RESEARCH_FANOUT", "3")))
+        self.research_budget = max(0.5, float(os.getenv("JARVIS_RESEARCH_BUDGET_MS", "6000")) / 1000.0)
+        self.research_backfill = os.getenv("JARVIS_RESEARCH_BACKFILL", "1").strip().lower() not in ("0", "false", "nao", "não", "no")
+        self._fetch_pool = ThreadPoolExecutor(max_workers=self.research_fanout * 2, thread_name_prefix="jarvis-research")
+        self.research_stats = {"lookups": 0, "fetches": 0, "late": 0, "backfilled": 0, "total_ms": 0.0}
+
+        # Fontes que resolvem o termo direto, consultadas antes da busca na web
+        self.sources = build_knowledge_sources(os.getenv("JARVIS_KNOWLEDGE_SOURCES", "offline,wikipedia"))
+        self.source_stats = {
+            source.name: {"hits": 0, "misses": 0, "errors": 0, "total_ms": 0.0} for source in self.sources
+        }
+        # Leitura do artigo em streaming, parando quando o contexto já basta
+        self.stream_extraction = os.getenv("JARVIS_STREAM_EXTRACTION", "1").strip().lower() not in ("0", "false", "nao", "não", "no")
+        self.stream_stats = {"streams": 0, "early_stops": 0, "intro_only": 0, "chars_read": 0, "completed_later": 0}
+
+        # Single-flight: pesquisas iguais ao mesmo tempo compartilham uma só busca
+        self._flights: Dict[str, Future] = {}
+        self._flights_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.coalesce_stats = {"lookups": 0, "coalesced": 0}
+
+        # Índice vetorial local das páginas já pesquisadas, consultado antes da web
+        self.index: Optional[VectorIndex] = None
+        self.index_threshold = float(os.getenv("JARVIS_INDEX_THRESHOLD", "0.35"))
+        if NUMPY_AVAILABLE and os.getenv("JARVIS_RESEARCH_INDEX", "1").strip().lower() not in ("0", "false", "nao", "não", "no"):
+            try:
+                self.index = VectorIndex(embedder=embedder, embedder_name=embedder_name)
+            except Exception as e:
+                print(f"[JARVIS][ÍNDICE] Índice local indisponível: {e}")
+
+        # Cache persistente; com JARVIS_RESEARCH_CACHE=0 fica só em memória (perdido ao sair)
+        cache_enabled = os.getenv("JARVIS_RESEARCH_CACHE", "1").strip().lower() not in ("0", "false", "nao", "não", "no")
+        cache_path = RESEARCH_CACHE_PATH if cache_enabled else ":memory:"
+        cache_args = dict(
+            max_bytes=int(float(os.getenv("JARVIS_RESEARCH_CACHE_MB", "64")) * 1024 * 1024),
+            ttl=float(os.getenv("JARVIS_RESEARCH_CACHE_TTL", str(7 * 24 * 3600))),
+            negative_ttl=float(os.getenv("JARVIS_RESEARCH_NEGATIVE_TTL", "900")),
+        )
+        try:
+            self.cache = ResearchCache(cache_path, **cache_args)
+        except Exception as e:
+            print(f"[PYbrowser] Cache em disco indisponível, usando memória: {e}")
+            self.cache = ResearchCache(":memory:", **cache_args)
+
+    @property
+    def available(self) -> bool:
+        return self.browser_service.available
+
+    @property
+    def browser(self):
+        return self.browser_service.get()
+
+    def _search(self, query: str) -> List:
+        return self.browser_service.search(query)
+
+    def _extract_text(self, url: str, worker: bool = False) -> str:
+        return self.browser_service.extract_text(url, worker=worker)
+
+    def get_article(self, query: str) -> Dict[str, Any]:
+        """Artigo completo para o termo (cache, fontes diretas ou busca), sem recorte de trechos.
+        Nunca para a leitura no meio: o artigo inteiro vai para o cache."""
+        return self._lookup(query, full=True)
+
+    def find_wikipedia_context(self, query: str, max_chars: Optional[int] = None, question: str = "",
+                               cancel_event: Optional[threading.Event] = None) -> Dict[str, str]:
         """
         Busca por "{termo} wikipedia", abre o primeiro resultado e extrai texto.
-        Retorna um dicionário com texto bruto, url e termo usado.
+        O artigo completo fica no cache; o texto devolvido traz só os trechos mais
+        relevantes para a pergunta (mais a introdução), dentro de max_chars.
+        Retorna um dicionário com o texto, url e termo usado. cancel_event (do job
+        da IA) libera a espera por uma pesquisa igual já em andamento.
+        """
+        if max_chars is None:
+            max_chars = self.context_chars
+        local = self._index_context(f"{query} {question}".strip(), max_chars)
+        if local is not None:
+            return local
+
+        data = self._lookup(query, question, max_chars, cancel_event)
+        if data.get("text") and self.index is not None and data.get("url") and data.get("complete", True):
+            self._index_async(data["url"], data.get("title", ""), data["text"])
+        if data.get("text"):
+            full_len = len(data["text"])
+            data = dict(data, text=select_relevant_chunks(data["text"], f"{query} {question}", max_chars))
+            if len(data["text"]) < full_len:
+                print(f"[PYbrowser] Contexto: {len(data['text'])} de {full_len} caracteres (trechos relevantes)")
+        return data
+
+    def _count(self, stats: Dict[str, Any], key: str, amount=1):
+        """Incrementa um contador de estatística; as pesquisas rodam em várias threads."""
+        with self._stats_lock:
+            stats[key] += amount
+
+    def _lookup(self, query: str, question: str = "", max_chars: Optional[int] = None,
+                cancel_event: Optional[threading.Event] = None, full: bool = False) -> Dict[str, Any]:
         """
+        Artigo para o termo, com chamadas concorrentes coalescidas: quem chega
+        enquanto a mesma pesquisa está em andamento espera o resultado dela em vez
+        de repetir busca e download. A chave inclui os termos próprios da pergunta,
+        já que a leitura em streaming depende deles. Se cancel_event for marcado
+        durante a espera, volta sem texto (a pesquisa original segue até o fim).
+        Com full=True o artigo é lido inteiro, sem streaming.
+        """
+        specific = sorted(set(_search_tokens(question)) - set(_search_tokens(query)))
+        key = _normalize_for_match(query) + "|" + ("*" if full else " ".join(specific))
+        with self._flights_lock:
+            self.coalesce_stats["lookups"] += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Future()
+            else:
+                self.coalesce_stats["coalesced"] += 1
+        if not leader:
+            print(f"[PYbrowser] Pesquisa já em andamento para '{query.strip()}', aguardando o resultado.")
+            while True:
+                if cancel_event is not None and cancel_event.is_set():
+                    print(f"[PYbrowser] Espera pela pesquisa de '{query.strip()}' cancelada.")
+                    return {
+                        "query": query.strip(),
+                        "search_term": "",
+                        "url": "",
+                        "text": "",
+                        "title": "",
+                        "cached": False,
+                    }
+                try:
+                    return dict(flight.result(timeout=self.FLIGHT_POLL_S))
+                except FutureTimeoutError:
+                    continue
+
+        try:
+            data = self._lookup_once(query, question, max_chars, full)
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        else:
+            flight.set_result(data)
+            return dict(data)
+        finally:
+            with self._flights_lock:
+                self._flights.pop(key, None)
+
+    def _lookup_once(self, query: str, question: str = "", max_chars: Optional[int] = None,
+                     full: bool = False) -> Dict[str, Any]:
+        """Artigo completo para o termo, do cache ou da web (ou só o necessário
+        para a pergunta, quando lido em streaming; aí "complete" vem False)."""
         normalized = query.strip()
         cache_key = _normalize_for_match(normalized)
 
-        if cache_key in self.cache:
-            cached = self.cache[cache_key]
+        cached, state = self.cache.get(cache_key)
+        if cached is not None and state == "stale" and self._revalidate(cached):
+            self.cache.touch(cache_key)
+            state = "fresh"
+        if cached is not None and state == "fresh":
             print(f"[PYbrowser] Cache hit para: {normalized}")
-            return {
-                "query": normalized,
-                "search_term": cached.get("search_term", normalized),
-                "url": cached.get("url", ""),
-                "text": cached.get("text", ""),
-                "title": cached.get("title", ""),
-                "cached": True,
-            }
+            return self._cached_result(normalized, cached)
+        # Entrada vencida: vale como reserva se a nova busca falhar
+        stale = cached if state == "stale" else None
+
+        def store(article: Dict[str, Any]):
+            self.cache.put(cache_key, article)
+            self._fetch_validators_async(cache_key, article["url"])
+
+        def store_completed(article: Dict[str, Any]):
+            # Resto do artigo lido em background depois de uma leitura parcial
+            store(article)
+            if self.index is not None:
+                self._index_async(article["url"], article.get("title", ""), article["text"])
+
+        direct = self._lookup_sources(normalized, question, max_chars or self.context_chars, store_completed,
+                                      stream=not full)
+        if direct is not None:
+            # Leitura parcial só vai para o cache quando o download terminar em background
+            if direct.get("complete", True):
+                store(direct)
+            return direct
 
         search_term = f"{normalized} wikipedia"
         results = self._search(search_term)
 
         if not results:
+            if stale is not None:
+                return self._cached_result(normalized, stale)
             data = {
                 "query": normalized,
                 "search_term": search_term,
@@ -815,34 +1947,18 @@ class BrowserKnowledgeProvider:
                 "title": "",
                 "cached": False,
             }
-            self.cache[cache_key] = data
+            self.cache.put(cache_key, data)
             return data
 
-        # Prioriza resultado com 'wikipedia' na URL ou título
-        chosen = None
-        for item in results:
-            if "wikipedia" in item.url.lower() or "wikipedia" in item.title.lower():
-                chosen = item
-                print(f"[PYbrowser] Selecionado Wikipedia: {item.url}")
-                break
-
-        if chosen is None:
-            print("[PYbrowser] Nenhum resultado Wikipedia exato, usando primeiro.")
-            chosen = results[0]
-
+        # Abre os melhores candidatos em paralelo e fica com o melhor que chegar no prazo
+        chosen, text_value = self._fetch_best(normalized, results)
         url = chosen.url
         title = chosen.title
-        text_value = self._extract_text(url)
 
-        if text_value:
-            # Limpeza básica: reduz quebras excessivas
-            text_value = re.sub(r"\n{3,}", "\n\n", text_value).strip()
-            # Trunca se necessário
-            if len(text_value) > max_chars:
-                text_value = text_value[:max_chars].rsplit(" ", 1)[0].strip()
-                print(f"[PYbrowser] Texto truncado para {max_chars} caracteres")
-        else:
+        if not text_value:
             print("[PYbrowser] Texto extraído vazio.")
+            if stale is not None:
+                return self._cached_result(normalized, stale)
 
         data = {
             "query": normalized,
@@ -852,184 +1968,2133 @@ class BrowserKnowledgeProvider:
             "title": title,
             "cached": False,
         }
-        self.cache[cache_key] = data
+        self.cache.put(cache_key, data)
+        if text_value:
+            self._fetch_validators_async(cache_key, url)
         return data
 
+    def _lookup_sources(self, query: str, question: str = "", max_chars: int = 0,
+                        on_complete=None, stream: bool = True) -> Optional[Dict[str, Any]]:
+        """Primeira fonte direta que conhece o termo; None para cair na busca.
+        Se a leitura for parcial, on_complete recebe o artigo inteiro quando o
+        download terminar em background. stream=False baixa o texto inteiro."""
+        def result(source, found: Dict[str, Any], text: str) -> Dict[str, Any]:
+            return {
+                "query": query,
+                "search_term": f"{source.name}:{found['title']}",
+                "url": found["url"],
+                "text": text,
+                "title": found["title"],
+                "cached": False,
+                "complete": found.get("complete", True),
+            }
+
+        for source in self.sources:
+            stats = self.source_stats[source.name]
+            started = time.monotonic()
+            finish = None
+            if on_complete is not None:
+                def finish(found, source=source):
+                    text = self._clean_article(found["text"])
+                    if text:
+                        on_complete(result(source, found, text))
+            try:
+                if stream and self.stream_extraction and hasattr(source, "stream_paragraphs"):
+                    found = self._read_streamed(source, query, question, max_chars, finish)
+                else:
+                    found = source.lookup(query)
+            except Exception as e:
+                self._count(stats, "errors")
+                print(f"[PYbrowser] Fonte {source.name} falhou: {e}")
+                continue
+            finally:
+                self._count(stats, "total_ms", (time.monotonic() - started) * 1000.0)
+            text = self._clean_article(found["text"]) if found else ""
+            if not text:
+                self._count(stats, "misses")
+                continue
+            self._count(stats, "hits")
+            print(f"[PYbrowser] Fonte {source.name}: {found['title']} ({len(text)} caracteres)")
+            return result(source, found, text)
+        return None
+
+    def _read_streamed(self, source, query: str, question: str, max_chars: int,
+                       on_complete=None) -> Optional[Dict[str, Any]]:
+        """
+        Lê o artigo parágrafo a parágrafo enquanto ele baixa. A introdução sempre
+        entra; para perguntas de resumo ("quem foi X") a leitura para no primeiro
+        título de seção. Nas demais, os parágrafos que citam termos da pergunta
+        contam para o orçamento e a leitura para quando ele enche.
+
+        A resposta do modelo só começa depois desta leitura (o contexto vai inteiro
+        no prompt); o ganho é não esperar o resto do artigo. Com on_complete, o
+        restante continua baixando em background e on_complete recebe o artigo
+        inteiro ("complete" True) para o cache; sem ele, o download é interrompido.
+        """
+        title = source.resolve_title(query)
+        if not title:
+            return None
+        specific = set(_search_tokens(question)) - set(_search_tokens(query))
+        parts: List[str] = []
+        budget_used = 0
+        in_intro = True
+        complete = True
+        # Bloco já lido que não entrou no contexto (o título que encerrou a introdução)
+        held: List[str] = []
+        blocks = source.stream_paragraphs(title)
+        try:
+            for kind, text in blocks:
+                if kind == "h":
+                    if in_intro and parts and not specific:
+                        self._count(self.stream_stats, "intro_only")
+                        complete = False
+                        held.append(f"== {text} ==")
+                        break
+                    in_intro = False
+                    parts.append(f"== {text} ==")
+                    continue
+                if not parts and "pode referir-se a" in text:
+                    # Desambiguação: a busca completa por extracts sabe pular esses casos
+                    blocks.close()
+                    return source.lookup(query)
+                parts.append(text)
+                self._count(self.stream_stats, "chars_read", len(text))
+                if in_intro or (specific & set(_search_tokens(text))):
+                    budget_used += len(text)
+                if budget_used >= max_chars or budget_used >= self.MAX_ARTICLE_CHARS:
+                    complete = False
+                    break
+        except BaseException:
+            blocks.close()
+            raise
+        background = not complete and bool(parts) and on_complete is not None
+        if not background:
+            blocks.close()
+        self._count(self.stream_stats, "streams")
+        if not complete:
+            self._count(self.stream_stats, "early_stops")
+            print(f"[PYbrowser] Leitura interrompida em {sum(len(p) for p in parts)} caracteres: contexto suficiente")
+        if not parts:
+            return None
+        url = source.page_url(title)
+        if background:
+            self._finish_read_async(blocks, parts + held, title, url, on_complete)
+        return {"title": title, "url": url, "text": "\n\n".join(parts), "complete": complete}
+
+    def _finish_read_async(self, blocks, parts: List[str], title: str, url: str, on_complete):
+        """Continua em background o download de um artigo lido em parte."""
+        def _run():
+            total = sum(len(p) for p in parts)
+            try:
+                for kind, text in blocks:
+                    parts.append(f"== {text} ==" if kind == "h" else text)
+                    total += len(parts[-1])
+                    if total >= self.MAX_ARTICLE_CHARS:
+                        break
+            except Exception as e:
+                print(f"[PYbrowser] Falha ao terminar a leitura de {title}: {e}")
+                return
+            finally:
+                blocks.close()
+            self._count(self.stream_stats, "completed_later")
+            print(f"[PYbrowser] Artigo completo em background: {title} ({total} caracteres)")
+            try:
+                on_complete({"title": title, "url": url, "text": "\n\n".join(parts), "complete": True})
+            except Exception as e:
+                print(f"[PYbrowser] Falha ao guardar o artigo completo de {title}: {e}")
+        threading.Thread(target=_run, daemon=True).start()
+
+    @staticmethod
+    def _is_wikipedia(item) -> bool:
+        return "wikipedia" in item.url.lower() or "wikipedia" in item.title.lower()
+
+    def _clean_article(self, text: str) -> str:
+        """Limpeza básica (quebras excessivas) e teto do artigo guardado no cache."""
+        text = re.sub(r"\n{3,}", "\n\n", text or "").strip()
+        if len(text) > self.MAX_ARTICLE_CHARS:
+            text = text[:self.MAX_ARTICLE_CHARS].rsplit(" ", 1)[0].strip()
+        return text
+
+    def _score_candidate(self, query: str, item, text: str, rank: int) -> float:
+        """Nota de um candidato já extraído: Wikipédia primeiro, depois termos da
+        consulta presentes no título/introdução e a posição original na busca."""
+        if not text:
+            return float("-inf")
+        score = 2.0 if self._is_wikipedia(item) else 0.0
+        terms = set(_search_tokens(query))
+        if terms:
+            found = set(_search_tokens(f"{item.title} {text[:2000]}"))
+            score += len(terms & found) / len(terms)
+        if len(text) < self.GOOD_RESULT_CHARS:
+            score -= 1.0
+        return score - 0.1 * rank
+
+    def _fetch_best(self, query: str, results: List):
+        """
+        Extrai até research_fanout candidatos em paralelo, com prazo por fonte, e
+        classifica cada um assim que termina. Uma página da Wikipédia com texto
+        suficiente encerra a espera na hora; senão vale o melhor disponível quando
+        o orçamento de latência acaba. Os que chegam depois só preenchem o cache.
+        Retorna (resultado escolhido, texto limpo).
+        """
+        # Wikipédia na frente, mantendo a ordem da busca entre iguais
+        ordered = sorted(results, key=lambda item: not self._is_wikipedia(item))
+        candidates = ordered[:max(1, self.research_fanout)]
+        started = time.monotonic()
+        budget_end = started + self.research_budget
+        self._count(self.research_stats, "lookups")
+        self._count(self.research_stats, "fetches", len(candidates))
+
+        futures = {}
+        for rank, item in enumerate(candidates):
+            # Fora da Wikipédia o prazo é menor: uma página lenta não segura a resposta
+            deadline = budget_end if self._is_wikipedia(item) else started + self.research_budget * 0.6
+            futures[self._fetch_pool.submit(self._extract_text, item.url, True)] = (rank, item, deadline)
+
+        best = None  # (nota, item, texto)
+        pending = set(futures)
+        while pending:
+            now = time.monotonic()
+            waiting = [f for f in pending if futures[f][2] > now]
+            if not waiting:
+                break
+            remaining = min(futures[f][2] for f in waiting) - now
+            done, _ = wait(waiting, timeout=remaining, return_when=FIRST_COMPLETED)
+            finished_at = time.monotonic()
+            for fut in done:
+                pending.discard(fut)
+                rank, item, deadline = futures[fut]
+                text = self._clean_article(fut.result()) if fut.exception() is None else ""
+                if finished_at > deadline:
+                    self._backfill(item, text)
+                    continue
+                score = self._score_candidate(query, item, text, rank)
+                if best is None or score > best[0]:
+                    if best is not None:
+                        self._backfill(best[1], best[2])
+                    best = (score, item, text)
+                else:
+                    self._backfill(item, text)
+            if best is not None and best[2] and self._is_wikipedia(best[1]) and len(best[2]) >= self.GOOD_RESULT_CHARS:
+                break
+
+        elapsed_ms = (time.monotonic() - started) * 1000.0
+        self._count(self.research_stats, "total_ms", elapsed_ms)
+        if pending:
+            self._count(self.research_stats, "late", len(pending))
+            for fut in pending:
+                _rank, item, _deadline = futures[fut]
+                fut.add_done_callback(
+                    lambda f, item=item: self._backfill(item, self._clean_article(f.result()) if f.exception() is None else "")
+                )
+
+        if best is None or not best[2]:
+            print(f"[PYbrowser] Nenhum candidato com texto em {elapsed_ms:.0f} ms.")
+            return candidates[0], ""
+        print(f"[PYbrowser] Selecionado ({elapsed_ms:.0f} ms, {len(pending)} ainda baixando): {best[1].url}")
+        return best[1], best[2]
+
+    def _backfill(self, item, text: str):
+        """Guarda no cache (pelo título da página) e no índice um candidato que não foi usado."""
+        if not self.research_backfill or not text:
+            return
+        title = re.split(r"\s[-–—|]\s", item.title)[0].strip()
+        key = _normalize_for_match(title)
+        if not key:
+            return
+        try:
+            if not self.cache.contains(key):
+                self.cache.put(key, {
+                    "query": title,
+                    "search_term": "",
+                    "url": item.url,
+                    "text": text,
+                    "title": item.title,
+                    "cached": False,
+                })
+                self._count(self.research_stats, "backfilled")
+            if self.index is not None:
+                self._index_async(item.url, item.title, text)
+        except Exception as e:
+            print(f"[PYbrowser] Falha ao guardar candidato {item.url}: {e}")
+
+    def get_research_stats(self) -> Dict[str, float]:
+        with self._stats_lock:
+            stats = dict(self.research_stats)
+        stats["avg_ms"] = stats["total_ms"] / stats["lookups"] if stats["lookups"] else 0.0
+        return stats
+
+    def _index_async(self, url: str, title: str, text: str):
+        if self.index.has_url(url):
+            return
+
+        def _run():
+            try:
+                self.index.add_document(url, title, text)
+            except Exception as e:
+                print(f"[JARVIS][ÍNDICE] Falha ao indexar {url}: {e}")
+        threading.Thread(target=_run, daemon=True).start()
+
+    def _index_context(self, question: str, max_chars: int) -> Optional[Dict[str, Any]]:
+        """
+        Responde pelo índice local quando o trecho mais próximo passa do limiar de
+        similaridade: monta o contexto com a introdução e os trechos próximos da
+        melhor página, sem tocar na rede. None se o corpus local não basta.
+        """
+        if self.index is None:
+            return None
+        try:
+            hits = self.index.search(question)
+        except Exception as e:
+            print(f"[JARVIS][ÍNDICE] Falha na consulta: {e}")
+            return None
+        if not hits or hits[0][0] < self.index_threshold:
+            self.index.record_query(False)
+            if hits:
+                print(f"[JARVIS][ÍNDICE] Melhor similaridade {hits[0][0]:.2f} abaixo do limiar {self.index_threshold:.2f}")
+            return None
+        self.index.record_query(True)
+
+        best = hits[0][1]
+        chunks = self.index.document_chunks(best["url"])
+        chosen = {0}
+        used = len(chunks[0]["text"]) if chunks else 0
+        for score, row in hits:
+            if row["url"] != best["url"] or score < self.index_threshold * 0.75 or row["pos"] in chosen:
+                continue
+            if used + len(row["text"]) + 7 > max_chars:
+                continue
+            chosen.add(row["pos"])
+            used += len(row["text"]) + 7
+
+        parts = []
+        previous = -1
+        for pos in sorted(chosen):
+            if pos >= len(chunks):
+                continue
+            if parts and pos != previous + 1:
+                parts.append("[...]")
+            parts.append(chunks[pos]["text"])
+            previous = pos
+        text = "\n\n".join(parts)[:max_chars]
+        print(f"[JARVIS][ÍNDICE] Contexto local ({hits[0][0]:.2f}) de: {best['url']}")
+        return {
+            "query": question,
+            "search_term": "",
+            "url": best["url"],
+            "text": text,
+            "title": best.get("title", ""),
+            "cached": True,
+            "source": "index",
+        }
+
+    @staticmethod
+    def _cached_result(normalized: str, cached: Dict[str, str]) -> Dict[str, Any]:
+        return {
+            "query": normalized,
+            "search_term": cached.get("search_term", normalized),
+            "url": cached.get("url", ""),
+            "text": cached.get("text", ""),
+            "title": cached.get("title", ""),
+            "cached": True,
+        }
+
+    def _fetch_validators_async(self, cache_key: str, url: str):
+        """Guarda ETag/Last-Modified da página em background, para revalidar quando vencer."""
+        def _run():
+            try:
+                r = requests.head(_clean_result_url(url), timeout=5, allow_redirects=True)
+                etag = r.headers.get("ETag", "")
+                last_modified = r.headers.get("Last-Modified", "")
+                if etag or last_modified:
+                    self.cache.set_validators(cache_key, etag, last_modified)
+            except Exception as e:
+                print(f"[PYbrowser] Falha ao obter validadores de {url}: {e}")
+        threading.Thread(target=_run, daemon=True).start()
+
+    def _revalidate(self, cached: Dict[str, str]) -> bool:
+        """GET condicional para uma entrada vencida; True se a página não mudou (304)."""
+        if not cached.get("url") or not (cached.get("etag") or cached.get("last_modified")):
+            return False
+        headers = {}
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+        try:
+            with requests.get(_clean_result_url(cached["url"]), headers=headers, timeout=5, stream=True) as r:
+                unchanged = r.status_code == 304
+            print(f"[PYbrowser] Revalidação de {cached['url']}: {'sem alterações' if unchanged else r.status_code}")
+            return unchanged
+        except Exception as e:
+            print(f"[PYbrowser] Falha na revalidação: {e}")
+            return False
+
     def has_context(self) -> bool:
-        return self.available and self.browser is not None
+        # Sem fontes diretas, depende do PYbrowser: tenta criá-lo para saber se funciona
+        return bool(self.sources) or self.browser_service.get() is not None
+
+# =========================
+# CLASSIFICADOR LOCAL DE INTENÇÕES
+# =========================
+class IntentClassifier:
+    """
+    Classificador local (regras + pontuação) que resolve intenções óbvias
+    ("abre o chrome", "pesquisa X no youtube", "quanto é 2+2") no mesmo formato
+    do plano do LLM, sem chamar o modelo. Abaixo do limiar, devolve None e o
+    planejador do LLM decide.
+    """
+
+    OPEN_VERBS = ("abrir", "abra", "abre", "abri", "executar", "execute", "executa", "iniciar", "inicie", "inicia")
+    SEARCH_VERBS = ("pesquisar", "pesquise", "pesquisa", "procurar", "procure", "procura", "buscar", "busque", "busca")
+    PLAY_VERBS = ("tocar", "toque", "toca", "colocar", "coloque", "coloca", "bota", "bote", "reproduzir", "reproduza")
+    TYPE_VERBS = ("digitar", "digite", "digita")
+    YOUTUBE_WORDS = ("youtube", "yt")
+    YTVIDEO_WORDS = ("ytvideo", "ytv", "vídeo", "video")
+    CLEAR_PHRASES = {
+        "limpar", "limpa", "limpe", "cls",
+        "limpar chat", "limpa o chat", "limpe o chat", "limpar o chat",
+        "limpar conversa", "limpa a conversa", "limpe a conversa", "limpar a conversa",
+        "limpar tela", "limpa a tela", "limpe a tela", "limpar a tela",
+    }
+    MATH_PREFIXES = ("quanto é", "quanto e", "quanto dá", "quanto da", "quanto fica", "calcule", "calcula", "calcular", "resolva")
+    QUESTION_WORDS = ("como", "por que", "porque", "o que", "qual", "quais", "quando", "onde", "quem")
+    ARTICLES = ("o", "a", "os", "as", "um", "uma", "meu", "minha", "o app", "o programa", "o aplicativo", "o site")
+
+    MATH_WORDS = (
+        (r"\bvezes\b", "*"),
+        (r"\bmultiplicado por\b", "*"),
+        (r"\bdividido por\b", "/"),
+        (r"\bmais\b", "+"),
+        (r"\bmenos\b", "-"),
+        (r"(?<=\d)\s*x\s*(?=\d)", "*"),
+        (r"(?<=\d)\s*\^\s*(?=\d)", "**"),
+    )
+
+    def __init__(self, threshold: float = 0.8, target_lookup=None):
+        self.threshold = threshold
+        # Função alvo -> bool que diz se há app/atalho conhecido com esse nome
+        # (ligada ao CommandRouter); sem ela, "abrir X" fica para o LLM
+        self.target_lookup = target_lookup
+        self._lock = threading.Lock()
+        self.stats = {
+            "total": 0,
+            "hits": 0,
+            "misses": 0,
+            "hit_confidence_sum": 0.0,
+            "miss_confidence_sum": 0.0,
+            "by_action": {},
+        }
+
+    # ---------- helpers ----------
+    @staticmethod
+    def _verb_pattern(verbs) -> str:
+        return "(?:" + "|".join(re.escape(v) for v in sorted(verbs, key=len, reverse=True)) + ")"
+
+    def _strip_article(self, value: str) -> str:
+        value = value.strip()
+        for article in sorted(self.ARTICLES, key=len, reverse=True):
+            prefix = article + " "
+            if value.lower().startswith(prefix) and len(value) > len(prefix):
+                return value[len(prefix):].strip()
+        return value
+
+    def _is_compound(self, lower: str) -> bool:
+        """Pedidos encadeados ("abre o chrome e pesquisa X") ficam para o LLM."""
+        verbs = self.OPEN_VERBS + self.SEARCH_VERBS + self.TYPE_VERBS + self.PLAY_VERBS
+        return re.search(r"\s(?:e|depois|então)\s+" + self._verb_pattern(verbs) + r"\b", lower) is not None
+
+    def _score(self, lower: str, argument: str, base: float = 0.6) -> float:
+        score = base
+        if argument:
+            score += 0.25
+        if len(argument.split()) <= 6:
+            score += 0.1
+        if self._is_compound(lower):
+            score -= 0.4
+        if "?" in lower:
+            score -= 0.2
+        if len(lower.split()) > 12:
+            score -= 0.2
+        return max(0.0, min(1.0, score))
+
+    def _plan(self, action: str, **fields) -> dict:
+        plan = {"action": action, "target": "", "query": "", "text": "", "context_query": ""}
+        plan.update(fields)
+        return plan
+
+    def _math_expression(self, value: str, prefixed: bool = False) -> str:
+        """
+        Expressão aritmética do texto, ou "" se não for uma. Sem prefixo ("quanto é",
+        "calcule"), só vale com operador inequívoco: "25/12" (data) e "10-15"
+        (intervalo) ficam para o LLM. Números com separador de milhar ("1.000,50")
+        são recusados, já que o avaliador não os entende.
+        """
+        source = value.strip().rstrip("?!. ")
+        expr = source
+        for pattern, repl in self.MATH_WORDS:
+            expr = re.sub(pattern, repl, expr, flags=re.IGNORECASE)
+        # "10 menos 3", "3 x 4": operador escrito por extenso também é inequívoco
+        worded = expr != source
+        expr = expr.strip()
+        if not re.fullmatch(r"[\d\s.,+\-*/()%]+", expr):
+            return ""
+        if not re.search(r"\d", expr) or not re.search(r"\d\s*(?:\*\*|[+\-*/%])\s*[\d(]", expr):
+            return ""
+        for number in re.findall(r"\d[\d.,]*", expr):
+            number = number.rstrip(".,")
+            if ("." in number and "," in number) or number.count(".") > 1 or re.search(r"\d\.\d{3}$", number):
+                return ""
+        if not prefixed and not worded and not re.search(r"[+*%()]", expr):
+            return ""
+        return expr
+
+    # ---------- classificação ----------
+    def _classify(self, text: str):
+        original = text.strip()
+        lower = original.lower().rstrip(".!")
+        if not lower:
+            return None, 0.0
+
+        if lower in self.CLEAR_PHRASES:
+            return self._plan("clear"), 0.98
+
+        # Matemática: "quanto é 2+2", "calcule 3 vezes 4" ou a expressão pura
+        expr_source = original
+        prefixed = False
+        for prefix in self.MATH_PREFIXES:
+            if lower.startswith(prefix + " "):
+                expr_source = original[len(prefix):]
+                prefixed = True
+                break
+        expr = self._math_expression(expr_source, prefixed)
+        if expr:
+            return self._plan("math", query=expr), 0.97
+
+        if lower.startswith(self.QUESTION_WORDS) and not lower.startswith(self.MATH_PREFIXES):
+            return None, 0.2
+
+        search = self._verb_pattern(self.SEARCH_VERBS)
+        play = self._verb_pattern(self.PLAY_VERBS)
+
+        # "pesquisa X no google/youtube"
+        m = re.match(rf"^{search}\s+(?:por\s+|sobre\s+)?(.+?)\s+no\s+(google|youtube|yt)\W*$", original, re.IGNORECASE)
+        if not m:
+            # "pesquisa no google/youtube X"
+            m2 = re.match(rf"^{search}\s+no\s+(google|youtube|yt)\s+(?:por\s+|sobre\s+)?(.+)$", original, re.IGNORECASE)
+            if m2:
+                m = m2
+                engine, query = m2.group(1).lower(), m2.group(2).strip()
+            else:
+                engine = query = None
+        else:
+            query, engine = m.group(1).strip(), m.group(2).lower()
+        if m:
+            action = "search" if engine == "google" else "youtube"
+            return self._plan(action, query=query), self._score(lower, query, base=0.65)
+
+        # "toca X no youtube"
+        m = re.match(rf"^{play}\s+(.+?)\s+no\s+(?:youtube|yt)\W*$", original, re.IGNORECASE)
+        if m:
+            query = m.group(1).strip()
+            return self._plan("youtube", query=query), self._score(lower, query)
+
+        # "pesquisa vídeos de X", "toca o vídeo de X"
+        m = re.match(rf"^(?:{search}|{play})\s+(?:o\s+|os\s+|um\s+)?v[íi]deos?\s+(?:de|do|da|sobre)\s+(.+)$",
+                     original, re.IGNORECASE)
+        if m:
+            query = m.group(1).strip()
+            return self._plan("ytvideo", query=query), self._score(lower, query)
+
+        first, _, rest = original.partition(" ")
+        first_lower = first.lower()
+        rest = rest.strip()
+
+        if first_lower in self.OPEN_VERBS and rest:
+            # Só é óbvio quando o alvo é um app ou atalho conhecido ("abre a porta
+            # da geladeira", "iniciar conversa sobre X" não são)
+            target = self._strip_article(rest)
+            if self.target_lookup is None or not self.target_lookup(target):
+                return self._plan("open", target=target), 0.5
+            return self._plan("open", target=target), self._score(lower, target)
+
+        if first_lower in self.TYPE_VERBS and rest:
+            # Digitação preserva o texto original (maiúsculas, pontuação); o conteúdo é literal,
+            # então tamanho e "?" não reduzem a confiança
+            return self._plan("type", text=rest), 0.9
+
+        # Sem verbo, só as abreviações ("yt X", "ytv X") são comando; "youtube é..." e
+        # "vídeo chamada..." podem ser frases comuns e ficam abaixo do limiar
+        if first_lower in self.YOUTUBE_WORDS and rest:
+            if first_lower == "youtube":
+                return self._plan("youtube", query=rest), 0.5
+            return self._plan("youtube", query=rest), self._score(lower, rest)
+
+        if first_lower in self.YTVIDEO_WORDS and rest:
+            query = re.sub(r"^(?:de|do|da|sobre)\s+", "", rest, flags=re.IGNORECASE)
+            if first_lower in ("vídeo", "video"):
+                return self._plan("ytvideo", query=query), 0.5
+            return self._plan("ytvideo", query=query), self._score(lower, query, base=0.55)
+
+        if first_lower in self.SEARCH_VERBS and rest:
+            # "pesquisa X" sem destino é ambíguo (Google x pesquisa com contexto): LLM decide
+            return self._plan("search", query=rest), 0.5
+
+        return None, 0.0
+
+    def classify(self, text: str):
+        """
+        Retorna (plano, confiança). O plano só é devolvido quando a confiança
+        atinge o limiar; caso contrário vem None e o LLM deve planejar.
+        """
+        try:
+            plan, confidence = self._classify(text or "")
+        except Exception as e:
+            print(f"[JARVIS][Intent] Erro no classificador local: {e}")
+            plan, confidence = None, 0.0
+
+        hit = plan is not None and confidence >= self.threshold
+        with self._lock:
+            self.stats["total"] += 1
+            if hit:
+                self.stats["hits"] += 1
+                self.stats["hit_confidence_sum"] += confidence
+                by_action = self.stats["by_action"]
+                by_action[plan["action"]] = by_action.get(plan["action"], 0) + 1
+            else:
+                self.stats["misses"] += 1
+                self.stats["miss_confidence_sum"] += confidence
+
+        if hit:
+            return plan, confidence
+        return None, confidence
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.stats["total"]
+            hits = self.stats["hits"]
+            misses = self.stats["misses"]
+            return {
+                "total": total,
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": hits / total if total else 0.0,
+                "avg_hit_confidence": self.stats["hit_confidence_sum"] / hits if hits else 0.0,
+                "avg_miss_confidence": self.stats["miss_confidence_sum"] / misses if misses else 0.0,
+                "by_action": dict(self.stats["by_action"]),
+                "threshold": self.threshold,
+            }
+
+# =========================
+# CACHE DO PLANEJADOR
+# =========================
+PLANNER_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "planner_cache.json")
+
+
+class PlannerCache:
+    """
+    Cache LRU + TTL dos planos gerados pelo LLM, indexado pelo texto (sem diferença
+    de maiúsculas e espaços) e pelo modelo que gerou o plano. É persistido em disco,
+    com a escrita agrupada numa thread de fundo, para que pedidos repetidos
+    ("abrir spotify", "limpar") não voltem ao Ollama entre sessões.
+    """
+
+    # "type" depende das maiúsculas do texto, que a chave descarta; "math" é
+    # resolvido localmente e não compensa guardar
+    UNCACHEABLE_ACTIONS = {"type", "math"}
+    # Espera antes de gravar: vários planos seguidos viram uma só escrita
+    SAVE_DELAY = 2.0
+
+    def __init__(self, path: str = PLANNER_CACHE_PATH, max_entries: int = 256, ttl: float = 7 * 24 * 3600):
+        self.path = path
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._save_timer: Optional[threading.Timer] = None
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "stores": 0}
+        self._load()
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        # Pontuação e operadores contam ("c" e "c++" são pedidos diferentes)
+        normalized = " ".join((text or "").casefold().split())
+        return f"{model}|{normalized}" if normalized else ""
+
+    def _expired(self, entry: Dict[str, Any], now: float) -> bool:
+        return self.ttl > 0 and now - entry.get("ts", 0) > self.ttl
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") != 2:
+                # Chaves do formato antigo (texto sem pontuação) não são reaproveitadas
+                return
+            now = time.time()
+            for key, entry in data.get("entries", []):
+                if isinstance(entry, dict) and isinstance(entry.get("plan"), dict) and not self._expired(entry, now):
+                    self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            print(f"[JARVIS][PlannerCache] {len(self._entries)} planos carregados de {self.path}")
+        except Exception as e:
+            print(f"[JARVIS][PlannerCache] Falha ao carregar cache: {e}")
+
+    def _schedule_save(self):
+        # Chamado com _lock
+        if not self.path or self._save_timer is not None:
+            return
+        self._save_timer = threading.Timer(self.SAVE_DELAY, self.flush)
+        self._save_timer.daemon = True
+        self._save_timer.start()
+
+    def flush(self):
+        """Grava o cache em disco agora (também usado pelo timer e ao sair)."""
+        with self._lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+            snapshot = list(self._entries.items())
+        if not self.path:
+            return
+        tmp_path = self.path + ".tmp"
+        with self._write_lock:
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump({"version": 2, "entries": snapshot}, f, ensure_ascii=False)
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                print(f"[JARVIS][PlannerCache] Falha ao salvar cache: {e}")
+
+    def get(self, model: str, text: str) -> Optional[dict]:
+        key = self.make_key(model, text)
+        if not key:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            if self._expired(entry, time.time()):
+                del self._entries[key]
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return dict(entry["plan"])
+
+    def put(self, model: str, text: str, plan: dict):
+        key = self.make_key(model, text)
+        if not key or not isinstance(plan, dict):
+            return
+        action = (plan.get("action") or "").lower().strip()
+        # Planos de falha trazem "response" e nunca devem ser reaproveitados
+        if not action or action in self.UNCACHEABLE_ACTIONS or "response" in plan:
+            return
+        with self._lock:
+            self._entries[key] = {"plan": dict(plan), "ts": time.time()}
+            self._entries.move_to_end(key)
+            self.stats["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+            self._schedule_save()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            result = dict(self.stats)
+            result["size"] = len(self._entries)
+            result["max_entries"] = self.max_entries
+            result["hit_rate"] = self.stats["hits"] / lookups if lookups else 0.0
+            return result
+
+# =========================
+# TRANSPORTE ASSÍNCRONO (OPCIONAL)
+# =========================
+class AsyncOllamaTransport:
+    """
+    Transporte de streaming em asyncio, só com a biblioteca padrão: um único event loop
+    numa thread dedicada atende todos os streams do Ollama. O NDJSON é lido de forma
+    incremental (chunked), os tokens são agrupados em lotes por janela de tempo e uma
+    fila limitada entre a leitura do socket e a entrega ao callback aplica backpressure:
+    enquanto a interface não consome o que já recebeu (backlog acima de high_water), os
+    lotes deixam de ser entregues, a fila enche, o socket deixa de ser lido e o TCP
+    segura o Ollama.
+    """
+
+    def __init__(self, batch_ms: int = 30, high_water: int = 256):
+        self.batch_interval = max(0, batch_ms) / 1000.0
+        self.high_water = max(1, high_water)
+        self.stats = {"streams": 0, "batches": 0, "tokens": 0, "backpressure": 0}
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, name="jarvis-async-ai", daemon=True)
+        self._thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        """Agenda a corrotina no loop do transporte; devolve um concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def _open(self, url: str, payload: dict, timeout: float):
+        parts = urllib.parse.urlsplit(url)
+        https = parts.scheme == "https"
+        host = parts.hostname or "localhost"
+        port = parts.port or (443 if https else 80)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=ssl.create_default_context() if https else None),
+            timeout,
+        )
+        body = json.dumps(payload).encode("utf-8")
+        head = (
+            f"POST {path} HTTP/1.1\r\n"
+            f"Host: {host}:{port}\r\n"
+            "Content-Type: application/json\r\n"
+            "Accept: application/x-ndjson\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n"
+        )
+        writer.write(head.encode("ascii") + body)
+        await writer.drain()
+
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        try:
+            status = int(status_line.split()[1])
+        except Exception:
+            writer.close()
+            raise requests.exceptions.ConnectionError(f"Resposta HTTP inválida: {status_line[:80]!r}")
+        headers: Dict[str, str] = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return status, headers, reader, writer
+
+    async def _iter_body(self, reader, headers: Dict[str, str], timeout: float):
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            while True:
+                size_line = await asyncio.wait_for(reader.readline(), timeout)
+                size = int(size_line.split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    return
+                data = await asyncio.wait_for(reader.readexactly(size), timeout)
+                await reader.readline()
+                yield data
+        else:
+            while True:
+                data = await asyncio.wait_for(reader.read(65536), timeout)
+                if not data:
+                    return
+                yield data
+
+    async def _iter_ndjson(self, reader, headers: Dict[str, str], timeout: float):
+        pending = b""
+        async for data in self._iter_body(reader, headers, timeout):
+            pending += data
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    try:
+                        yield json.loads(line)
+                    except Exception:
+                        continue
+        if pending.strip():
+            try:
+                yield json.loads(pending)
+            except Exception:
+                pass
+
+    async def stream(self, url: str, payload: dict, on_batch, timeout: float = 60, on_headers=None,
+                     backlog=None) -> dict:
+        """
+        Envia payload ao /api/chat em streaming e entrega os tokens agrupados a on_batch
+        (chamado na thread do loop, não pode bloquear). Se on_batch retornar False o
+        stream é encerrado. backlog(), se informado, diz quantos tokens já entregues a
+        interface ainda não exibiu; acima de high_water a entrega espera.
+        Retorna o chunk final do Ollama (com as estatísticas).
+        """
+        status, headers, reader, writer = await self._open(url, payload, timeout)
+        final: dict = {}
+        try:
+            if on_headers is not None:
+                on_headers()
+            if status >= 400:
+                body = b"".join([data async for data in self._iter_body(reader, headers, timeout)])
+                raise requests.exceptions.HTTPError(f"{status} Error: {body[:200].decode('utf-8', 'replace')}")
+
+            self.stats["streams"] += 1
+            tokens: "asyncio.Queue[Optional[str]]" = asyncio.Queue(maxsize=self.high_water)
+
+            async def produce():
+                try:
+                    async for chunk in self._iter_ndjson(reader, headers, timeout):
+                        if chunk.get("error"):
+                            raise requests.exceptions.HTTPError(str(chunk["error"]))
+                        if chunk.get("done"):
+                            final.update(chunk)
+                        token = chunk.get("message", {}).get("content", "")
+                        if token:
+                            await tokens.put(token)
+                finally:
+                    await tokens.put(None)
+
+            producer = asyncio.ensure_future(produce())
+            try:
+                finished = False
+                while not finished:
+                    token = await tokens.get()
+                    if token is None:
+                        break
+                    # Janela de tempo: tudo que chegar nesse intervalo sai num único lote
+                    if self.batch_interval:
+                        await asyncio.sleep(self.batch_interval)
+                    parts = [token]
+                    while not tokens.empty():
+                        token = tokens.get_nowait()
+                        if token is None:
+                            finished = True
+                            break
+                        parts.append(token)
+                    self.stats["batches"] += 1
+                    self.stats["tokens"] += len(parts)
+                    if on_batch("".join(parts)) is False:
+                        return final
+                    if backlog is not None and backlog() > self.high_water:
+                        # Interface atrasada: espera ela consumir antes de ler mais do socket
+                        self.stats["backpressure"] += 1
+                        while backlog() > self.high_water:
+                            await asyncio.sleep(self.batch_interval or 0.01)
+                await producer
+            finally:
+                if not producer.done():
+                    producer.cancel()
+            return final
+        finally:
+            # Fechar o socket é o que faz o Ollama parar de gerar num cancelamento
+            writer.close()
+
+    def get_stats(self) -> dict:
+        stats = dict(self.stats)
+        stats["avg_batch"] = stats["tokens"] / stats["batches"] if stats["batches"] else 0.0
+        return stats
+
 
 # =========================
 # IA (OLLAMA)
 # =========================
 
+class _OllamaRetry(Retry):
+    """Retry que repete resets de conexão, mas nunca um timeout de leitura
+    (um timeout significa inferência lenta; repetir só duplicaria o trabalho do modelo)."""
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if isinstance(error, ReadTimeoutError):
+            raise error
+        return super().increment(method, url, response=response, error=error, _pool=_pool, _stacktrace=_stacktrace)
+
+
+class AIRequestCancelled(Exception):
+    """Requisição ao Ollama abortada por cancel_inflight()."""
+
+
+class CancelScope(threading.Event):
+    """
+    cancel_event de uma parte de um job (por exemplo, o stream especulativo): pode
+    ser cancelado sozinho e conta como cancelado quando o job dono (parent) é.
+    """
+
+    def __init__(self, parent: Optional[threading.Event] = None):
+        super().__init__()
+        self.parent = parent
+
+    def is_set(self) -> bool:
+        return super().is_set() or (self.parent is not None and self.parent.is_set())
+
+    def within(self, scopes) -> bool:
+        """Se este escopo ou algum dos seus donos está em scopes."""
+        scope = self
+        while scope is not None:
+            if scope in scopes:
+                return True
+            scope = getattr(scope, "parent", None)
+        return False
+
+
 class AIEngine:
-    def __init__(self, url: str = None, model: str = None):
-        base_url = url or os.getenv("OLLAMA_URL") or "http://localhost:11434/api/chat"
-        self.model = model or os.getenv("OLLAMA_MODEL") or "qwen2.5-coder:3b"
+    # Papéis com modelo configurável; "fused" e "summary" usam o modelo de chat
+    MODEL_ROLES = ("planner", "chat", "research", "decide")
+    # Requisições do turno interativo, abortadas pelo "cancelar" (o resumo em background segue)
+    CANCELLABLE_LABELS = ("planner", "chat", "research", "decide", "fused")
+    # Ao estourar o orçamento, o histórico desce até esta fração dele: o início da
+    # conversa (prefixo reaproveitado pelo Ollama) fica igual por vários turnos
+    HISTORY_LOW_WATER = 0.75
+
+    def __init__(self, url: str = None, model: str = None, pool_size: int = None, retries: int = None):
+        config = load_config()
+        base_url = url or os.getenv("OLLAMA_URL") or config.get("url") or "http://localhost:11434/api/chat"
+        default_model = model or os.getenv("OLLAMA_MODEL") or config.get("model") or "qwen2.5-coder:3b"
+
+        # Modelo por papel: env OLLAMA_MODEL_<PAPEL> > jarvis_config.json ("models") > modelo padrão.
+        # O planner é uma classificação curta em JSON e pode usar um modelo bem menor.
+        config_models = config.get("models") if isinstance(config.get("models"), dict) else {}
+        self.models: Dict[str, str] = {}
+        for role in self.MODEL_ROLES:
+            self.models[role] = (
+                os.getenv(f"OLLAMA_MODEL_{role.upper()}")
+                or config_models.get(role)
+                or default_model
+            )
+        self.model = self.models["chat"]
+        # Modelo de embeddings (opcional) para o índice local de pesquisas
+        self.embed_model = (os.getenv("OLLAMA_EMBED_MODEL") or config.get("embed_model") or "").strip()
+
+        # Sessão HTTP persistente (keep-alive + pool) compartilhada por planner,
+        # streaming, decide() e health checks
+        pool_size = pool_size or int(os.getenv("OLLAMA_POOL_SIZE", "4"))
+        retries = retries if retries is not None else int(os.getenv("OLLAMA_RETRIES", "2"))
+        backoff = float(os.getenv("OLLAMA_RETRY_BACKOFF", "0.3"))
+        self.session = self._build_session(pool_size, retries, backoff)
+
+        # Latência por tipo de requisição (plan, chat, decide, probe)
+        self.request_stats: Dict[str, Dict[str, float]] = {}
+        self._stats_lock = threading.Lock()
 
         parsed = urllib.parse.urlparse(base_url)
         scheme = parsed.scheme or "http"
         netloc = parsed.netloc or parsed.path
-        base = f"{scheme}://{netloc}"
-        candidates = [base_url]
-        candidates.extend([
-            urllib.parse.urljoin(base, "/api/chat"),
-            urllib.parse.urljoin(base, "/api/status"),
-            urllib.parse.urljoin(base, "/api/health"),
-            urllib.parse.urljoin(base, "/v1/chat"),
-            urllib.parse.urljoin(base, "/")
-        ])
-
-        self.url = base_url
+        self.base_url = f"{scheme}://{netloc}"
+
+        # Mantém o endpoint informado se já for de chat; senão usa o padrão do Ollama
+        if parsed.netloc and parsed.path.rstrip("/").endswith("/chat"):
+            self.url = base_url
+        else:
+            self.url = urllib.parse.urljoin(self.base_url, "/api/chat")
         self.available = False
 
         self.conversation_history = []
-        
-        for ep in candidates:
-            try:
-                if ep.endswith("/chat"):
-                    payload = {
-                        "model": self.model,
-                        "messages": [{"role": "system", "content": "health check"}],
-                        "stream": False,
-                        "options": {"temperature": 0}
-                    }
-                    r = requests.post(ep, json=payload, timeout=2)
-                else:
-                    r = requests.get(ep, timeout=2)
+        # Chamado com (pergunta, resposta) a cada turno concluído (persistência das conversas)
+        self.on_turn = None
+
+        # Mantém o modelo carregado entre mensagens esparsas e fixa a janela de contexto
+        self.keep_alive = os.getenv("OLLAMA_KEEP_ALIVE", "30m").strip()
+        num_ctx = os.getenv("OLLAMA_NUM_CTX", "").strip()
+        self.num_ctx = int(num_ctx) if num_ctx.isdigit() else None
+
+        # Pré-carregamento do modelo em background (janela restaurada, voz, digitação)
+        self.warmup_interval = float(os.getenv("JARVIS_WARMUP_INTERVAL", "20"))
+        self.warmup_stats = {"requested": 0, "loaded": 0, "resident": 0, "debounced": 0, "errors": 0}
+        self._warm_lock = threading.Lock()
+        self._warm_running = False
+        self._last_warm_check = 0.0
+
+        # Estatísticas de avaliação reportadas pelo próprio Ollama (prompt eval x geração)
+        self.ollama_stats: Dict[str, Dict[str, float]] = {}
+        self.last_turn_stats: Dict[str, Dict[str, float]] = {}
+
+        # Histórico limitado por orçamento aproximado de tokens (por modelo)
+        self.history_token_budget = int(os.getenv("JARVIS_HISTORY_TOKENS", "3000"))
+        self.history_token_budgets: Dict[str, int] = {}
+        config_budgets = config.get("history_tokens")
+        if isinstance(config_budgets, dict):
+            for name, value in config_budgets.items():
+                if isinstance(value, int):
+                    self.history_token_budgets[name] = value
+        for item in os.getenv("JARVIS_HISTORY_TOKENS_BY_MODEL", "").split(","):
+            name, _, value = item.rpartition("=")
+            if name.strip() and value.strip().isdigit():
+                self.history_token_budgets[name.strip()] = int(value)
+        # Resumo contínuo (opcional) das mensagens removidas do histórico
+        self.history_summary_enabled = os.getenv("JARVIS_HISTORY_SUMMARY", "0").strip().lower() in ("1", "true", "sim", "yes")
+        self.history_summary = ""
+        self.history_stats = {"evicted": 0, "summaries": 0}
+        self._summary_lock = threading.Lock()
+        self._summary_pending: List[Dict[str, str]] = []
+        self._summary_running = False
+        # Incrementado a cada /limpar: resumo calculado antes disso é descartado
+        self._history_generation = 0
+
+        # Classificador local: intenções óbvias não chegam ao LLM planner
+        self.intent_classifier = None
+        if os.getenv("JARVIS_FASTPATH", "1").strip().lower() not in ("0", "false", "nao", "não", "no"):
+            self.intent_classifier = IntentClassifier(
+                threshold=float(os.getenv("JARVIS_FASTPATH_THRESHOLD", "0.8"))
+            )
+
+        # Cache dos planos do LLM (LRU + TTL, persistido em disco)
+        self.planner_cache = None
+        if os.getenv("JARVIS_PLANNER_CACHE", "1").strip().lower() not in ("0", "false", "nao", "não", "no"):
+            self.planner_cache = PlannerCache(
+                max_entries=int(os.getenv("JARVIS_PLANNER_CACHE_SIZE", "256")),
+                ttl=float(os.getenv("JARVIS_PLANNER_CACHE_TTL", str(7 * 24 * 3600))),
+            )
+
+        # Saída estruturada do planner: schema JSON no "format" do Ollama
+        # (cai para "json" simples em versões antigas que não aceitam schema)
+        self.planner_format: Any = PLANNER_SCHEMA
+        self.planner_stats = {"valid": 0, "invalid": 0, "errors": 0}
+
+        # Modo fundido (planner + resposta em uma única inferência em streaming)
+        self.fused_mode = os.getenv("JARVIS_FUSED_PLANNER", "0").strip().lower() in ("1", "true", "sim", "yes")
+
+        # Modo especulativo: planner e stream de chat disparados em paralelo
+        self.speculative_mode = os.getenv("JARVIS_SPECULATIVE", "0").strip().lower() in ("1", "true", "sim", "yes")
+        self.speculative_stats = {"launched": 0, "used": 0, "wasted": 0, "wasted_tokens": 0, "plan_ms": 0.0}
+        self._spec_lock = threading.Lock()
+
+        # Requisições em andamento que o cancelamento pode abortar, cada uma ligada ao
+        # cancel_event do job que a fez (None fora do agendador)
+        self._inflight: "weakref.WeakKeyDictionary[requests.Response, Optional[threading.Event]]" = weakref.WeakKeyDictionary()
+        self._inflight_lock = threading.Lock()
+        self._cancel_generation = 0
+        self._cancel_scope = threading.local()
+        self.cancel_stats = {"cancels": 0, "aborted": 0}
+        self._async_inflight: Dict[Any, Optional[threading.Event]] = {}
+
+        # Transporte asyncio opcional para as respostas em streaming
+        self.async_transport: Optional[AsyncOllamaTransport] = None
+        # Quantos tokens a interface recebeu e ainda não exibiu (definido pelo JarvisApp)
+        self.ui_backlog = None
+        if os.getenv("JARVIS_ASYNC_TRANSPORT", "0").strip().lower() in ("1", "true", "sim", "yes"):
+            self.async_transport = AsyncOllamaTransport(
+                batch_ms=int(os.getenv("JARVIS_STREAM_BATCH_MS", "30")),
+                high_water=int(os.getenv("JARVIS_STREAM_HIGH_WATER", "256")),
+            )
+
+        # A verificação de saúde não roda mais aqui: start_probe() a executa
+        # em background para não atrasar a abertura da janela
+        self._probe_done = threading.Event()
+        self._probe_thread = None
 
-                if r is not None and r.status_code < 500:
-                    self.available = True
-                    if ep.endswith("/chat"):
-                        self.url = ep
+    @property
+    def probe_pending(self) -> bool:
+        """True enquanto a verificação iniciada por start_probe() não terminou."""
+        return self._probe_thread is not None and not self._probe_done.is_set()
+
+    def _probe_endpoint(self, url: str, timeout: float) -> bool:
+        try:
+            r = self._request("GET", url, "probe", timeout=timeout)
+            return r.ok
+        except Exception:
+            return False
+
+    def probe(self, timeout: float = 2.0) -> bool:
+        """
+        Verifica se o Ollama está no ar consultando /api/version e /api/tags em paralelo.
+        Usa somente endpoints leves (nunca dispara inferência nem carrega modelo)
+        e retorna assim que o primeiro responder com sucesso.
+        """
+        endpoints = [
+            urllib.parse.urljoin(self.base_url, "/api/version"),
+            urllib.parse.urljoin(self.base_url, "/api/tags"),
+        ]
+        executor = ThreadPoolExecutor(max_workers=len(endpoints), thread_name_prefix="ollama-probe")
+        futures = [executor.submit(self._probe_endpoint, ep, timeout) for ep in endpoints]
+        healthy = False
+        try:
+            for fut in as_completed(futures, timeout=timeout * 2):
+                if fut.result():
+                    healthy = True
                     break
-            except Exception:
-                continue
-    
-    def _trim_history(self, max_messages: int = 20):
-        if len(self.conversation_history) > max_messages:
-            self.conversation_history = self.conversation_history[-max_messages:]
+        except Exception:
+            healthy = False
+        finally:
+            # Não espera pelos demais: o primeiro resultado saudável já basta
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        self.available = healthy
+        return healthy
+
+    def start_probe(self, callback=None, timeout: float = 2.0):
+        """Executa probe() em uma thread; callback(available) é chamado ao terminar."""
+        self._probe_done.clear()
+
+        def _run():
+            available = False
+            try:
+                available = self.probe(timeout=timeout)
+            finally:
+                self._probe_done.set()
+            if callback:
+                try:
+                    callback(available)
+                except Exception as e:
+                    print(f"[JARVIS][AI] Erro no callback da verificação: {e}")
+
+        self._probe_thread = threading.Thread(target=_run, daemon=True)
+        self._probe_thread.start()
+
+    def wait_for_probe(self, timeout: float = None) -> bool:
+        """Aguarda a verificação em andamento (se houver) e retorna a disponibilidade."""
+        if self._probe_thread is not None:
+            self._probe_done.wait(timeout)
+        return self.available
+
+    def history_budget(self) -> int:
+        """Orçamento de tokens do histórico para o modelo atual."""
+        return self.history_token_budgets.get(self.model, self.history_token_budget)
+
+    def _trim_history(self):
+        """
+        Quando o histórico passa do orçamento de tokens, remove as mensagens mais
+        antigas até HISTORY_LOW_WATER do orçamento, e não só até caber: cortar um
+        pouco a cada turno mudaria o início do prompt sempre e o Ollama perderia o
+        prefixo em cache. A mensagem mais recente nunca é removida e o histórico
+        sempre recomeça em uma mensagem do usuário.
+        """
+        budget = self.history_budget()
+        history = self.conversation_history
+        evicted = []
+        if estimate_message_tokens(history) > budget:
+            low_water = int(budget * self.HISTORY_LOW_WATER)
+            while len(history) > 1 and estimate_message_tokens(history) > low_water:
+                evicted.append(history.pop(0))
+        while len(history) > 1 and history[0].get("role") != "user":
+            evicted.append(history.pop(0))
+
+        if not evicted:
+            return
+        self.history_stats["evicted"] += len(evicted)
+        print(f"[JARVIS][AI] Histórico: {len(evicted)} mensagens antigas removidas (orçamento {budget} tokens)")
+        if self.history_summary_enabled:
+            self._schedule_summary(evicted)
+
+    def _schedule_summary(self, evicted):
+        """Acumula as mensagens removidas e resume em background (uma execução por vez)."""
+        with self._summary_lock:
+            self._summary_pending.extend(evicted)
+            if self._summary_running:
+                return
+            self._summary_running = True
+        threading.Thread(target=self._summarize_pending, daemon=True).start()
+
+    def _summarize_pending(self):
+        try:
+            while True:
+                with self._summary_lock:
+                    pending = self._summary_pending
+                    self._summary_pending = []
+                    if not pending:
+                        self._summary_running = False
+                        return
+                    generation = self._history_generation
+                    previous_summary = self.history_summary
+                transcript = "\n".join(
+                    f"{'Usuário' if m.get('role') == 'user' else 'Assistente'}: {m.get('content', '')[:1500]}"
+                    for m in pending
+                )
+                messages = [
+                    {"role": "system", "content": (
+                        "Resuma a conversa abaixo em português, em no máximo 5 frases curtas, "
+                        "mantendo fatos, nomes e preferências do usuário. Responda só com o resumo."
+                    )},
+                    {"role": "user", "content": (
+                        (f"Resumo anterior:\n{previous_summary}\n\n" if previous_summary else "")
+                        + f"Novas mensagens:\n{transcript}"
+                    )},
+                ]
+                try:
+                    r = self._post_chat(messages, stream=False, temperature=0.2, timeout=60,
+                                        label="summary", options={"num_predict": 200})
+                    r.raise_for_status()
+                    resp = r.json()
+                    self._record_ollama_stats("summary", resp)
+                    summary = (resp.get("message", {}).get("content") or "").strip()
+                    with self._summary_lock:
+                        if summary and generation == self._history_generation:
+                            self.history_summary = summary[:1200]
+                            self.history_stats["summaries"] += 1
+                except Exception as e:
+                    print(f"[JARVIS][AI] Falha ao resumir histórico: {e}")
+        except Exception:
+            with self._summary_lock:
+                self._summary_running = False
+
+    def _notify_turn(self, user_text: str, response_text: str):
+        if self.on_turn is None:
+            return
+        try:
+            self.on_turn(user_text, response_text)
+        except Exception as e:
+            print(f"[JARVIS][AI] Erro ao registrar turno: {e}")
+
+    def restore_history(self, messages: List[Dict[str, str]]):
+        """Coloca mensagens de uma sessão anterior antes do histórico atual."""
+        restored = [{"role": m["role"], "content": m["content"]} for m in messages
+                    if m.get("role") in ("user", "assistant") and m.get("content")]
+        self.conversation_history[:0] = restored
+        self._trim_history()
+
+    def reset_history(self):
+        """Descarta histórico e resumo (usado por /limpar)."""
+        with self._summary_lock:
+            self._history_generation += 1
+            self.conversation_history = []
+            self.history_summary = ""
+            self._summary_pending = []
+
+    def _system_messages(self, system_content: str = JARVIS_PERSONALITY) -> List[Dict[str, str]]:
+        messages = [{"role": "system", "content": system_content}]
+        if self.history_summary:
+            messages.append({"role": "system", "content": f"Resumo da conversa anterior:\n{self.history_summary}"})
+        return messages
+
+    def _build_session(self, pool_size: int, retries: int, backoff: float) -> requests.Session:
+        """Cria a sessão com pool de conexões keep-alive e retry com backoff para resets."""
+        retry = _OllamaRetry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=0,
+            backoff_factor=backoff,
+            allowed_methods=None,  # POST também: o Ollama não recebeu nada se a conexão caiu
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update({"Connection": "keep-alive"})
+        return session
+
+    def _record_latency(self, label: str, seconds: float, ok: bool = True):
+        ms = seconds * 1000.0
+        with self._stats_lock:
+            stats = self.request_stats.setdefault(label, {
+                "count": 0, "errors": 0, "total_ms": 0.0,
+                "last_ms": 0.0, "min_ms": 0.0, "max_ms": 0.0,
+            })
+            if stats["count"] == 0 or ms < stats["min_ms"]:
+                stats["min_ms"] = ms
+            stats["count"] += 1
+            stats["total_ms"] += ms
+            stats["last_ms"] = ms
+            stats["max_ms"] = max(stats["max_ms"], ms)
+            if not ok:
+                stats["errors"] += 1
+
+    def get_request_stats(self) -> Dict[str, Dict[str, float]]:
+        """Retorna uma cópia das latências registradas, com média por tipo."""
+        with self._stats_lock:
+            result = {}
+            for label, stats in self.request_stats.items():
+                item = dict(stats)
+                item["avg_ms"] = stats["total_ms"] / stats["count"] if stats["count"] else 0.0
+                result[label] = item
+            return result
+
+    def _request(self, method: str, url: str, label: str, record_latency: bool = True, **kwargs):
+        """Executa uma requisição pela sessão compartilhada, registrando a latência
+        (para streams, o tempo até os cabeçalhos chegarem). Com record_latency=False
+        quem chama registra o tempo (ex.: até o fim do stream)."""
+        start = time.perf_counter()
+        ok = False
+        try:
+            r = self.session.request(method, url, **kwargs)
+            ok = True
+            return r
+        finally:
+            if record_latency or not ok:
+                self._record_latency(label, time.perf_counter() - start, ok)
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """Embeddings pelo /api/embed do Ollama com o modelo embed_model."""
+        payload = {"model": self.embed_model, "input": texts}
+        if self.keep_alive:
+            payload["keep_alive"] = self.keep_alive
+        r = self._request("POST", urllib.parse.urljoin(self.base_url, "/api/embed"), "embed",
+                          json=payload, timeout=60)
+        r.raise_for_status()
+        return r.json()["embeddings"]
+
+    def model_for(self, role: str) -> str:
+        """Modelo configurado para o papel (planner, chat, research, decide)."""
+        return self.models.get(role, self.model)
+
+    def plan_model(self) -> str:
+        """Modelo que gera os planos no modo atual (fundido ou planner separado)."""
+        return self.model_for("fused") if self.fused_mode else self.model_for("planner")
+
+    def _warmup_models(self) -> List[str]:
+        # planner e chat respondem a toda mensagem; research/decide carregam sob demanda
+        return [self.model_for("planner"), self.model_for("chat")]
+
+    def _resident_models(self) -> Optional[set]:
+        """Modelos já carregados na memória do Ollama (/api/ps); None se não foi possível consultar."""
+        try:
+            r = self._request("GET", urllib.parse.urljoin(self.base_url, "/api/ps"), "warmup", timeout=2)
+            if not r.ok:
+                return None
+            names = set()
+            for item in r.json().get("models", []) or []:
+                for key in ("name", "model"):
+                    if item.get(key):
+                        names.add(item[key])
+            return names
+        except Exception:
+            return None
 
-    def _post_chat(self, messages, stream: bool = False, temperature: float = 0.7, timeout: int = 60):
+    def warm_up(self, reason: str = ""):
+        """
+        Pré-carrega em background os modelos usados (requisição /api/generate sem prompt),
+        para que a primeira mensagem não pague o tempo de carga. Não faz nada se já houver
+        um aquecimento em andamento, se a última checagem for recente ou se o modelo já
+        estiver residente.
+        """
+        if not self.available:
+            return
+        with self._warm_lock:
+            self.warmup_stats["requested"] += 1
+            now = time.time()
+            if self._warm_running or now - self._last_warm_check < self.warmup_interval:
+                self.warmup_stats["debounced"] += 1
+                return
+            self._warm_running = True
+            self._last_warm_check = now
+        threading.Thread(target=self._warm_up_worker, args=(reason,), daemon=True).start()
+
+    def _warm_up_worker(self, reason: str):
+        try:
+            resident = self._resident_models()
+            for model in dict.fromkeys(self._warmup_models()):
+                if resident is not None and (model in resident or f"{model}:latest" in resident):
+                    self.warmup_stats["resident"] += 1
+                    continue
+                payload = {"model": model, "prompt": "", "stream": False}
+                if self.keep_alive:
+                    payload["keep_alive"] = self.keep_alive
+                if self.num_ctx:
+                    payload["options"] = {"num_ctx": self.num_ctx}
+                try:
+                    start = time.perf_counter()
+                    r = self._request("POST", urllib.parse.urljoin(self.base_url, "/api/generate"), "warmup",
+                                      json=payload, timeout=120)
+                    r.raise_for_status()
+                    self.warmup_stats["loaded"] += 1
+                    print(f"[JARVIS][AI] Modelo {model} pré-carregado ({reason}) em {(time.perf_counter() - start) * 1000:.0f} ms")
+                except Exception as e:
+                    self.warmup_stats["errors"] += 1
+                    print(f"[JARVIS][AI] Falha ao pré-carregar {model}: {e}")
+        finally:
+            with self._warm_lock:
+                self._warm_running = False
+
+    def _record_ollama_stats(self, label: str, data: dict):
+        """Registra as durações do chunk final do Ollama (em ns na API) para o turno."""
+        if not isinstance(data, dict) or ("eval_count" not in data and "prompt_eval_count" not in data):
+            return
+        turn = {
+            "prompt_tokens": data.get("prompt_eval_count", 0) or 0,
+            "prompt_ms": (data.get("prompt_eval_duration", 0) or 0) / 1e6,
+            "eval_tokens": data.get("eval_count", 0) or 0,
+            "eval_ms": (data.get("eval_duration", 0) or 0) / 1e6,
+            "load_ms": (data.get("load_duration", 0) or 0) / 1e6,
+            "total_ms": (data.get("total_duration", 0) or 0) / 1e6,
+        }
+        with self._stats_lock:
+            self.last_turn_stats[label] = turn
+            agg = self.ollama_stats.setdefault(label, {"turns": 0, **{k: 0.0 for k in turn}})
+            agg["turns"] += 1
+            for key, value in turn.items():
+                agg[key] += value
+
+        rate = turn["eval_tokens"] / (turn["eval_ms"] / 1000.0) if turn["eval_ms"] else 0.0
+        print(
+            f"[JARVIS][AI] {label}: prompt {turn['prompt_tokens']} tok em {turn['prompt_ms']:.0f} ms | "
+            f"geração {turn['eval_tokens']} tok em {turn['eval_ms']:.0f} ms ({rate:.1f} tok/s) | "
+            f"carga {turn['load_ms']:.0f} ms"
+        )
+
+    def get_ollama_stats(self) -> Dict[str, Dict[str, float]]:
+        with self._stats_lock:
+            return {label: dict(agg) for label, agg in self.ollama_stats.items()}
+
+    def _iter_stream(self, r, label: str):
+        """Itera pelo NDJSON do Ollama devolvendo os tokens e registrando as estatísticas finais.
+        Levanta AIRequestCancelled se o stream foi abortado por cancel_inflight()."""
+        try:
+            for line in r.iter_lines():
+                if not line:
+                    continue
+                try:
+                    chunk = json.loads(line)
+                except Exception:
+                    continue
+                if chunk.get("done"):
+                    self._record_ollama_stats(label, chunk)
+                token = chunk.get("message", {}).get("content", "")
+                if token:
+                    yield token
+        except Exception as e:
+            if getattr(r, "jarvis_cancelled", False):
+                raise AIRequestCancelled(label) from e
+            raise
+        if getattr(r, "jarvis_cancelled", False):
+            raise AIRequestCancelled(label)
+
+    def _chat_collect(self, messages, temperature: float = 0, timeout: int = 30, label: str = "planner",
+                      options: Optional[dict] = None, response_format: Any = None) -> str:
+        """Equivalente a stream=False, mas em streaming por baixo: assim o planner e o
+        decide podem ser abortados no meio da geração. Retorna o texto completo.
+        A latência registrada vai até o fim do stream, como numa chamada sem stream."""
+        start = time.perf_counter()
+        with self._post_chat(messages, stream=True, temperature=temperature, timeout=timeout, label=label,
+                             options=options, response_format=response_format, record_latency=False) as r:
+            ok = False
+            try:
+                r.raise_for_status()
+                content = "".join(self._iter_stream(r, label))
+                ok = True
+                return content
+            finally:
+                self._record_latency(label, time.perf_counter() - start, ok)
+
+    def _stream_async(self, messages, label: str, on_token, temperature: float = 0.7, timeout: int = 60):
+        """Stream pelo transporte asyncio; on_token recebe lotes de tokens na thread do loop."""
+        payload = self._chat_payload(messages, True, temperature, label)
+        start = time.perf_counter()
+        got_headers = []
+
+        def on_headers():
+            got_headers.append(True)
+            self._record_latency(label, time.perf_counter() - start, True)
+
+        scope = self.current_cancel_scope()
+        generation = self._cancel_generation
+        future = self.async_transport.submit(
+            self.async_transport.stream(self.url, payload, on_token, timeout=timeout, on_headers=on_headers,
+                                        backlog=self.ui_backlog)
+        )
+        with self._inflight_lock:
+            cancelled = generation != self._cancel_generation or (scope is not None and scope.is_set())
+            if not cancelled:
+                self._async_inflight[future] = scope
+        if cancelled:
+            future.cancel()
+            raise AIRequestCancelled(label)
+        try:
+            final = future.result()
+        except CancelledError:
+            raise AIRequestCancelled(label)
+        except Exception:
+            if not got_headers:
+                self._record_latency(label, time.perf_counter() - start, False)
+            raise
+        finally:
+            with self._inflight_lock:
+                self._async_inflight.pop(future, None)
+        if final:
+            self._record_ollama_stats(label, final)
+
+    @staticmethod
+    def _abort_response(r) -> bool:
+        """Derruba a conexão de uma resposta em andamento. O Ollama percebe a desconexão
+        e interrompe a geração na hora; a conexão não volta para o pool."""
+        if getattr(r, "jarvis_cancelled", False):
+            return False
+        r.jarvis_cancelled = True
+        raw = getattr(r, "raw", None)
+        if raw is None or getattr(raw, "closed", True):
+            return False
+        try:
+            conn = getattr(raw, "_connection", None) or getattr(raw, "connection", None)
+            sock = getattr(conn, "sock", None)
+            if sock is not None:
+                # shutdown acorda a thread bloqueada no recv (close sozinho não acorda)
+                sock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+        try:
+            r.close()
+        except Exception:
+            pass
+        return True
+
+    def bind_cancel_scope(self, cancel_event: Optional[threading.Event]):
+        """Liga as requisições feitas por esta thread ao job dono de cancel_event."""
+        self._cancel_scope.event = cancel_event
+
+    def current_cancel_scope(self) -> Optional[threading.Event]:
+        return getattr(self._cancel_scope, "event", None)
+
+    def _run_in_scope(self, cancel_event: Optional[threading.Event], fn, *args, **kwargs):
+        """Executa fn em outra thread mantendo o vínculo com o mesmo job."""
+        self.bind_cancel_scope(cancel_event)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.bind_cancel_scope(None)
+
+    def cancel_inflight(self, scopes: Optional[List[threading.Event]] = None) -> int:
+        """Aborta as requisições interativas em andamento: todas (scopes=None) ou só as
+        dos jobs cujos cancel_event foram passados. Requisições que ainda aguardam os
+        cabeçalhos são abortadas assim que eles chegarem. Retorna quantos streams foram fechados."""
+        with self._inflight_lock:
+            if scopes is None:
+                self._cancel_generation += 1
+                responses = list(self._inflight.keys())
+                self._inflight.clear()
+                futures = list(self._async_inflight)
+                self._async_inflight.clear()
+            else:
+                wanted = set(scopes)
+
+                def matches(scope):
+                    return scope in wanted or (isinstance(scope, CancelScope) and scope.within(wanted))
+                responses = [r for r, scope in list(self._inflight.items()) if matches(scope)]
+                for r in responses:
+                    self._inflight.pop(r, None)
+                futures = [f for f, scope in self._async_inflight.items() if matches(scope)]
+                for f in futures:
+                    self._async_inflight.pop(f, None)
+        aborted = sum(1 for r in responses if self._abort_response(r))
+        # Streams do transporte asyncio: cancelar a task fecha o socket
+        aborted += sum(1 for f in futures if f.cancel())
+        self.cancel_stats["cancels"] += 1
+        self.cancel_stats["aborted"] += aborted
+        print(f"[JARVIS][AI] Cancelamento: {aborted} stream(s) do Ollama encerrado(s)")
+        return aborted
+
+    def _chat_payload(self, messages, stream: bool, temperature: float, label: str,
+                      options: Optional[dict] = None, response_format: Any = None) -> dict:
         payload = {
-            "model": self.model,
+            "model": self.model_for(label),
             "messages": messages,
             "stream": stream,
             "options": {"temperature": temperature}
         }
-        return requests.post(self.url, json=payload, stream=stream, timeout=timeout)
+        if response_format is not None:
+            payload["format"] = response_format
+        if self.keep_alive:
+            payload["keep_alive"] = self.keep_alive
+        if self.num_ctx:
+            # Mesmo num_ctx em todas as chamadas: mudar o valor força o Ollama a recarregar o modelo
+            payload["options"]["num_ctx"] = self.num_ctx
+        if options:
+            payload["options"].update(options)
+        return payload
+
+    def _post_chat(self, messages, stream: bool = False, temperature: float = 0.7, timeout: int = 60,
+                   label: str = "chat", options: Optional[dict] = None, response_format: Any = None,
+                   record_latency: bool = True):
+        """Envia ao /api/chat usando o modelo do papel indicado por label."""
+        payload = self._chat_payload(messages, stream, temperature, label, options, response_format)
+        if label not in self.CANCELLABLE_LABELS:
+            return self._request("POST", self.url, label, record_latency, json=payload, stream=stream, timeout=timeout)
+
+        scope = self.current_cancel_scope()
+        generation = self._cancel_generation
+        r = self._request("POST", self.url, label, record_latency, json=payload, stream=stream, timeout=timeout)
+        with self._inflight_lock:
+            cancelled = generation != self._cancel_generation or (scope is not None and scope.is_set())
+            if not cancelled:
+                self._inflight[r] = scope
+        if cancelled:
+            # Cancelado enquanto esperava os cabeçalhos
+            self._abort_response(r)
+            raise AIRequestCancelled(label)
+        return r
+
+    def quick_plan(self, user_text: str) -> Optional[dict]:
+        """
+        Resolve o plano sem chamar o modelo: primeiro pelo classificador local
+        (intenções óbvias), depois pelo cache de planos anteriores.
+        """
+        if self.intent_classifier is not None:
+            start = time.perf_counter()
+            plan, confidence = self.intent_classifier.classify(user_text)
+            elapsed_us = (time.perf_counter() - start) * 1_000_000
+            if plan is not None:
+                print(f"[JARVIS][Intent] Plano local ({confidence:.2f}, {elapsed_us:.0f} µs): {plan}")
+                return plan
+
+        if self.planner_cache is not None:
+            plan = self.planner_cache.get(self.plan_model(), user_text)
+            if plan is not None:
+                print(f"[JARVIS][PlannerCache] Cache hit: {plan}")
+                return plan
+        return None
 
     def plan(self, user_text: str) -> dict:
-        planner_prompt = (
-            "Você é o planejador de ações do JARVIS. "
-            "Responda SOMENTE com JSON válido, sem markdown e sem texto extra.\n\n"
-            "Formato obrigatório:\n"
-            "{\n"
-            '  "action": "chat|research|open|search|youtube|ytvideo|type|clear|math",\n'
-            '  "target": "",\n'
-            '  "query": "",\n'
-            '  "text": "",\n'
-            '  "context_query": ""\n'
-            "}\n\n"
-            "Regras:\n"
-            "- Se o usuário pedir para pesquisar informação, explicar um tema, ou responder algo que exija conhecimento externo, use action=\"research\" e preencha query com o termo principal.\n"
-            "- Se pedir para abrir algo, use action=\"open\" e target com o nome do app/arquivo.\n"
-            "- Se pedir pesquisa no Google, use action=\"search\" e query.\n"
-            "- Se pedir YouTube, use action=\"youtube\" ou \"ytvideo\".\n"
-            "- Se pedir para digitar, use action=\"type\" e text.\n"
-            "- Se pedir para limpar, use action=\"clear\".\n"
-            "- Se for uma pergunta matemática, use action=\"math\" e coloque a expressão em query.\n"
-            "- Caso contrário, use action=\"chat\".\n"
-        )
+        local = self.quick_plan(user_text)
+        if local is not None:
+            return local
+        return self._model_plan(user_text)
 
+    def _model_plan(self, user_text: str) -> dict:
+        """Plano pelo modelo, para quem já tentou quick_plan sem sucesso."""
         messages = [
-            {"role": "system", "content": planner_prompt},
+            {"role": "system", "content": PLANNER_PROMPT},
             {"role": "user", "content": user_text}
         ]
 
         try:
-            r = self._post_chat(messages, stream=False, temperature=0, timeout=30)
-            r.raise_for_status()
             try:
-                resp = r.json()
-                content = resp.get("message", {}).get("content", "") or r.text
+                content = self._chat_collect(messages, temperature=0, timeout=30, label="planner",
+                                             options={"num_predict": PLANNER_NUM_PREDICT},
+                                             response_format=self.planner_format)
+            except requests.exceptions.HTTPError as e:
+                if e.response is None or e.response.status_code != 400 or not isinstance(self.planner_format, dict):
+                    raise
+                print("[JARVIS][AI] Ollama não aceitou schema em 'format'; usando format=json")
+                self.planner_format = "json"
+                content = self._chat_collect(messages, temperature=0, timeout=30, label="planner",
+                                             options={"num_predict": PLANNER_NUM_PREDICT},
+                                             response_format=self.planner_format)
+            try:
+                data = json.loads(content)
             except Exception:
-                content = r.text
-            data = extract_json(content)
-            if not isinstance(data, dict):
+                data = extract_json(content)
+            plan = validate_plan(data)
+            if plan is None:
+                self.planner_stats["invalid"] += 1
+                print(f"[JARVIS][AI] Plano fora do schema: {content[:200]!r}")
                 return {"action": "chat", "response": content or "Não consegui planejar a ação."}
-            if not data.get("action"):
-                data["action"] = "chat"
-            return data
+            self.planner_stats["valid"] += 1
+            if self.planner_cache is not None:
+                self.planner_cache.put(self.model_for("planner"), user_text, plan)
+            return plan
+        except AIRequestCancelled:
+            raise
         except Exception as e:
+            self.planner_stats["errors"] += 1
             print(f"[JARVIS][AI] Falha no planner: {e}")
             return {"action": "chat", "response": "Não consegui interpretar sua solicitação."}
 
     def decide(self, user_text):
-        self.conversation_history.append({"role": "user", "content": user_text})
+        turn = {"role": "user", "content": user_text}
+        self.conversation_history.append(turn)
 
-        messages = [{"role": "system", "content": JARVIS_PERSONALITY}] + self.conversation_history
+        messages = self._system_messages() + self.conversation_history
 
         try:
-            r = self._post_chat(messages, stream=False, temperature=0.7, timeout=60)
-            r.raise_for_status()
-
-            try:
-                resp = r.json()
-                content = resp.get("message", {}).get("content")
-            except Exception:
-                content = r.text
+            content = self._chat_collect(messages, temperature=0.7, timeout=60, label="decide")
 
             if not content:
                 content = "Resposta vazia do modelo."
 
             self.conversation_history.append({"role": "assistant", "content": content})
+            self._notify_turn(user_text, content)
             self._trim_history()
 
             return {"action": "chat", "response": content}
 
+        except AIRequestCancelled:
+            try:
+                self.conversation_history.remove(turn)
+            except ValueError:
+                pass
+            raise
         except Exception:
             return {
                 "action": "chat",
                 "response": "Não consegui interpretar sua solicitação."
             }
 
-    def stream_chat(self, user_text, on_token, context: str = "", timeout: int = 60):
-        self.conversation_history.append({"role": "user", "content": user_text})
-        
-        system_content = JARVIS_PERSONALITY
+    def stream_chat(self, user_text, on_token, context: str = "", timeout: int = 60) -> str:
+        """
+        Resposta em streaming. Se on_token retornar False o stream é interrompido e o
+        turno não entra no histórico. Retorna o texto gerado.
+        """
+        turn = {"role": "user", "content": user_text}
+        history = list(self.conversation_history)
+        self.conversation_history.append(turn)
+
+        response_text, aborted = self._stream_reply(user_text, on_token, history, context, timeout)
+        if aborted:
+            # Turno interrompido: sai do histórico
+            try:
+                self.conversation_history.remove(turn)
+            except ValueError:
+                pass
+        elif response_text:
+            self.conversation_history.append({"role": "assistant", "content": response_text})
+            self._notify_turn(user_text, response_text)
+
+        self._trim_history()
+        return response_text
+
+    def _stream_reply(self, user_text, on_token, history: List[dict], context: str = "",
+                      timeout: int = 60) -> Tuple[str, bool]:
+        """
+        Faz o stream da resposta sobre history, sem alterar o histórico. Retorna
+        (texto, interrompido); interrompido quando on_token devolveu False ou o
+        job foi cancelado.
+        """
+        # O prompt de sistema é sempre o mesmo para o Ollama reaproveitar o prefixo (KV cache)
+        # entre turnos; as instruções de contexto vão apenas na última mensagem
         user_content = user_text
         if context:
-            system_content += (
-                "\n\nUse o contexto fornecido como base principal para responder."
-                "\nSe o contexto não for suficiente, diga isso de forma direta."
+            user_content = (
+                f"Contexto extraído da Wikipédia:\n{context}\n\n"
+                "Use o contexto acima como base principal para responder. "
+                "Se ele não for suficiente, diga isso de forma direta.\n\n"
+                f"Pergunta do usuário:\n{user_text}"
             )
-            user_content = f"Contexto extraído da Wikipédia:\n{context}\n\nPergunta do usuário:\n{user_text}"
 
-        messages = [{"role": "system", "content": system_content}] + self.conversation_history
-        if context:
-            messages[-1]["content"] = user_content
+        # O contexto vai só na cópia enviada ao modelo: o histórico guarda apenas a pergunta,
+        # nunca o artigo expandido
+        messages = self._system_messages() + history
+        messages.append({"role": "user", "content": user_content})
+
+        # Respostas com contexto de pesquisa usam o papel (e o modelo) "research"
+        role = "research" if context else "chat"
+        response_text = ""
+        aborted = False
+
+        def handle(token):
+            nonlocal response_text, aborted
+            response_text += token
+            if on_token(token) is False:
+                aborted = True
+                return False
+            return True
+
+        try:
+            if self.async_transport is not None:
+                self._stream_async(messages, role, handle, temperature=0.7, timeout=timeout)
+            else:
+                with self._post_chat(messages, stream=True, temperature=0.7, timeout=timeout, label=role) as r:
+                    r.raise_for_status()
+                    for token in self._iter_stream(r, role):
+                        if not handle(token):
+                            break
+        except AIRequestCancelled:
+            aborted = True
+        except Exception as e:
+            on_token(f"\n[Erro IA: {e}]")
+        return response_text, aborted
+
+    def speculative_plan_and_chat(self, user_text, on_plan, on_token, timeout: int = 60) -> dict:
+        """
+        Modo especulativo: dispara o planner e o stream de chat ao mesmo tempo.
+        Os tokens ficam em buffer até o plano sair; on_plan(plan) decide o destino:
+        se retornar True (action=chat) o buffer é descarregado em on_token e o stream
+        continua; caso contrário o stream é abortado na hora (tem escopo de cancelamento
+        próprio, filho do job) e a especulação é contabilizada como desperdiçada.
+        O turno só entra no histórico se o stream terminar sem ser interrompido.
+        Quem chama já tentou quick_plan: aqui o plano vem sempre do modelo.
+        Retorna o plano.
+        """
+        lock = threading.Lock()
+        buffer: List[str] = []
+        decision = {"use": None}
+
+        def buffered_token(token):
+            with lock:
+                if decision["use"] is None:
+                    buffer.append(token)
+                    return True
+                if decision["use"] is False:
+                    return False
+            return on_token(token)
+
+        with self._spec_lock:
+            self.speculative_stats["launched"] += 1
+
+        # Escopo próprio: descartar a especulação aborta só este stream; cancelar o job aborta ambos
+        spec_scope = CancelScope(self.current_cancel_scope())
+        history = list(self.conversation_history)
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="jarvis-spec")
+        stream_future = executor.submit(
+            self._run_in_scope, spec_scope,
+            self._stream_reply, user_text, buffered_token, history, timeout=timeout
+        )
+        executor.shutdown(wait=False)
+
+        t0 = time.perf_counter()
+        plan = self._model_plan(user_text)
+        plan_ms = (time.perf_counter() - t0) * 1000.0
+        use = (plan.get("action") or "chat").lower().strip() == "chat" and on_plan(plan) is not False
+
+        with lock:
+            decision["use"] = use
+            pending = list(buffer)
+            buffer.clear()
+            if use:
+                # Descarrega sob o lock para preservar a ordem com os tokens seguintes
+                for token in pending:
+                    on_token(token)
+
+        with self._spec_lock:
+            self.speculative_stats["plan_ms"] += plan_ms
+            if use:
+                self.speculative_stats["used"] += 1
+            else:
+                self.speculative_stats["wasted"] += 1
+                self.speculative_stats["wasted_tokens"] += len(pending)
+
+        if not use:
+            print(f"[JARVIS][AI] Especulação descartada ({len(pending)} tokens) -> {plan.get('action')}")
+            # Libera o Ollama para a requisição da ação que vem a seguir
+            spec_scope.set()
+            self.cancel_inflight([spec_scope])
+            return plan
+
+        print(f"[JARVIS][AI] Especulação aproveitada ({len(pending)} tokens em buffer, planner {plan_ms:.0f} ms)")
+        response_text, aborted = stream_future.result()
+        if response_text and not aborted and not spec_scope.is_set():
+            self.conversation_history.append({"role": "user", "content": user_text})
+            self.conversation_history.append({"role": "assistant", "content": response_text})
+            self._notify_turn(user_text, response_text)
+            self._trim_history()
+        return plan
+
+    def get_speculative_stats(self) -> dict:
+        with self._spec_lock:
+            stats = dict(self.speculative_stats)
+        decided = stats["used"] + stats["wasted"]
+        stats["waste_rate"] = stats["wasted"] / decided if decided else 0.0
+        stats["avg_plan_ms"] = stats.pop("plan_ms") / decided if decided else 0.0
+        return stats
+
+    def stream_plan_and_chat(self, user_text, on_plan, on_token, timeout: int = 60) -> dict:
+        """
+        Modo fundido: uma única requisição em streaming devolve primeiro o cabeçalho JSON
+        do plano e, para action=chat, a resposta logo em seguida.
+        on_plan(plan) é chamado assim que o cabeçalho é lido; se retornar False o stream
+        é encerrado (a ação fica a cargo do roteador). O restante vai para on_token.
+        Retorna o plano.
+        """
+        messages = (
+            self._system_messages(FUSED_PLANNER_PROMPT)
+            + self.conversation_history
+            + [{"role": "user", "content": user_text}]
+        )
+
+        plan = None
+        header_buffer = ""
+        response_text = ""
+
+        def _resolve(data, rest):
+            nonlocal plan
+            plan = validate_plan(data) or {"action": "chat"}
+            print(f"[JARVIS][AI] Cabeçalho do plano recebido: {plan}")
+            return on_plan(plan) is not False, rest
+
+        with self._post_chat(messages, stream=True, temperature=0.7, timeout=timeout, label="fused") as r:
+            r.raise_for_status()
+            for token in self._iter_stream(r, "fused"):
+                if plan is None:
+                    header_buffer += token
+                    parsed = split_json_header(header_buffer)
+                    if parsed is None and len(header_buffer) <= FUSED_HEADER_MAX_CHARS:
+                        continue
+                    if parsed:
+                        keep_going, token = _resolve(*parsed)
+                        if self.planner_cache is not None:
+                            # O plano veio do modelo do modo fundido, não do planner
+                            self.planner_cache.put(self.model_for("fused"), user_text, plan)
+                    else:
+                        # O modelo ignorou o cabeçalho: trata tudo como resposta de chat
+                        keep_going, token = _resolve({"action": "chat"}, header_buffer)
+                    if not keep_going:
+                        return plan
+                    if not token:
+                        continue
+
+                response_text += token
+                if on_token(token) is False:
+                    # Resposta interrompida: o turno não entra no histórico
+                    return plan
+
+        if plan is None:
+            parsed = split_json_header(header_buffer)
+            keep_going, rest = _resolve(*(parsed or ({"action": "chat"}, header_buffer)))
+            if not keep_going:
+                return plan
+            if rest:
+                response_text += rest
+                on_token(rest)
+
+        if response_text:
+            self.conversation_history.append({"role": "user", "content": user_text})
+            self.conversation_history.append({"role": "assistant", "content": response_text})
+            self._notify_turn(user_text, response_text)
+            self._trim_history()
+        return plan
+
+# =========================
+# AGENDADOR DE TAREFAS DA IA
+# =========================
+class AIJob:
+    """Uma mensagem do usuário aguardando (ou em) processamento pela IA."""
+
+    def __init__(self, text: str, priority: int, seq: int):
+        self.text = text
+        # Chave de deduplicação: texto literal sem diferença de maiúsculas ("2+2" e "2*2"
+        # são pedidos diferentes); vazia nunca deduplica
+        self.key = text.strip().casefold() or f"#{seq}"
+        self.priority = priority
+        self.seq = seq
+        self.cancel_event = threading.Event()
+        self.state = "pending"  # pending, running, done, cancelled, superseded
+        self.submitted_at = time.perf_counter()
+        self.started_at: Optional[float] = None
+
+    def __lt__(self, other: "AIJob") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class AIJobScheduler:
+    """
+    Fila única para todo o trabalho da IA (plan/stream_chat/decide): um pool limitado
+    de workers consome uma PriorityQueue, pedidos idênticos ainda pendentes são
+    deduplicados e, com supersede=True, uma mensagem nova cancela as anteriores.
+    handler(text, cancel_event) roda no worker; on_cancel(jobs) é chamado quando jobs
+    em execução são cancelados (para abortar as requisições deles), com jobs=None
+    quando tudo é cancelado.
+    """
+
+    # Voz passa na frente do que foi digitado: quem fala espera a resposta sem olhar a tela
+    PRIORITY_HIGH = 0
+    PRIORITY_NORMAL = 10
+
+    def __init__(self, handler, workers: int = 1, supersede: bool = False, max_pending: int = 8,
+                 on_cancel=None):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.supersede = supersede
+        self.max_pending = max(1, max_pending)
+        self.on_cancel = on_cancel
+
+        self._queue: "queue.PriorityQueue[AIJob]" = queue.PriorityQueue()
+        self._lock = threading.Lock()
+        self._pending: Dict[str, AIJob] = {}
+        self._running: List[AIJob] = []
+        self._threads: List[threading.Thread] = []
+        self._seq = 0
+        self.stats = {
+            "submitted": 0, "completed": 0, "deduped": 0, "superseded": 0,
+            "cancelled": 0, "rejected": 0, "max_depth": 0,
+            "wait_total_ms": 0.0, "wait_max_ms": 0.0, "started": 0,
+        }
+
+    def _ensure_workers(self):
+        while len(self._threads) < self.workers:
+            t = threading.Thread(target=self._worker, name=f"jarvis-ai-{len(self._threads)}", daemon=True)
+            self._threads.append(t)
+            t.start()
+
+    def submit(self, text: str, priority: int = PRIORITY_NORMAL) -> Optional[AIJob]:
+        """Enfileira uma mensagem. Retorna o job (ou o job idêntico já pendente),
+        ou None se a fila estiver cheia."""
+        superseded_running = []
+        with self._lock:
+            key = text.strip().casefold()
+            existing = self._pending.get(key) if key else None
+            if existing is not None:
+                self.stats["deduped"] += 1
+                print(f"[JARVIS][AI] Pedido idêntico já na fila: '{text}'")
+                return existing
+
+            if self.supersede:
+                for job in list(self._pending.values()):
+                    self._drop_pending(job, "superseded")
+                for job in self._running:
+                    if not job.cancel_event.is_set():
+                        job.cancel_event.set()
+                        job.state = "superseded"
+                        self.stats["superseded"] += 1
+                        superseded_running.append(job)
+            elif len(self._pending) >= self.max_pending:
+                self.stats["rejected"] += 1
+                return None
 
-        response_text = ""
+            self._seq += 1
+            job = AIJob(text, priority, self._seq)
+            self._pending[job.key] = job
+            self.stats["submitted"] += 1
+            self.stats["max_depth"] = max(self.stats["max_depth"], len(self._pending))
+            self._ensure_workers()
+
+        if superseded_running:
+            print(f"[JARVIS][AI] Resposta anterior substituída por: '{text}'")
+            self._notify_cancel(superseded_running)
+        self._queue.put(job)
+        return job
+
+    def _drop_pending(self, job: AIJob, state: str):
+        # Chamado com _lock; o job continua na PriorityQueue e é descartado pelo worker
+        job.cancel_event.set()
+        job.state = state
+        self._pending.pop(job.key, None)
+        self.stats["superseded" if state == "superseded" else "cancelled"] += 1
+
+    def cancel_all(self) -> int:
+        """Cancela os jobs pendentes e os em execução. Retorna quantos foram cancelados."""
+        with self._lock:
+            jobs = list(self._pending.values())
+            for job in jobs:
+                self._drop_pending(job, "cancelled")
+            running = [job for job in self._running if not job.cancel_event.is_set()]
+            for job in running:
+                job.cancel_event.set()
+                job.state = "cancelled"
+                self.stats["cancelled"] += 1
+        # Mesmo sem job registrado, aborta o que estiver aberto no Ollama
+        self._notify_cancel(None)
+        return len(jobs) + len(running)
+
+    def _notify_cancel(self, jobs: Optional[List[AIJob]]):
+        if self.on_cancel is None:
+            return
         try:
-            with self._post_chat(messages, stream=True, temperature=0.7, timeout=timeout) as r:
-                r.raise_for_status()
-                for line in r.iter_lines():
-                    if not line:
-                        continue
-                    try:
-                        token = json.loads(line).get("message", {}).get("content", "")
-                    except Exception:
-                        token = ""
-                    if token:
-                        response_text += token
-                        on_token(token)
+            self.on_cancel(jobs)
         except Exception as e:
-            on_token(f"\n[Erro IA: {e}]")
-        if response_text:
-            self.conversation_history.append({"role": "assistant", "content": response_text})
+            print(f"[JARVIS][AI] Erro ao cancelar job: {e}")
 
-        self._trim_history()
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            with self._lock:
+                if job.cancel_event.is_set() or self._pending.get(job.key) is not job:
+                    continue
+                self._pending.pop(job.key, None)
+                job.state = "running"
+                job.started_at = time.perf_counter()
+                wait_ms = (job.started_at - job.submitted_at) * 1000.0
+                self.stats["started"] += 1
+                self.stats["wait_total_ms"] += wait_ms
+                self.stats["wait_max_ms"] = max(self.stats["wait_max_ms"], wait_ms)
+                self._running.append(job)
+            if wait_ms >= 50:
+                print(f"[JARVIS][AI] Job aguardou {wait_ms:.0f} ms na fila: '{job.text}'")
+            try:
+                self.handler(job.text, job.cancel_event)
+            except Exception as e:
+                print(f"[JARVIS][AI] Erro no job '{job.text}': {type(e).__name__}: {e}")
+            finally:
+                with self._lock:
+                    if job in self._running:
+                        self._running.remove(job)
+                    if job.state == "running":
+                        job.state = "done"
+                        self.stats["completed"] += 1
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["queue_depth"] = len(self._pending)
+            stats["running"] = len(self._running)
+        started = stats.pop("started")
+        stats["avg_wait_ms"] = stats.pop("wait_total_ms") / started if started else 0.0
+        stats["workers"] = self.workers
+        stats["supersede"] = self.supersede
+        return stats
 
 # =========================
 # COMMAND ROUTER (MODIFICADO PARA ADDONS)
@@ -1045,10 +4110,13 @@ class CommandRouter:
         '.mp3', '.wav', '.ogg', '.flac',                           # áudio
         '.mp4', '.avi', '.mkv', '.mov',                            # vídeo
     }
+    # Validade da lista de apps/atalhos conhecidos usada pelo classificador local
+    KNOWN_TARGETS_TTL = 60.0
     
     def __init__(self, app):
         self.app = app
         self.addon_manager = app.addon_manager
+        self._known_targets = None  # (horário, nomes normalizados)
 
     def handle_direct(self, text: str) -> bool:
         if not is_safe_command(text):
@@ -1101,6 +4169,12 @@ class CommandRouter:
             self.app.clear()
         elif cmd == "ajuda" or cmd == "help" or cmd == "?":
             self._helpcmd(cmd)
+        elif cmd == "estatisticas" or cmd == "estatísticas" or cmd == "stats":
+            self._stats()
+        elif cmd == "conversas" or cmd.startswith("conversas "):
+            self.app.show_conversations(orig[10:])
+        elif cmd == "historico" or cmd == "histórico" or cmd.startswith("historico ") or cmd.startswith("histórico "):
+            self.app.search_transcript(orig.split(" ", 1)[1] if " " in orig else "")
         else:
             self.app.say("Comando direto não reconhecido.")
 
@@ -1145,6 +4219,9 @@ class CommandRouter:
             "  /limpar ou /cls - Limpa o chat\n"
             "  /ytvideo [consulta] - Pesquisa avançada de vídeos no YouTube\n"
             "  /cancelar ou /parar - Cancela a resposta da IA\n"
+            "  /estatisticas - Mostra métricas de desempenho da IA\n"
+            "  /historico [termo] - Busca no histórico completo do chat\n"
+            "  /conversas [termo] - Lista as sessões salvas ou busca em todas elas\n"
             "  '/' só é necessário caso modelo IA esteja ativo.\n"
         )
 
@@ -1156,9 +4233,203 @@ class CommandRouter:
 
         self.app.say(help_text)
 
+    def _stats(self):
+        models = self.app.ai.models
+        lines = ["Modelos por papel: " + ", ".join(f"{role}={models[role]}" for role in self.app.ai.MODEL_ROLES)]
+        lines.append("Latência das requisições ao Ollama (sessão persistente):")
+        stats = self.app.ai.get_request_stats()
+        if not stats:
+            lines.append("  Nenhuma requisição registrada ainda.")
+        for label, item in sorted(stats.items()):
+            lines.append(
+                f"  {label}: {int(item['count'])}x, média {item['avg_ms']:.0f} ms, "
+                f"última {item['last_ms']:.0f} ms, mín {item['min_ms']:.0f} ms, "
+                f"máx {item['max_ms']:.0f} ms, erros {int(item['errors'])}"
+            )
+
+        classifier = self.app.ai.intent_classifier
+        if classifier is not None:
+            cs = classifier.get_stats()
+            lines.append(
+                f"Classificador local: {cs['hits']}/{cs['total']} resolvidos localmente "
+                f"({cs['hit_rate'] * 100:.0f}%), confiança média {cs['avg_hit_confidence']:.2f} "
+                f"nos acertos e {cs['avg_miss_confidence']:.2f} nos repasses ao LLM "
+                f"(limiar {cs['threshold']:.2f})"
+            )
+            if cs["by_action"]:
+                detail = ", ".join(f"{k}={v}" for k, v in sorted(cs["by_action"].items()))
+                lines.append(f"  por ação: {detail}")
+
+        ai = self.app.ai
+        ps = ai.planner_stats
+        lines.append(
+            f"Planner (saída estruturada, format={'schema' if isinstance(ai.planner_format, dict) else ai.planner_format}): "
+            f"{ps['valid']} planos válidos, {ps['invalid']} fora do schema, {ps['errors']} falhas"
+        )
+
+        kp = self.app.knowledge_provider
+        if kp is not None and getattr(kp, "cache", None) is not None:
+            rs = kp.cache.get_stats()
+            lines.append(
+                f"Cache de pesquisa: {rs['entries']} páginas, {rs['bytes'] / 1048576:.1f}/{rs['max_bytes'] / 1048576:.0f} MB | "
+                f"{rs['hits']} hits, {rs['negative_hits']} negativos, {rs['revalidated']}/{rs['stale']} revalidados, "
+                f"{rs['misses']} misses ({rs['hit_rate']:.0%}) | {rs['evictions']} removidas"
+            )
+            cs = kp.coalesce_stats
+            if cs["coalesced"]:
+                lines.append(f"Pesquisas coalescidas: {cs['coalesced']} de {cs['lookups']} aguardaram uma busca já em andamento")
+
+        if kp is not None and getattr(kp, "research_stats", None) is not None:
+            fs = kp.get_research_stats()
+            if fs["lookups"]:
+                lines.append(
+                    f"Pesquisa paralela ({kp.research_fanout} candidatos, orçamento {kp.research_budget * 1000:.0f} ms): "
+                    f"{fs['lookups']} buscas, média {fs['avg_ms']:.0f} ms até o contexto | "
+                    f"{fs['late']} páginas fora do prazo, {fs['backfilled']} guardadas no cache"
+                )
+
+        if kp is not None and getattr(kp, "source_stats", None):
+            parts = []
+            for name, st in kp.source_stats.items():
+                calls = st["hits"] + st["misses"] + st["errors"]
+                avg = st["total_ms"] / calls if calls else 0.0
+                parts.append(f"{name} {st['hits']}/{calls} (média {avg:.0f} ms, {st['errors']} erros)")
+            lines.append("Fontes diretas: " + ", ".join(parts))
+            ss = kp.stream_stats
+            if ss["streams"]:
+                lines.append(
+                    f"Leitura em streaming: {ss['streams']} artigos, {ss['early_stops']} interrompidos cedo "
+                    f"({ss['intro_only']} só com a introdução, {ss['completed_later']} completados em background), "
+                    f"{ss['chars_read'] / 1024:.0f} KB lidos"
+                )
+
+        if kp is not None and getattr(kp, "index", None) is not None:
+            vs = kp.index.get_stats()
+            lines.append(
+                f"Índice local: {vs['documents']} páginas, {vs['chunks']} trechos ({vs['bytes'] / 1048576:.1f} MB) | "
+                f"{vs['sufficient']}/{vs['queries']} pesquisas respondidas sem rede (limiar {kp.index_threshold:.2f})"
+            )
+
+        us = self.app.ui_stream_stats
+        if us["streams"]:
+            ui_ms_per_s = us["ui_ms"] / us["stream_s"] if us["stream_s"] else 0.0
+            mode = f"lotes a cada {self.app.token_buffer.interval_ms} ms" if self.app.token_buffer else "um insert por token"
+            lines.append(
+                f"Chat ({mode}): {us['tokens']} tokens em {us['inserts']} inserts, "
+                f"{ui_ms_per_s:.1f} ms de UI por segundo de streaming"
+            )
+
+        qs = self.app.ai_scheduler.get_stats()
+        lines.append(
+            f"Fila da IA: {qs['queue_depth']} pendentes (máx {qs['max_depth']}), {qs['running']} em execução, "
+            f"{qs['workers']} worker(s){', substituição ativa' if qs['supersede'] else ''} | "
+            f"espera média {qs['avg_wait_ms']:.0f} ms (máx {qs['wait_max_ms']:.0f} ms) | "
+            f"{qs['deduped']} duplicadas, {qs['superseded']} substituídas, "
+            f"{qs['cancelled']} canceladas, {qs['rejected']} recusadas"
+        )
+
+        if ai.async_transport is not None:
+            ts = ai.async_transport.get_stats()
+            lines.append(
+                f"Transporte asyncio: {ts['streams']} streams, {ts['batches']} lotes "
+                f"({ts['avg_batch']:.1f} tokens/lote), backpressure acionado {ts['backpressure']}x"
+            )
+
+        if ai.cancel_stats["cancels"]:
+            lines.append(
+                f"Cancelamentos: {ai.cancel_stats['cancels']} "
+                f"({ai.cancel_stats['aborted']} streams do Ollama encerrados)"
+            )
+
+        if ai.speculative_mode:
+            ss = ai.get_speculative_stats()
+            lines.append(
+                f"Especulação: {ss['launched']} disparadas, {ss['used']} aproveitadas, "
+                f"{ss['wasted']} descartadas ({ss['waste_rate']:.0%}, {ss['wasted_tokens']} tokens), "
+                f"planner médio {ss['avg_plan_ms']:.0f} ms"
+            )
+
+        ollama_stats = ai.get_ollama_stats()
+        if ollama_stats:
+            lines.append("Avaliação no Ollama (médias por turno):")
+            for label, agg in sorted(ollama_stats.items()):
+                turns = max(1, agg["turns"])
+                rate = agg["eval_tokens"] / (agg["eval_ms"] / 1000.0) if agg["eval_ms"] else 0.0
+                lines.append(
+                    f"  {label}: prompt {agg['prompt_tokens'] / turns:.0f} tok em {agg['prompt_ms'] / turns:.0f} ms, "
+                    f"geração {agg['eval_tokens'] / turns:.0f} tok em {agg['eval_ms'] / turns:.0f} ms "
+                    f"({rate:.1f} tok/s), carga {agg['load_ms'] / turns:.0f} ms"
+                )
+
+        ws = ai.warmup_stats
+        lines.append(
+            f"Pré-carregamento: {ws['requested']} pedidos, {ws['loaded']} cargas, "
+            f"{ws['resident']} já residentes, {ws['debounced']} ignorados, {ws['errors']} erros"
+        )
+
+        lines.append(
+            f"Histórico: {len(ai.conversation_history)} mensagens, "
+            f"~{estimate_message_tokens(ai.conversation_history)}/{ai.history_budget()} tokens, "
+            f"{ai.history_stats['evicted']} removidas, {ai.history_stats['summaries']} resumos"
+        )
+
+        cache = self.app.ai.planner_cache
+        if cache is not None:
+            ps = cache.get_stats()
+            lines.append(
+                f"Cache do planejador: {ps['hits']} hits, {ps['misses']} misses "
+                f"({ps['hit_rate'] * 100:.0f}%), {ps['size']}/{ps['max_entries']} planos, "
+                f"{ps['expired']} expirados, {ps['evictions']} removidos por LRU"
+            )
+
+        self.app.say("\n".join(lines))
+
     def _normalize(self, value: str) -> str:
         return _normalize_for_match(value)
 
+    def _known_target_names(self) -> set:
+        """Nomes normalizados do apps.json e dos atalhos/executáveis da área de trabalho,
+        mais cada palavra dos nomes compostos ("Google Chrome" -> "chrome"); cache de 60 s."""
+        if self._known_targets is not None and time.monotonic() - self._known_targets[0] < self.KNOWN_TARGETS_TTL:
+            return self._known_targets[1]
+
+        try:
+            with open(os.path.join(os.path.dirname(__file__), "apps.json"), "r", encoding="utf-8") as f:
+                apps = json.load(f)
+            raw_names = list(apps.keys() if isinstance(apps, dict) else [a.get("name", "") for a in apps])
+        except Exception:
+            raw_names = []
+
+        for desktop in self._candidate_desktop_dirs():
+            for root, dirs, files in os.walk(desktop):
+                rel = os.path.relpath(root, desktop)
+                if rel != "." and rel.count(os.sep) + 1 > 2:
+                    dirs[:] = []
+                    continue
+                for entry in files:
+                    if os.path.splitext(entry)[1].lower() in (".lnk", ".exe"):
+                        raw_names.extend(self._entry_display_names(os.path.join(root, entry)))
+
+        names = set()
+        for name in raw_names:
+            names.add(self._normalize(name))
+            words = [self._normalize(w) for w in re.split(r"[\W_]+", name)]
+            if len(words) > 1:
+                names.update(w for w in words if len(w) >= 4)
+        names.discard("")
+        self._known_targets = (time.monotonic(), names)
+        return names
+
+    def is_known_target(self, target: str) -> bool:
+        """True se o alvo corresponde (exato ou quase) a um app do apps.json ou atalho da área de trabalho."""
+        target_norm = self._normalize(target)
+        if not target_norm:
+            return False
+        names = self._known_target_names()
+        if target_norm in names:
+            return True
+        return any(difflib.SequenceMatcher(None, target_norm, name).ratio() >= 0.85 for name in names)
+
     def _candidate_desktop_dirs(self):
         home = os.path.expanduser("~")
         candidates = [
@@ -1674,9 +4945,7 @@ class CommandRouter:
                 self.app.say(f"Abrindo primeiro vídeo: {q}")
                 return
 
-            chat = self.app.chat
-            chat.config(state="normal")
-            chat.insert("end", f"Jarvis > Resultados para: {q}\n")
+            self.app._chat_insert(f"Jarvis > Resultados para: {q}\n")
             for i, vid in enumerate(ids, start=1):
                 video_url = f"https://www.youtube.com/watch?v={vid}"
                 title = vid
@@ -1688,17 +4957,9 @@ class CommandRouter:
                 except Exception:
                     pass
 
-                tag = f"yt_{vid}"
-                start_idx = chat.index("end-1c")
-                chat.insert("end", f"{i}- {title}\n")
-                end_idx = chat.index("end-1c")
-                chat.tag_add(tag, start_idx, end_idx)
-                chat.tag_config(tag, foreground=FG_COLOR, underline=True)
-                chat.tag_bind(tag, "<Button-1>", lambda e, u=video_url: webbrowser.open(u))
-
-            chat.insert("end", "Jarvis > Clique no vídeo que desejar.\n")
-            chat.see("end")
-            chat.config(state="disabled")
+                self.app._chat_insert(f"{i}- {title}\n", url=video_url)
+
+            self.app._chat_insert("Jarvis > Clique no vídeo que desejar.\n")
         except Exception as e:
             self.app.say(f"Erro ao buscar vídeo: {e}")
 
@@ -1749,6 +5010,318 @@ class CommandRouter:
         except Exception as e:
             self.app.say(f"Erro ao digitar: {e}")
 
+# =========================
+# BUFFER DE TOKENS (UI)
+# =========================
+class TokenBuffer:
+    """
+    Acumula os tokens que chegam das threads da IA e os entrega ao chat em lotes:
+    no máximo um insert a cada interval_ms, sempre na thread do Tk. Cada token guarda
+    o cancel_event do job que o gerou; os de jobs cancelados não são exibidos.
+    """
+
+    def __init__(self, root, sink, interval_ms: int = 40):
+        self.root = root
+        self.sink = sink
+        self.interval_ms = max(1, interval_ms)
+        self._parts: List[Tuple[str, Optional[threading.Event]]] = []
+        self._lock = threading.Lock()
+        self._scheduled = False
+
+    def pending(self) -> int:
+        """Tokens aguardando o próximo flush (usado como backlog pelo transporte)."""
+        with self._lock:
+            return len(self._parts)
+
+    def push(self, token: str, cancel_event: Optional[threading.Event] = None) -> bool:
+        """Chamado de qualquer thread. Retorna False (e descarta o token) se o job foi cancelado."""
+        if cancel_event is not None and cancel_event.is_set():
+            return False
+        with self._lock:
+            self._parts.append((token, cancel_event))
+            if self._scheduled:
+                return True
+            self._scheduled = True
+        try:
+            self.root.after(self.interval_ms, self.flush)
+        except Exception:
+            with self._lock:
+                self._scheduled = False
+        return True
+
+    def flush(self):
+        """Entrega o que estiver acumulado (thread do Tk), sem os tokens de jobs
+        cancelados depois de entrarem no buffer."""
+        with self._lock:
+            text = "".join(token for token, event in self._parts if event is None or not event.is_set())
+            self._parts.clear()
+            self._scheduled = False
+        if text:
+            self.sink(text)
+
+    def clear(self):
+        """Descarta os tokens ainda não exibidos (cancelamento)."""
+        with self._lock:
+            self._parts.clear()
+
+
+# =========================
+# TRANSCRIPT DO CHAT
+# =========================
+class TranscriptStore:
+    """
+    Histórico completo do chat, linha a linha. O widget só mantém as últimas linhas;
+    o restante fica aqui para ser recarregado ao rolar para cima e para a busca do
+    /historico. Índices são globais (não mudam quando linhas antigas são descartadas).
+    """
+
+    def __init__(self, max_lines: int = 20000):
+        self.max_lines = max(100, max_lines)
+        self.offset = 0             # índice global da primeira linha guardada
+        self.lines: List[str] = []  # linhas completas
+        self.partial = ""           # linha em aberto (sempre existe, como a última linha do Text)
+        self.links: Dict[int, str] = {}
+        self.hidden: set = set()    # linhas fora da busca (ex.: resultados do próprio /historico)
+
+    def line_count(self) -> int:
+        """Total de linhas, contando a linha em aberto."""
+        return self.offset + len(self.lines) + 1
+
+    def append(self, text: str, url: Optional[str] = None, searchable: bool = True):
+        first = self.line_count() - 1
+        if url:
+            self.links[first] = url
+        pieces = text.split("\n")
+        pieces[0] = self.partial + pieces[0]
+        self.lines.extend(pieces[:-1])
+        self.partial = pieces[-1]
+        if not searchable:
+            self.hidden.update(range(first, self.line_count()))
+        self._drop_old()
+
+    def _drop_old(self):
+        excess = len(self.lines) - self.max_lines
+        if excess <= 0:
+            return
+        del self.lines[:excess]
+        self.offset += excess
+        self.links = {i: u for i, u in self.links.items() if i >= self.offset}
+        self.hidden = {i for i in self.hidden if i >= self.offset}
+
+    def get_line(self, index: int) -> str:
+        if index == self.line_count() - 1:
+            return self.partial
+        return self.lines[index - self.offset]
+
+    def get_lines(self, start: int, end: int) -> List[str]:
+        """Linhas completas no intervalo global [start, end)."""
+        start = max(start, self.offset)
+        end = min(end, self.offset + len(self.lines))
+        return self.lines[start - self.offset:end - self.offset]
+
+    def search(self, term: str, limit: int = 20) -> List[tuple]:
+        """Linhas que contêm term (sem diferenciar acentos/maiúsculas), das mais recentes
+        para as mais antigas. Retorna [(índice, linha)]; termos sem letras nem
+        números não casam com nada."""
+        needle = _normalize_for_search(term)
+        if not needle:
+            return []
+        results = []
+        total = len(self.lines)
+        for pos in range(total - 1, -1, -1):
+            index = self.offset + pos
+            if index in self.hidden:
+                continue
+            line = self.lines[pos]
+            if needle in _normalize_for_search(line):
+                results.append((index, line))
+                if len(results) >= limit:
+                    break
+        return results
+
+
+# =========================
+# HISTÓRICO DE CONVERSAS (SQLITE)
+# =========================
+CONVERSATION_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "conversations.db")
+
+
+class ConversationStore:
+    """
+    Conversas persistidas em SQLite (append-only), indexadas por sessão e horário, com
+    busca full-text (FTS5 quando disponível, LIKE caso contrário). As escritas vão para
+    uma thread dedicada, então append() nunca bloqueia a UI. Cada execução do JARVIS
+    (ou cada "limpar") abre uma sessão nova, criada só quando a primeira mensagem chega.
+    """
+
+    def __init__(self, path: str = CONVERSATION_DB_PATH):
+        self.path = path
+        self.fts = False
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._session_id: Optional[int] = None
+        conn = self._connect()
+        try:
+            self._create_schema(conn)
+        finally:
+            conn.close()
+        self._writer = threading.Thread(target=self._write_loop, name="jarvis-conversations", daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _create_schema(self, conn):
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                started_at REAL NOT NULL,
+                ended_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id INTEGER NOT NULL REFERENCES sessions(id),
+                ts REAL NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_session_ts ON messages(session_id, ts);
+            CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages(ts);
+        """)
+        try:
+            conn.executescript("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+                    USING fts5(content, content='messages', content_rowid='id');
+                CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+                    INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+                END;
+            """)
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            print(f"[JARVIS][CONVERSAS] FTS5 indisponível, busca usará LIKE: {e}")
+        conn.commit()
+
+    # -- escrita (thread dedicada) --
+    def append(self, role: str, content: str):
+        if content:
+            self._queue.put(("message", time.time(), role, content))
+
+    def append_turn(self, user_text: str, assistant_text: str):
+        self.append("user", user_text)
+        self.append("assistant", assistant_text)
+
+    def new_session(self):
+        """Encerra a sessão atual; a próxima mensagem abre outra."""
+        self._queue.put(("new_session", time.time()))
+
+    def close(self, timeout: float = 2.0):
+        self._queue.put(None)
+        self._writer.join(timeout)
+
+    def _write_loop(self):
+        conn = self._connect()
+        try:
+            while True:
+                item = self._queue.get()
+                batch = [item]
+                # Agrupa o que já estiver na fila em uma única transação
+                while item is not None and not self._queue.empty() and len(batch) < 200:
+                    item = self._queue.get_nowait()
+                    batch.append(item)
+                try:
+                    for entry in batch:
+                        if entry is not None:
+                            self._write(conn, entry)
+                    conn.commit()
+                except Exception as e:
+                    print(f"[JARVIS][CONVERSAS] Falha ao gravar: {e}")
+                if batch[-1] is None:
+                    return
+        finally:
+            conn.close()
+
+    def _write(self, conn, entry: tuple):
+        kind, ts = entry[0], entry[1]
+        if kind == "new_session":
+            if self._session_id is not None:
+                conn.execute("UPDATE sessions SET ended_at = ? WHERE id = ?", (ts, self._session_id))
+            self._session_id = None
+            return
+        if self._session_id is None:
+            self._session_id = conn.execute("INSERT INTO sessions (started_at) VALUES (?)", (ts,)).lastrowid
+        conn.execute(
+            "INSERT INTO messages (session_id, ts, role, content) VALUES (?, ?, ?, ?)",
+            (self._session_id, ts, entry[2], entry[3]),
+        )
+        conn.execute("UPDATE sessions SET ended_at = ? WHERE id = ?", (ts, self._session_id))
+
+    # -- leitura (conexão própria, em qualquer thread) --
+    def last_session(self, limit: int = 20) -> tuple:
+        """Últimas mensagens da sessão mais recente com mensagens.
+        Retorna (info da sessão ou None, [{"role", "content", "ts"}])."""
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT id, started_at, ended_at FROM sessions "
+                "WHERE EXISTS (SELECT 1 FROM messages WHERE session_id = sessions.id) "
+                "ORDER BY id DESC LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None, []
+            rows = conn.execute(
+                "SELECT role, content, ts FROM messages WHERE session_id = ? ORDER BY ts DESC, id DESC LIMIT ?",
+                (row[0], limit),
+            ).fetchall()
+        finally:
+            conn.close()
+        messages = [{"role": r, "content": c, "ts": ts} for r, c, ts in reversed(rows)]
+        # O corte pelo limite pode começar no meio de um turno
+        while messages and messages[0]["role"] != "user":
+            messages.pop(0)
+        return {"id": row[0], "started_at": row[1], "ended_at": row[2]}, messages
+
+    def recent_sessions(self, limit: int = 10) -> List[dict]:
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT s.id, s.started_at, COUNT(m.id), "
+                "(SELECT content FROM messages WHERE session_id = s.id AND role = 'user' ORDER BY id LIMIT 1) "
+                "FROM sessions s JOIN messages m ON m.session_id = s.id "
+                "GROUP BY s.id ORDER BY s.id DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        finally:
+            conn.close()
+        return [{"id": r[0], "started_at": r[1], "count": r[2], "title": r[3] or ""} for r in rows]
+
+    def search(self, term: str, limit: int = 20) -> List[dict]:
+        """Busca em todas as sessões; mais recentes primeiro."""
+        words = [w for w in re.findall(r"\w+", term, flags=re.UNICODE)]
+        if not words:
+            return []
+        conn = self._connect()
+        try:
+            if self.fts:
+                query = " ".join(f'"{w}"' for w in words)
+                rows = conn.execute(
+                    "SELECT m.session_id, m.ts, m.role, m.content FROM messages_fts f "
+                    "JOIN messages m ON m.id = f.rowid WHERE messages_fts MATCH ? "
+                    "ORDER BY m.ts DESC LIMIT ?",
+                    (query, limit),
+                ).fetchall()
+            else:
+                clause = " AND ".join("content LIKE ?" for _ in words)
+                rows = conn.execute(
+                    f"SELECT session_id, ts, role, content FROM messages WHERE {clause} ORDER BY ts DESC LIMIT ?",
+                    (*[f"%{w}%" for w in words], limit),
+                ).fetchall()
+        finally:
+            conn.close()
+        return [{"session_id": r[0], "ts": r[1], "role": r[2], "content": r[3]} for r in rows]
+
+
 # =========================
 # GUI (MODIFICADA PARA ADDONS)
 # =========================
@@ -1762,7 +5335,29 @@ class JarvisApp:
         self.addon_manager.execute_hooks('pre_init')
         
         self.ai = AIEngine()
-        self.knowledge_provider = BrowserKnowledgeProvider()
+
+        # Conversas persistidas; a última sessão é restaurada depois que a janela abre
+        self.conversation_store: Optional[ConversationStore] = None
+        db_path = os.getenv("JARVIS_CONVERSATION_DB", CONVERSATION_DB_PATH).strip()
+        if db_path and db_path != "0":
+            try:
+                self.conversation_store = ConversationStore(db_path)
+                self.ai.on_turn = self.conversation_store.append_turn
+            except Exception as e:
+                print(f"[JARVIS][CONVERSAS] Banco de conversas indisponível: {e}")
+        self._user_sent_message = False
+        # Todo o trabalho da IA passa por uma fila com workers limitados
+        self.ai_scheduler = AIJobScheduler(
+            self._handle_ai,
+            workers=int(os.getenv("JARVIS_AI_WORKERS", "1")),
+            supersede=os.getenv("JARVIS_AI_SUPERSEDE", "0").strip().lower() in ("1", "true", "sim", "yes"),
+            max_pending=int(os.getenv("JARVIS_AI_QUEUE_MAX", "8")),
+            on_cancel=self._abort_ai_stream,
+        )
+        if self.ai.embed_model:
+            self.knowledge_provider = BrowserKnowledgeProvider(self.ai.embed, f"ollama:{self.ai.embed_model}")
+        else:
+            self.knowledge_provider = BrowserKnowledgeProvider()
         self.router = None  # Será inicializado depois
         
         # Inicializa sistema de voz
@@ -1771,24 +5366,41 @@ class JarvisApp:
             self.voice_system = VoiceSystem(self)
 
         # CRÍTICO: Salvar se a IA estava disponível NO INÍCIO
-        self._ai_initially_available = self.ai.available
+        # (definido de fato em _on_ai_probe_done, quando a verificação em background termina)
+        self._ai_initially_available = False
         
-        # Intervalo de checagem de presença
-        self._presence_interval = 60 if not self.ai.available else 1
+        # Intervalo de checagem de presença (ajustado quando a verificação terminar)
+        self._presence_interval = 1
         self._paused = False
         self._presence_job = None
         
         # Flag para controlar cancelamento da IA
         self._ai_cancelled = False
+        self._response_open = False
         self._current_ai_thread = None
         
         # Flag para controlar se a IA está pensando
         self._ai_thinking = False
 
-        print(f"[JARVIS][AI] inicializado. available={self.ai.available}, initially_available={self._ai_initially_available}")
-
         self.root = tk.Tk()
         self.root.title(APP_NAME)
+
+        # Tokens do stream vão para o chat em lotes; JARVIS_TOKEN_FLUSH_MS=0 volta ao insert por token
+        flush_ms = int(os.getenv("JARVIS_TOKEN_FLUSH_MS", "40"))
+        self.token_buffer = TokenBuffer(self.root, self.append_response_token, flush_ms) if flush_ms > 0 else None
+        self.ui_stream_stats = {"streams": 0, "tokens": 0, "inserts": 0, "ui_ms": 0.0, "stream_s": 0.0}
+        self._stream_started_at: Optional[float] = None
+        # Tokens agendados no Tk (sem TokenBuffer) e ainda não exibidos: backlog para o transporte
+        self._ui_pending_tokens = 0
+        self._ui_pending_lock = threading.Lock()
+        self.ai.ui_backlog = self.ui_backlog
+
+        # O widget do chat guarda só as últimas linhas; o histórico completo fica no transcript
+        self.transcript = TranscriptStore(int(os.getenv("JARVIS_TRANSCRIPT_MAX_LINES", "20000")))
+        self.chat_max_lines = max(50, int(os.getenv("JARVIS_CHAT_MAX_LINES", "400")))
+        self._chat_first_line = 0  # índice no transcript da primeira linha do widget
+        self._chat_floor = 0       # "limpar" não deixa recarregar linhas anteriores a este ponto
+        self._loading_older = False
         self.root.geometry("560x380")
         self.root.configure(bg=BG_COLOR)
 
@@ -1800,28 +5412,6 @@ class JarvisApp:
             pass
         
         
-        def research_with_context(self, query: str) -> str:
-            if not self.browser:
-                return ""
-
-            search_term = f"{query.strip()} wikipedia"
-            try:
-                results = self.browser.search(search_term, language="pt-BR")
-                if not results:
-                    return ""
-
-                # prioriza resultado da Wikipédia
-                selected = next(
-                    (r for r in results if "wikipedia.org" in r.url.lower()),
-                    results[0]
-                )
-
-                text = self.browser.export_text(selected.url)
-                return text.strip()
-            except Exception as e:
-                print(f"[JARVIS] Erro ao pesquisar com PYbrowser: {e}")
-                return ""
-        
         # minimize -> send to system tray (pystray) or fallback to iconify
         def _quit_from_tray():
             try:
@@ -2374,7 +5964,7 @@ class JarvisApp:
 
         # instantiate custom scrollbar and wire it to the Text widget
         self._chat_scroll = CustomScrollbar(self._chat_frame, command=self.chat.yview, width=10, track="#071025", thumb=FG_COLOR)
-        self.chat.config(yscrollcommand=self._chat_scroll.set)
+        self.chat.config(yscrollcommand=self._on_chat_yscroll)
         # pack inside the frame so the create_window placement still works
         self._chat_scroll.pack(side="right", fill="y", padx=(6,0))
         self.chat.pack(side="left", fill="both", expand=True)
@@ -2447,12 +6037,16 @@ class JarvisApp:
 
         # keep previous bindings/behavior
         self.entry.bind("<Return>", self.send)
+        # Começar a digitar já aquece o modelo no Ollama
+        self.entry.bind("<Key>", lambda e: self.warm_up_ai("digitação"), add="+")
         
         self.tts = TTSEngine()
         self.tts.start()
         
         # AGORA inicializa o router (depois que a interface foi construída)
         self.router = CommandRouter(self)
+        if self.ai.intent_classifier is not None:
+            self.ai.intent_classifier.target_lookup = self.router.is_known_target
         
         # AGORA carrega os addons (depois que a interface foi completamente construída)
         self.addon_manager.load_all_addons()
@@ -2460,8 +6054,96 @@ class JarvisApp:
         # Executa hooks de pós-inicialização
         self.addon_manager.execute_hooks('post_init')
 
+        self._tts_buffer = ""
+
+        # Verifica o Ollama em background: a janela aparece imediatamente e
+        # as mensagens iniciais são exibidas quando a verificação termina
+        try:
+            self.status_label.config(text="Conectando à IA...")
+        except Exception:
+            pass
+        self.ai.start_probe(lambda available: self.root.after(0, self._on_ai_probe_done, available))
+
+        if self.conversation_store is not None:
+            threading.Thread(target=self._load_last_session, daemon=True).start()
+
+    def _load_last_session(self):
+        """Lê a última sessão em background (a janela já está aberta)."""
+        try:
+            limit = int(os.getenv("JARVIS_RESTORE_MESSAGES", "20"))
+            if limit <= 0:
+                return
+            info, messages = self.conversation_store.last_session(limit)
+        except Exception as e:
+            print(f"[JARVIS][CONVERSAS] Falha ao restaurar a última sessão: {e}")
+            return
+        if messages:
+            self.root.after(0, self._apply_last_session, info, messages)
+
+    def _apply_last_session(self, info, messages):
+        self.ai.restore_history(messages)
+        print(f"[JARVIS][CONVERSAS] {len(messages)} mensagens da sessão {info['id']} restauradas")
+        # Se o usuário já começou a conversar, a sessão anterior vale só como contexto da IA
+        if self._user_sent_message:
+            return
+        started = time.strftime("%d/%m %H:%M", time.localtime(info["started_at"]))
+        self._chat_insert(f"Jarvis > Conversa anterior ({started}):\n", searchable=False)
+        for m in messages:
+            prefix = "Você" if m["role"] == "user" else "Jarvis"
+            self._chat_insert(f"{prefix} > {m['content']}\n", see=False)
+        self._chat_insert("Jarvis > Fim da conversa anterior. Use /conversas [termo] para buscar outras.\n",
+                          searchable=False)
+
+    def show_conversations(self, term: str = ""):
+        """Lista as sessões recentes ou busca em todas as conversas salvas (/conversas)."""
+        if self.conversation_store is None:
+            self.say("O histórico de conversas está desativado.")
+            return
+        term = term.strip()
+        try:
+            if term:
+                results = self.conversation_store.search(term)
+            else:
+                results = self.conversation_store.recent_sessions()
+        except Exception as e:
+            self.say(f"Erro ao consultar conversas: {e}")
+            return
+        if not results:
+            self.say(f"Nenhuma conversa encontrada para: {term}" if term else "Nenhuma conversa salva ainda.")
+            return
+
+        if term:
+            lines = [f"Conversas com '{term}' ({len(results)}, mais recentes primeiro):"]
+            for r in results:
+                when = time.strftime("%d/%m/%Y %H:%M", time.localtime(r["ts"]))
+                who = "Você" if r["role"] == "user" else "Jarvis"
+                snippet = " ".join(r["content"].split())[:140]
+                lines.append(f"  [{when}] sessão {r['session_id']} - {who}: {snippet}")
+        else:
+            lines = ["Sessões recentes:"]
+            for r in results:
+                when = time.strftime("%d/%m/%Y %H:%M", time.localtime(r["started_at"]))
+                title = " ".join(r["title"].split())[:80]
+                lines.append(f"  [{when}] sessão {r['id']} - {r['count']} mensagens - {title}")
+        self._chat_insert("Jarvis > " + "\n".join(lines) + "\n", searchable=False)
+
+    def _on_ai_probe_done(self, available):
+        """Executado na thread da UI quando a verificação inicial do Ollama termina"""
+        self._ai_initially_available = available
+        self._presence_interval = 1 if available else 60
+        print(f"[JARVIS][AI] inicializado. available={self.ai.available}, initially_available={self._ai_initially_available}")
+
+        if not getattr(self, "_thinking", False):
+            try:
+                self.status_label.config(text="")
+            except Exception:
+                pass
+
+        if available:
+            self.warm_up_ai("inicialização")
+
         # initial messages
-        if self.ai.available == True:
+        if available:
             self.say("JARVIS online. Digite um comando, peça uma pesquisa ou faça uma solicitação.")
             if VOICE_AVAILABLE and self.voice_system:
                 self.say("Pressione CTRL+ALT+V para falar.")
@@ -2469,8 +6151,6 @@ class JarvisApp:
             self.say("JARVIS online. Apenas comandos.")
             if VOICE_AVAILABLE and self.voice_system:
                 self.say("Pressione CTRL+ALT+V para comandos por voz.")
-        
-        self._tts_buffer = ""
 
     def _toggle_tts(self):
         state = self.tts.toggle()
@@ -2483,13 +6163,14 @@ class JarvisApp:
         self.say(f"Voz {'ativada' if state else 'desativada'}.")
     
     def append_response_token(self, token):
-        self.chat.config(state="normal")
-        self.chat.insert("end", token)
-        self.chat.see("end")
-        self.chat.config(state="disabled")
+        start = time.perf_counter()
+        self._chat_insert(token)
 
         if self.tts.enabled:
             self._tts_buffer += token
+
+        self.ui_stream_stats["inserts"] += 1
+        self.ui_stream_stats["ui_ms"] += (time.perf_counter() - start) * 1000.0
     
     # NOVO MÉTODO: Verifica se pode tentar reativar a IA
     def _should_try_reactivate_ai(self):
@@ -2497,57 +6178,45 @@ class JarvisApp:
         return self._ai_initially_available and not self.ai.available
 
     def _reconnect_ollama(self):
-        """Tenta reconectar com o Ollama quando a janela é restaurada"""
+        """
+        Tenta reconectar com o Ollama quando a janela é restaurada. A verificação
+        roda em background (como na inicialização) e o resultado chega na thread
+        da UI; enquanto isso ai.probe_pending fica True e a thread da IA aguarda.
+        Retorna True se a verificação foi iniciada.
+        """
         # SÓ tenta reconectar se a IA estava disponível inicialmente
         if not self._ai_initially_available:
             print(f"[JARVIS][AI] IA não estava disponível inicialmente, ignorando reconexão")
             return False
-            
+        if self.ai.probe_pending:
+            return True
+
         try:
             print(f"[JARVIS][AI] Tentando reconectar com Ollama...")
-            # Testa a conexão com o Ollama
-            test_url = self.ai.url if hasattr(self.ai, 'url') else "http://localhost:11434/api/chat"
-            try:
-                # Tenta uma requisição simples de saúde
-                r = requests.get(test_url.replace('/api/chat', '/api/version'), timeout=2)
-                if r.status_code < 500:
-                    print(f"[JARVIS][AI] Conexão com Ollama estabelecida. available=True")
-                    self.ai.available = True
-                    return True
-            except Exception:
-                pass
-            
-            # Tenta endpoints alternativos
-            endpoints = [
-                test_url,
-                test_url.replace('/api/chat', '/api/tags'),
-                test_url.replace('/api/chat', '/api/version'),
-                "http://localhost:11434/api/version",
-                "http://localhost:11434/api/tags",
-                "http://localhost:11434/api/chat"
-            ]
-            
-            for ep in endpoints:
-                try:
-                    r = requests.get(ep, timeout=2)
-                    if r.status_code < 500:
-                        if '/api/chat' in ep:
-                            self.ai.url = ep
-                        print(f"[JARVIS][AI] Ollama encontrado em {ep}")
-                        self.ai.available = True
-                        return True
-                except Exception:
-                    continue
-            
-            print(f"[JARVIS][AI] Não foi possível conectar ao Ollama")
-            self.ai.available = False
-            return False
-            
+            # Mesma verificação paralela da inicialização (sem inferência)
+            self.ai.start_probe(lambda available: self.root.after(0, self._on_reconnect_done, available))
+            return True
         except Exception as e:
             print(f"[JARVIS][AI] Erro ao reconectar: {e}")
             self.ai.available = False
             return False
 
+    def _on_reconnect_done(self, available):
+        """Executado na thread da UI quando a verificação da reconexão termina"""
+        if available:
+            print(f"[JARVIS][AI] Conexão com Ollama estabelecida em {self.ai.base_url}. available=True")
+            self.warm_up_ai("reconexão")
+        else:
+            print(f"[JARVIS][AI] Não foi possível conectar ao Ollama")
+
+    def warm_up_ai(self, reason: str = ""):
+        """Pede ao AIEngine para pré-carregar o modelo (não bloqueia a UI)"""
+        try:
+            if self.ai.available:
+                self.ai.warm_up(reason)
+        except Exception as e:
+            print(f"[JARVIS][AI] Erro ao pré-carregar modelo: {e}")
+
     def restore_and_activate_ai(self):
         """Reativa a IA se estiver desativada - APENAS se estava disponível inicialmente"""
         # SÓ reativa se a IA estava disponível inicialmente
@@ -2569,13 +6238,22 @@ class JarvisApp:
             self._reconnect_ollama()
 
     def cancel_ai_response(self):
-        """Cancela a resposta da IA em andamento"""
+        """Cancela a resposta da IA em andamento e as pendentes na fila"""
         self._ai_cancelled = True
+        self.ai_scheduler.cancel_all()
         self.stop_thinking()
         self.say("Resposta cancelada.")
-        
-        # Reseta a flag
-        self._ai_cancelled = False
+
+    def _abort_ai_stream(self, jobs=None):
+        """Fecha as requisições abertas no Ollama (só as dos jobs indicados, ou todas)
+        e a linha parcial da resposta"""
+        self.ai.cancel_inflight(None if jobs is None else [job.cancel_event for job in jobs])
+        if self.token_buffer is not None:
+            self.token_buffer.clear()
+        if self._response_open:
+            # Fecha a linha parcial sem mandar o texto cancelado para o TTS
+            self._tts_buffer = ""
+            self.end_response_stream()
 
     def restore_from_tray_or_minimal(self):
         """Restaura a janela se estiver na bandeja ou em presença mínima, 
@@ -2648,8 +6326,8 @@ class JarvisApp:
         self.entry.delete(0, tk.END)
         self.entry.insert(0, corrected_text)
         
-        # Simula pressionar Enter para enviar
-        self.send()
+        # Simula pressionar Enter para enviar (pedido de voz tem prioridade na fila da IA)
+        self.send(priority=AIJobScheduler.PRIORITY_HIGH)
 
     def correct_voice_command(self, text):
         """Corrige um comando de voz mal interpretado usando similaridade"""
@@ -2669,7 +6347,7 @@ class JarvisApp:
         # 2. Comandos com barra (sem a barra)
         slash_commands = [
             "abrir", "pesquisar", "youtube", "digitar", "limpar", 
-            "ajuda", "ytvideo", "cancelar", "parar"
+            "ajuda", "ytvideo", "cancelar", "parar", "estatisticas", "historico", "conversas"
         ]
         
         # 3. Adiciona comandos dos addons
@@ -2733,18 +6411,104 @@ class JarvisApp:
         # Executa hooks pre_say
         self.addon_manager.execute_hooks('pre_say', text)
         
-        self.chat.config(state="normal")
-        self.chat.insert("end", f"Jarvis > {text}\n")
-        self.chat.see("end")
-        self.chat.config(state="disabled")
+        self._chat_insert(f"Jarvis > {text}\n")
         
         # Executa hooks post_say
         self.addon_manager.execute_hooks('post_say', text)
 
     def _print_user(self, text):
+        self._chat_insert(f"Você > {text}\n", see=False)
+
+    # -- transcript do chat --
+    def _chat_insert(self, text, url: Optional[str] = None, searchable: bool = True, see: bool = True):
+        """Único ponto de escrita no chat: grava no transcript e mantém o widget limitado.
+        Com url, o texto vira um link clicável."""
+        line_index = self.transcript.line_count() - 1
         self.chat.config(state="normal")
-        self.chat.insert("end", f"Você > {text}\n")
+        if url:
+            start_idx = self.chat.index("end-1c")
+            self.chat.insert("end", text)
+            self._tag_chat_link(start_idx, self.chat.index("end-1c"), line_index, url)
+        else:
+            self.chat.insert("end", text)
+        self.transcript.append(text, url=url, searchable=searchable)
+        self._trim_chat()
+        if see:
+            self.chat.see("end")
         self.chat.config(state="disabled")
+
+    def _tag_chat_link(self, start_idx, end_idx, line_index: int, url: str):
+        tag = f"link_{line_index}"
+        self.chat.tag_add(tag, start_idx, end_idx)
+        self.chat.tag_config(tag, foreground=FG_COLOR, underline=True)
+        self.chat.tag_bind(tag, "<Button-1>", lambda e, u=url: webbrowser.open(u))
+
+    def _chat_line_count(self) -> int:
+        return int(self.chat.index("end-1c").split(".")[0])
+
+    def _trim_chat(self):
+        """Remove do widget as linhas mais antigas além de chat_max_lines. Só acontece com
+        a visão no fim do chat, para não apagar o que o usuário está lendo."""
+        excess = self._chat_line_count() - self.chat_max_lines
+        # Folga para não apagar a cada linha nova
+        if excess < 50:
+            return
+        try:
+            if self.chat.yview()[1] < 0.999:
+                return
+        except Exception:
+            pass
+        for tag in self.chat.tag_names():
+            if tag.startswith("link_") and int(tag[5:]) < self._chat_first_line + excess:
+                self.chat.tag_delete(tag)
+        self.chat.delete("1.0", f"{excess + 1}.0")
+        self._chat_first_line += excess
+
+    def _on_chat_yscroll(self, first, last):
+        self._chat_scroll.set(first, last)
+        if (float(first) <= 0.0 and not self._loading_older
+                and self._chat_first_line > max(self.transcript.offset, self._chat_floor)):
+            self._loading_older = True
+            self.root.after_idle(self._load_older_chat_lines)
+
+    def _load_older_chat_lines(self, page: int = 100):
+        """Recarrega do transcript as linhas anteriores às que estão no widget."""
+        try:
+            start = max(self._chat_first_line - page, self.transcript.offset, self._chat_floor)
+            lines = self.transcript.get_lines(start, self._chat_first_line)
+            if not lines:
+                return
+            self.chat.config(state="normal")
+            self.chat.insert("1.0", "\n".join(lines) + "\n")
+            for offset, index in enumerate(range(start, start + len(lines))):
+                url = self.transcript.links.get(index)
+                if url:
+                    self._tag_chat_link(f"{offset + 1}.0", f"{offset + 2}.0", index, url)
+            self.chat.config(state="disabled")
+            self._chat_first_line = start
+            # Mantém na tela a linha que estava no topo
+            self.chat.yview(f"{len(lines) + 1}.0")
+        finally:
+            self._loading_older = False
+
+    def search_transcript(self, term: str, limit: int = 20):
+        """Busca no histórico completo do chat (/historico)."""
+        term = term.strip()
+        if not term:
+            total = self.transcript.line_count() - 1 - self.transcript.offset
+            self.say(f"O histórico tem {total} linhas. Use /historico [termo] para buscar.")
+            return
+        if not _normalize_for_search(term):
+            self.say(f"Termo de busca inválido: {term}")
+            return
+        results = self.transcript.search(term, limit=limit)
+        if not results:
+            self.say(f"Nada encontrado no histórico para: {term}")
+            return
+        lines = [f"Histórico: {len(results)} ocorrência(s) de '{term}' (mais recentes primeiro)"]
+        for index, line in results:
+            lines.append(f"  [{index + 1}] {line[:160]}")
+        self._chat_insert("Jarvis > " + "\n".join(lines) + "\n", searchable=False)
     
     # -- thinking / streaming helpers --
     def start_thinking(self):
@@ -2796,24 +6560,28 @@ class JarvisApp:
                 pass
 
     def start_response_stream(self):
-        self.chat.config(state="normal")
-        self.chat.insert("end", "Jarvis > ")
-        self.chat.see("end")
-        self.chat.config(state="disabled")
+        self._response_open = True
+        self._stream_started_at = time.perf_counter()
+        self.ui_stream_stats["streams"] += 1
+        self._chat_insert("Jarvis > ")
 
     def end_response_stream(self):
+        # Os últimos tokens do buffer entram antes da quebra de linha
+        if self.token_buffer is not None:
+            self.token_buffer.flush()
+        self._response_open = False
+        if self._stream_started_at is not None:
+            self.ui_stream_stats["stream_s"] += time.perf_counter() - self._stream_started_at
+            self._stream_started_at = None
         # Envia texto completo ao TTS, se ativado
         if self.tts.enabled and self._tts_buffer.strip():
             print(f"[TTS] Enviando texto completo: {self._tts_buffer.strip()[:80]}...")
             self.tts.speak_async(self._tts_buffer.strip())
         self._tts_buffer = ""
 
-        self.chat.config(state="normal")
-        self.chat.insert("end", "\n")
-        self.chat.see("end")
-        self.chat.config(state="disabled")
+        self._chat_insert("\n")
 
-    def send(self, event=None):
+    def send(self, event=None, priority: int = AIJobScheduler.PRIORITY_NORMAL):
         text = self.entry.get().strip()
         if not text:
             return
@@ -2875,10 +6643,11 @@ class JarvisApp:
             else:
                 print("[JARVIS][AI] Ignorando reativação: IA não estava disponível inicialmente")
 
-        if not self.ai.available:
+        # Se uma verificação estiver em andamento, a thread da IA aguarda o resultado
+        if not self.ai.available and not self.ai.probe_pending:
             if self._ai_initially_available:
                 if self._reconnect_ollama():
-                    print("[JARVIS][AI] Reconexão bem-sucedida!")
+                    print("[JARVIS][AI] Reconexão em andamento; a pergunta aguarda o resultado")
                 else:
                     mensagem_comandos = (
                         "Modelo local indisponível. "
@@ -2916,23 +6685,72 @@ class JarvisApp:
                 self.addon_manager.execute_hooks("post_send", text)
                 return
 
-        # Reseta flag de cancelamento antes de iniciar nova resposta
+        self._user_sent_message = True
+
+        # Reseta flag de cancelamento antes de iniciar nova resposta;
+        # cada job da fila tem seu próprio evento de cancelamento
         self._ai_cancelled = False
 
-        threading.Thread(
-            target=self._handle_ai,
-            args=(text,),
-            daemon=True
-        ).start()
+        if self.ai_scheduler.submit(text, priority) is None:
+            self.say("Muitas mensagens aguardando a IA. Espere as respostas ou digite 'cancelar'.")
 
         self.addon_manager.execute_hooks("post_send", text)
 
 
-    def _handle_ai(self, text):
+    def _make_on_token(self, cancel_event: Optional[threading.Event] = None):
+        """Cria o callback que envia os tokens do stream da IA para o chat"""
+        def append(token):
+            with self._ui_pending_lock:
+                self._ui_pending_tokens -= 1
+            # Tokens já agendados quando o cancelamento chegou são descartados
+            if cancel_event is None or not cancel_event.is_set():
+                self.append_response_token(token)
+
+        def on_token(token):
+            if getattr(self, "_ai_cancelled", False) or (cancel_event is not None and cancel_event.is_set()):
+                return False
+            self.ui_stream_stats["tokens"] += 1
+            if self.token_buffer is not None:
+                return self.token_buffer.push(token, cancel_event)
+            with self._ui_pending_lock:
+                self._ui_pending_tokens += 1
+            try:
+                self.root.after(0, lambda t=token: append(t))
+            except Exception:
+                with self._ui_pending_lock:
+                    self._ui_pending_tokens -= 1
+            return True
+        return on_token
+
+    def ui_backlog(self) -> int:
+        """Tokens entregues pela IA que o chat ainda não exibiu."""
+        if self.token_buffer is not None:
+            return self.token_buffer.pending()
+        return self._ui_pending_tokens
+
+    def research_with_context(self, query: str) -> str:
+        """Texto completo do artigo sobre o termo, via provedor de conhecimento (cache incluso)."""
+        kp = self.knowledge_provider
+        if kp is None or not kp.has_context():
+            return ""
+        try:
+            return kp.get_article(query).get("text", "").strip()
+        except Exception as e:
+            print(f"[JARVIS] Erro ao pesquisar com PYbrowser: {e}")
+            return ""
+
+    def _handle_ai(self, text, cancel_event: Optional[threading.Event] = None):
+        if cancel_event is None:
+            cancel_event = threading.Event()
+        # Requisições ao Ollama feitas nesta thread pertencem a este job
+        self.ai.bind_cancel_scope(cancel_event)
         streamed = False
         cancelled = False
 
         try:
+            if not self.ai.available and self.ai.probe_pending:
+                self.ai.wait_for_probe(timeout=10)
+
             if not self.ai.available:
                 print(f"[JARVIS][AI] ERRO: IA não disponível para processar: '{text}'")
                 self.root.after(0, lambda: self.say("IA não disponível no momento. Tente novamente."))
@@ -2940,7 +6758,38 @@ class JarvisApp:
 
             print(f"[JARVIS][AI] Processando pergunta: '{text}'")
             self.start_thinking()
-            plan = self.ai.plan(text)
+            plan = None
+            early_stream = self.ai.fused_mode or self.ai.speculative_mode
+            if early_stream:
+                plan = self.ai.quick_plan(text)
+
+            if early_stream and plan is None:
+                chat_streaming = []
+
+                def on_plan(p):
+                    if (p.get("action") or "chat").lower().strip() != "chat":
+                        return False
+                    # Ação de chat: a resposta continua chegando no mesmo stream
+                    chat_streaming.append(True)
+                    self.root.after(0, self.restore_from_tray_or_minimal)
+                    self.root.after(0, self.start_response_stream)
+                    self.root.after(0, self.stop_thinking)
+                    return True
+
+                if self.ai.fused_mode:
+                    print(f"[JARVIS][AI] Modo fundido: plano e resposta em uma única requisição")
+                    plan = self.ai.stream_plan_and_chat(text, on_plan, self._make_on_token(cancel_event))
+                else:
+                    print(f"[JARVIS][AI] Modo especulativo: planner e chat em paralelo")
+                    plan = self.ai.speculative_plan_and_chat(text, on_plan, self._make_on_token(cancel_event))
+                if chat_streaming:
+                    streamed = True
+                    print(f"[JARVIS][AI] Streaming concluído com sucesso")
+                    return
+            elif plan is None:
+                plan = self.ai.plan(text)
+            if cancel_event.is_set():
+                return
             action = (plan.get("action") or "chat").lower().strip()
 
             if action in {"open", "search", "youtube", "ytvideo", "type", "clear", "math"}:
@@ -2962,19 +6811,12 @@ class JarvisApp:
                 time.sleep(0.3)
                 self.root.after(0, self.start_response_stream)
 
-                def on_token(token):
-                    if getattr(self, "_ai_cancelled", False):
-                        return False
-                    try:
-                        self.root.after(0, lambda t=token: self.append_response_token(t))
-                    except Exception:
-                        pass
-                    return True
+                on_token = self._make_on_token(cancel_event)
 
                 context = ""
                 try:
                     if self.knowledge_provider and self.knowledge_provider.has_context():
-                        kb = self.knowledge_provider.find_wikipedia_context(query)
+                        kb = self.knowledge_provider.find_wikipedia_context(query, question=text, cancel_event=cancel_event)
                         context = kb.get("text", "") or ""
                         source_title = kb.get("title", "") or query
                         source_url = kb.get("url", "") or ""
@@ -2993,6 +6835,8 @@ class JarvisApp:
                     print(f"[JARVIS][PYbrowser] Falha ao buscar contexto: {e}")
                     context = ""
 
+                if cancel_event.is_set():
+                    return
                 try:
                     # Timeout dobrado para contextos grandes
                     self.ai.stream_chat(text, on_token, context=context, timeout=120)
@@ -3002,7 +6846,8 @@ class JarvisApp:
                     streamed = False
                 finally:
                     try:
-                        self.root.after(0, self.end_response_stream)
+                        if not cancel_event.is_set():
+                            self.root.after(0, self.end_response_stream)
                     except Exception:
                         pass
                     try:
@@ -3016,14 +6861,7 @@ class JarvisApp:
             time.sleep(0.3)
             self.root.after(0, self.start_response_stream)
 
-            def on_token(token):
-                if getattr(self, "_ai_cancelled", False):
-                    return False
-                try:
-                    self.root.after(0, lambda t=token: self.append_response_token(t))
-                except Exception:
-                    pass
-                return True
+            on_token = self._make_on_token(cancel_event)
 
             try:
                 self.stop_thinking()
@@ -3037,10 +6875,10 @@ class JarvisApp:
                 streamed = False
             except Exception as e:
                 print(f"[JARVIS][AI] Erro no streaming: {type(e).__name__}: {e}")
-                if not self._ai_cancelled:
-                    streamed = False
-                else:
-                    cancelled = True
+                streamed = False
+
+        except AIRequestCancelled:
+            print(f"[JARVIS][AI] Requisição cancelada: '{text}'")
 
         except Exception as e:
             print(f"[JARVIS][AI] Erro geral no _handle_ai: {type(e).__name__}: {e}")
@@ -3049,6 +6887,9 @@ class JarvisApp:
             streamed = False
 
         finally:
+            self.ai.bind_cancel_scope(None)
+            # O cancelamento já avisou o usuário e fechou a linha da resposta
+            cancelled = cancel_event.is_set()
             if streamed and not cancelled:
                 try:
                     self.root.after(0, self.end_response_stream)
@@ -3061,10 +6902,6 @@ class JarvisApp:
                     pass
                 return
             elif cancelled:
-                try:
-                    self.root.after(0, lambda: self.say("Resposta cancelada."))
-                except Exception:
-                    pass
                 try:
                     self.root.after(0, self.stop_thinking)
                 except Exception:
@@ -3074,8 +6911,7 @@ class JarvisApp:
 
         print(f"[JARVIS][AI] Tentando fallback síncrono...")
 
-        if self._ai_cancelled:
-            self.root.after(0, lambda: self.say("Resposta cancelada."))
+        if cancel_event.is_set():
             self.root.after(0, self.stop_thinking)
             return
 
@@ -3084,7 +6920,7 @@ class JarvisApp:
             decision = self.ai.decide(text)
             print(f"[JARVIS][AI] Resposta do decide(): {decision}")
 
-            if not self._ai_cancelled:
+            if not cancel_event.is_set():
                 if decision.get("action") == "chat":
                     response = decision.get("response", "")
                     if response:
@@ -3095,14 +6931,12 @@ class JarvisApp:
                         print(f"[JARVIS][AI] Resposta vazia do fallback")
                 else:
                     self.root.after(0, lambda: self.router.execute(decision))
-            else:
-                self.root.after(0, lambda: self.say("Resposta cancelada."))
+        except AIRequestCancelled:
+            print(f"[JARVIS][AI] Fallback cancelado")
         except Exception as e:
             print(f"[JARVIS][AI] Erro no fallback: {type(e).__name__}: {e}")
-            if not self._ai_cancelled:
+            if not cancel_event.is_set():
                 self.root.after(0, lambda: self.say(f"Erro ao processar sua solicitação: {type(e).__name__}"))
-            else:
-                self.root.after(0, lambda: self.say("Resposta cancelada."))
         finally:
             try:
                 self.root.after(0, self.stop_thinking)
@@ -3113,17 +6947,35 @@ class JarvisApp:
         self.chat.config(state="normal")
         self.chat.delete("1.0", "end")
         self.chat.config(state="disabled")
-        self.ai.conversation_history = []
+        # O transcript continua disponível para o /historico, mas não volta para a tela
+        self._chat_first_line = self._chat_floor = self.transcript.line_count() - 1
+        self.ai.reset_history()
+        if self.conversation_store is not None:
+            self.conversation_store.new_session()
         self.stop_thinking()
         self._tts_buffer = ""
 
     def run(self):
-        self.root.mainloop()
+        try:
+            self.root.mainloop()
+        finally:
+            if self.ai.planner_cache is not None:
+                self.ai.planner_cache.flush()
+            if self.conversation_store is not None:
+                self.conversation_store.close()
 
 # =========================
 # MAIN
 # =========================
 if __name__ == "__main__":
+    # python main.py --build-wiki-index <saída do WikiExtractor>
+    if len(sys.argv) > 1 and sys.argv[1] == "--build-wiki-index":
+        if len(sys.argv) < 3:
+            print("Uso: python main.py --build-wiki-index <arquivo .json/.bz2/.gz ou pasta do WikiExtractor>")
+            sys.exit(2)
+        build_offline_wiki_index(sys.argv[2])
+        sys.exit(0)
+
     # Verificar dependências de voz
     if not VOICE_AVAILABLE:
         print("⚠️  Bibliotecas de voz não disponíveis. Instale com:")
@@ -0,0 +1,176 @@
+"""
+Testes do AsyncOllamaTransport contra um servidor local que imita o /api/chat do
+Ollama (HTTP/1.1 com Transfer-Encoding: chunked e NDJSON).
+
+    python -m unittest discover -s tests
+"""
+
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def ndjson(*chunks) -> bytes:
+    return b"".join(json.dumps(c).encode("utf-8") + b"\n" for c in chunks)
+
+
+def token(text: str) -> dict:
+    return {"message": {"role": "assistant", "content": text}, "done": False}
+
+
+DONE = {"message": {"role": "assistant", "content": ""}, "done": True, "eval_count": 3}
+
+
+class StandInServer:
+    """
+    Servidor TCP mínimo: lê a requisição e executa script(conn), que escreve a
+    resposta crua (cabeçalhos e chunks) do jeito que o teste quiser.
+    """
+
+    def __init__(self, script):
+        self.script = script
+        self.disconnected = threading.Event()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(1)
+        self.url = f"http://127.0.0.1:{self.sock.getsockname()[1]}/api/chat"
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        conn, _ = self.sock.accept()
+        with conn:
+            data = b""
+            while b"\r\n\r\n" not in data:
+                data += conn.recv(65536)
+            head, _, body = data.partition(b"\r\n\r\n")
+            length = int(next(
+                line.split(b":", 1)[1] for line in head.split(b"\r\n") if line.lower().startswith(b"content-length")
+            ))
+            while len(body) < length:
+                body += conn.recv(65536)
+            try:
+                self.script(conn)
+            except OSError:
+                self.disconnected.set()
+
+    def close(self):
+        self.sock.close()
+
+
+def chunked_headers(conn):
+    conn.sendall(
+        b"HTTP/1.1 200 OK\r\n"
+        b"Content-Type: application/x-ndjson\r\n"
+        b"Transfer-Encoding: chunked\r\n\r\n"
+    )
+
+
+def send_chunk(conn, data: bytes, extension: bytes = b""):
+    conn.sendall(b"%x%s\r\n" % (len(data), extension) + data + b"\r\n")
+
+
+class AsyncTransportTests(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = main.AsyncOllamaTransport(batch_ms=0, high_water=4)
+        self.server = None
+
+    def tearDown(self):
+        self.transport.loop.call_soon_threadsafe(self.transport.loop.stop)
+        if self.server is not None:
+            self.server.close()
+
+    def _stream(self, on_batch, **kwargs):
+        future = self.transport.submit(
+            self.transport.stream(self.server.url, {"model": "x"}, on_batch, timeout=5, **kwargs)
+        )
+        return future
+
+    def test_chunked_framing(self):
+        body = ndjson(token("Olá"), token(", "), token("mundo"), DONE)
+        first_line_end = body.index(b"\n") + 1
+
+        def script(conn):
+            chunked_headers(conn)
+            # Uma linha NDJSON dividida entre dois chunks, e uma extensão de chunk
+            send_chunk(conn, body[:first_line_end + 10], b";ext=1")
+            send_chunk(conn, body[first_line_end + 10:])
+            conn.sendall(b"0\r\n\r\n")
+
+        self.server = StandInServer(script)
+        batches = []
+        final = self._stream(batches.append).result(timeout=5)
+        self.assertEqual("".join(batches), "Olá, mundo")
+        self.assertTrue(final.get("done"))
+        self.assertEqual(final.get("eval_count"), 3)
+
+    def test_split_chunk_boundary(self):
+        body = ndjson(token("abc"), token("def"), DONE)
+
+        def script(conn):
+            chunked_headers(conn)
+            # Tamanho, dados e o CRLF final chegam em segmentos TCP separados
+            conn.sendall(b"%x\r\n" % len(body))
+            time.sleep(0.05)
+            conn.sendall(body[:7])
+            time.sleep(0.05)
+            conn.sendall(body[7:])
+            time.sleep(0.05)
+            conn.sendall(b"\r\n")
+            time.sleep(0.05)
+            conn.sendall(b"0\r\n\r\n")
+
+        self.server = StandInServer(script)
+        batches = []
+        final = self._stream(batches.append).result(timeout=5)
+        self.assertEqual("".join(batches), "abcdef")
+        self.assertTrue(final.get("done"))
+
+    def test_cancel_closes_connection(self):
+        def script(conn):
+            chunked_headers(conn)
+            while True:
+                send_chunk(conn, ndjson(token("x")))
+                time.sleep(0.02)
+
+        self.server = StandInServer(script)
+        got_first = threading.Event()
+        future = self._stream(lambda text: got_first.set())
+        self.assertTrue(got_first.wait(5))
+        future.cancel()
+        # O servidor percebe a conexão fechada ao tentar escrever o próximo chunk
+        self.assertTrue(self.server.disconnected.wait(5))
+
+    def test_backpressure_waits_for_consumer(self):
+        def script(conn):
+            chunked_headers(conn)
+            for i in range(50):
+                send_chunk(conn, ndjson(token(f"{i} ")))
+            send_chunk(conn, ndjson(DONE))
+            conn.sendall(b"0\r\n\r\n")
+
+        self.server = StandInServer(script)
+        consumed = threading.Event()
+        batches = []
+        # A interface "não exibiu" nada até consumed ser marcado
+        future = self._stream(batches.append, backlog=lambda: 0 if consumed.is_set() else 100)
+        time.sleep(0.3)
+        self.assertEqual(len(batches), 1)
+        self.assertFalse(future.done())
+        consumed.set()
+        future.result(timeout=5)
+        self.assertEqual("".join(batches), "".join(f"{i} " for i in range(50)))
+        self.assertGreaterEqual(self.transport.get_stats()["backpressure"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()